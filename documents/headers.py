@@ -0,0 +1,195 @@
+from collections import defaultdict
+import re
+
+
+# headers at least this similar (1 - edit distance / length) get unified
+MIN_SIMILARITY = 0.85
+# size of the character n-grams used to find candidate pairs of headers
+NGRAM_SIZE = 3
+
+
+def clean_headers(headers):
+    if isinstance(headers, str):
+        headers = [headers]
+    cleaned_headers = []
+    for raw_h in headers:
+        cleaned_headers.append(re.sub(
+            r"\s+", " ", raw_h.lower().replace(
+                "recevied", "received"
+            )
+        ).strip())
+    return cleaned_headers
+
+
+def header_key(header):
+    """
+    The canonical form of a cleaned header we compare with, just its words
+    and numbers. "date_received", "Date Received:" and "date - received"
+    all become "date received".
+    """
+    return " ".join(re.findall(r"[^\W_]+", header.lower()))
+
+
+def max_distance(a, b):
+    """
+    The most edits two headers can be apart and still get unified.
+    """
+    return int(max(len(a), len(b)) * (1 - MIN_SIMILARITY))
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Damerau-Levenshtein (optimal string alignment) distance between a and
+    b, only filling in the diagonal band of the matrix that can be within
+    max_distance. Returns max_distance + 1 for anything further apart, as
+    soon as we know it is.
+    """
+    too_far = max_distance + 1
+    if abs(len(a) - len(b)) > max_distance:
+        return too_far
+
+    prev_prev_row = None
+    row = [j if j <= max_distance else too_far for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        prev_row, row = row, [too_far] * (len(b) + 1)
+        if i <= max_distance:
+            row[0] = i
+        lo = max(1, i - max_distance)
+        hi = min(len(b), i + max_distance)
+        for j in range(lo, hi + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            d = min(
+                prev_row[j - 1] + cost,  # substitution
+                prev_row[j] + 1,  # deletion
+                row[j - 1] + 1,  # insertion
+            )
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] \
+                    and a[i - 2] == b[j - 1]:
+                d = min(d, prev_prev_row[j - 2] + 1)  # transposition
+            row[j] = min(d, too_far)
+        if min(row[lo - 1:hi + 1]) > max_distance:
+            return too_far
+        prev_prev_row = prev_row
+    return row[len(b)]
+
+
+def ngrams(text, n=NGRAM_SIZE):
+    padded = f"{' ' * (n - 1)}{text}{' ' * (n - 1)}"
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def similar_keys(keys):
+    """
+    Find every pair of header keys within max_distance of each other.
+    Instead of comparing every pair, an n-gram index finds the keys
+    sharing enough n-grams to possibly be that close (each edit can only
+    change NGRAM_SIZE + 1 of them) and only those get an edit distance.
+    Returns [(distance, key1, key2)].
+    """
+    pairs = []
+    # n-gram => indexes of keys containing it
+    index = defaultdict(list)
+    key_ngrams = []
+    for ix, key in enumerate(keys):
+        grams = ngrams(key)
+        key_ngrams.append(grams)
+
+        shared = defaultdict(int)
+        for gram in grams:
+            for other_ix in index[gram]:
+                shared[other_ix] += 1
+        for gram in grams:
+            index[gram].append(ix)
+
+        for other_ix, n_shared in shared.items():
+            other = keys[other_ix]
+            max_edits = max_distance(key, other)
+            if not max_edits:
+                continue
+            max_grams = max(len(grams), len(key_ngrams[other_ix]))
+            if n_shared < max_grams - max_edits * (NGRAM_SIZE + 1):
+                continue
+            distance = edit_distance(key, other, max_edits)
+            if distance <= max_edits:
+                pairs.append((distance, other, key))
+    return pairs
+
+
+class HeaderClusters:
+    """
+    Union-find over headers, which refuses to merge two clusters if any of
+    their headers appear in the same CSV: those are different columns, no
+    matter how alike they look.
+    """
+    def __init__(self, csvs_by_header):
+        self.parent = {header: header for header in csvs_by_header}
+        # root header => indexes of the CSVs its cluster's headers are in
+        self.csvs = {
+            header: set(csvs) for header, csvs in csvs_by_header.items()
+        }
+
+    def find(self, header):
+        while self.parent[header] != header:
+            self.parent[header] = self.parent[self.parent[header]]
+            header = self.parent[header]
+        return header
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return True
+        if self.csvs[root_a] & self.csvs[root_b]:
+            return False
+        if len(self.csvs[root_a]) < len(self.csvs[root_b]):
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.csvs[root_a] |= self.csvs.pop(root_b)
+        return True
+
+    def clusters(self):
+        clusters = defaultdict(list)
+        for header in self.parent:
+            clusters[self.find(header)].append(header)
+        return list(clusters.values())
+
+
+def unify_headers(header_lists):
+    """
+    Work out which of the (cleaned) headers of a set of CSVs are the same
+    column, spelled differently: the same words with different punctuation
+    or small typos like "date recieved". Headers in the same CSV or with
+    different numbers in them ("officer 1", "officer 2") are never unified.
+    Each group of headers gets the name most CSVs use. Returns {header:
+    unified header}, for every header.
+    """
+    # header => indexes of the CSVs it's in
+    csvs_by_header = defaultdict(set)
+    for csv_ix, headers in enumerate(header_lists):
+        for header in headers:
+            csvs_by_header[header].add(csv_ix)
+
+    headers_by_key = defaultdict(list)
+    for header in sorted(csvs_by_header):
+        key = header_key(header)
+        # blank headers don't tell us anything, leave them alone
+        if key:
+            headers_by_key[key].append(header)
+
+    keys = sorted(headers_by_key)
+    pairs = [(0, key, key) for key in keys]
+    pairs += sorted(similar_keys(keys))
+
+    clusters = HeaderClusters(csvs_by_header)
+    for _, key1, key2 in pairs:
+        if re.findall(r"\d+", key1) != re.findall(r"\d+", key2):
+            continue
+        for header1 in headers_by_key[key1]:
+            for header2 in headers_by_key[key2]:
+                clusters.union(header1, header2)
+
+    mapping = {}
+    for headers in clusters.clusters():
+        unified = min(headers, key=lambda h: (-len(csvs_by_header[h]), h))
+        for header in headers:
+            mapping[header] = unified
+    return mapping
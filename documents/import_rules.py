@@ -0,0 +1,251 @@
+from bisect import bisect_left
+import os
+import re
+
+import tablib
+import yaml
+
+from .util import classify
+
+
+PROCESSED_TYPE = "processed"
+DOCUMENT_TYPE = "document"
+SKIP_TYPE = "skip"
+
+# How import_safe decides what a new file is and, for processed files,
+# which document it came from. Override any of these with a YAML file
+# (import_safe --rules) containing the keys to change.
+DEFAULT_RULES = {
+    # the first matching rule decides a file's type. files that don't match
+    # any (e.g. .txt, which can be either) go to the review queue
+    "types": [
+        {
+            # .ocr.pdf needs checking before the .pdf documents
+            "type": PROCESSED_TYPE,
+            # files in some state of completion, see util.classify
+            "statuses": ["complete", "awaiting-cleaning", "awaiting-csv"],
+            # text files are ambiguous
+            "exclude_suffixes": [".txt"],
+        },
+        {
+            "type": DOCUMENT_TYPE,
+            "suffixes": [
+                ".pdf", ".xlsx", ".doc", ".docx", ".msg", ".eml", ".mp3",
+                ".wma",
+            ],
+            "ignore_case": True,
+        },
+    ],
+    # stripped off a processed file to get the name of its parent
+    "parent_suffixes": [
+        ".cleaned.csv", ".complete.csv", ".rough.csv", ".precleaned.csv",
+        ".ocr.pdf", ".csv", ".txt",
+    ],
+    # groups of parent match strategies, tried in order. the first group
+    # finding any candidates decides the parent:
+    #   prefix: documents starting with the stripped processed file name
+    #   table: [name]_[table_no].csv exported from a DOC/X
+    #   sheet: [name]-[sheet].csv exported from an XLS/X
+    "parent_strategies": [["prefix"], ["table", "sheet"]],
+    "table_pattern": r"_\d\.[^\.]*\.?csv",
+    "sheet_separator": "-",
+    # the only kinds of documents table and sheet CSVs come from
+    "table_sheet_parents": [".doc", ".docx", ".xls", ".xlsx"],
+}
+
+REVIEW_HEADERS = (
+    "agency", "file", "type", "parent", "reason", "candidates",
+)
+
+
+def load_rules(path=None):
+    """
+    The default rules, with anything in the YAML file at path replacing
+    the matching top level keys.
+    """
+    rules = dict(DEFAULT_RULES)
+    if path:
+        with open(path, "r") as f:
+            rules.update(yaml.safe_load(f) or {})
+    return rules
+
+
+class PrefixIndex:
+    """
+    A sorted list of file paths that can find every path starting with a
+    given prefix with a binary search, in place of a file__startswith query.
+    """
+    def __init__(self, files=()):
+        self.files = sorted(files)
+
+    def add(self, file):
+        ix = bisect_left(self.files, file)
+        if ix == len(self.files) or self.files[ix] != file:
+            self.files.insert(ix, file)
+
+    def startswith(self, prefix):
+        matches = []
+        ix = bisect_left(self.files, prefix)
+        while ix < len(self.files) and self.files[ix].startswith(prefix):
+            matches.append(self.files[ix])
+            ix += 1
+        return matches
+
+
+def file_type(file, rules):
+    """
+    The type of a new file (PROCESSED_TYPE or DOCUMENT_TYPE) going by the
+    rules, or None if no rule matched.
+    """
+    status = classify(file)
+    for rule in rules["types"]:
+        name = file.lower() if rule.get("ignore_case") else file
+        if "statuses" in rule and status not in rule["statuses"]:
+            continue
+        if "suffixes" in rule and not name.endswith(tuple(rule["suffixes"])):
+            continue
+        if name.endswith(tuple(rule.get("exclude_suffixes", []))):
+            continue
+        return rule["type"]
+    return None
+
+
+def strip_parent_suffixes(file, rules):
+    possible_parent = file
+    for ext in rules["parent_suffixes"]:
+        if possible_parent.endswith(ext):
+            possible_parent = possible_parent[:-len(ext)]
+    return possible_parent
+
+
+def parent_candidates(file, strategy, index, rules):
+    """
+    Documents in the index that could be the parent of a processed file,
+    using a single match strategy.
+    """
+    if strategy == "prefix":
+        return index.startswith(strip_parent_suffixes(file, rules))
+
+    if strategy == "table":
+        possible_parent = re.sub(rules["table_pattern"], "", file)
+    elif strategy == "sheet":
+        separator = rules["sheet_separator"]
+        if separator not in os.path.basename(file):
+            return []
+        possible_parent = file.rsplit(separator, 1)[0]
+    else:
+        raise ValueError(f"Unknown parent match strategy: {strategy}")
+
+    extensions = tuple(rules["table_sheet_parents"])
+    return [
+        candidate
+        for candidate in index.startswith(f"{possible_parent}.")
+        if candidate.endswith(extensions)
+    ]
+
+
+def find_parent(file, index, rules):
+    """
+    Find the parent document of a processed file. Returns (parent, reason,
+    candidates), parent is None if there wasn't exactly one candidate.
+    """
+    for strategies in rules["parent_strategies"]:
+        candidates = []
+        for strategy in strategies:
+            for candidate in parent_candidates(file, strategy, index, rules):
+                if candidate not in candidates:
+                    candidates.append(candidate)
+        if len(candidates) == 1:
+            return candidates[0], None, candidates
+        if candidates:
+            return None, "Ambiguous parent", candidates
+    return None, "No parent found", []
+
+
+def resolve_files(agency_name, files, document_files, rules, resolutions=None):
+    """
+    Work out what to do with every new file of an agency in one pass.
+    document_files are the agency's existing document paths. resolutions,
+    {(agency, file): (type, parent)}, come from a reviewed queue and win
+    over the rules. Returns (documents, processed, unresolved): the files to
+    add as documents, (file, parent) pairs to add as processed documents and
+    review queue rows for everything else.
+    """
+    if resolutions is None:
+        resolutions = {}
+
+    documents = []
+    processed_files = []
+    unresolved = []
+    for file in files:
+        mtype, parent = resolutions.get((agency_name, file), (None, None))
+        if mtype == SKIP_TYPE:
+            continue
+        if mtype == PROCESSED_TYPE and parent:
+            processed_files.append((file, parent))
+            continue
+        if not mtype:
+            mtype = file_type(file, rules)
+
+        if mtype == DOCUMENT_TYPE:
+            documents.append(file)
+        elif mtype == PROCESSED_TYPE:
+            processed_files.append((file, None))
+        else:
+            unresolved.append({
+                "agency": agency_name, "file": file, "type": "",
+                "parent": "", "reason": "Unknown file type",
+                "candidates": "",
+            })
+
+    # new documents can be parents too
+    index = PrefixIndex(document_files)
+    for file in documents:
+        index.add(file)
+
+    processed = []
+    for file, parent in processed_files:
+        if parent:
+            processed.append((file, parent))
+            continue
+        parent, reason, candidates = find_parent(file, index, rules)
+        if parent:
+            processed.append((file, parent))
+            continue
+        unresolved.append({
+            "agency": agency_name, "file": file, "type": PROCESSED_TYPE,
+            "parent": "", "reason": reason,
+            "candidates": "; ".join(candidates),
+        })
+
+    return documents, processed, unresolved
+
+
+def write_review_queue(path, unresolved):
+    """
+    Write the files we couldn't resolve to a CSV. Fill in the type column
+    (document, processed or skip) and, for processed files, the parent
+    column, then pass it back in with import_safe --resume-from.
+    """
+    queue = tablib.Dataset(headers=REVIEW_HEADERS)
+    for row in unresolved:
+        queue.append([row[h] for h in REVIEW_HEADERS])
+    with open(path, "w") as f:
+        f.write(queue.csv)
+
+
+def load_review_queue(path):
+    """
+    Read the decisions out of a reviewed queue CSV.
+    Returns {(agency, file): (type, parent)}.
+    """
+    with open(path, "r") as f:
+        queue = tablib.Dataset().load(f.read(), format="csv")
+    resolutions = {}
+    for row in queue.dict:
+        mtype = (row.get("type") or "").strip().lower()
+        parent = (row.get("parent") or "").strip()
+        if mtype not in (DOCUMENT_TYPE, PROCESSED_TYPE, SKIP_TYPE):
+            continue
+        resolutions[(row["agency"], row["file"])] = (mtype, parent or None)
+    return resolutions
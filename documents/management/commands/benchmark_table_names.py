@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import itertools
+import time
+
+from django.core.management.base import BaseCommand
+import numpy as np
+
+from documents.management.commands.export_sqlite_dbs import (
+    Command as ExportCommand, common_filename, smith_waterman
+)
+from documents.models import Agency, ProcessedDocument
+
+
+# The original, pure Python, Smith-Waterman from export_sqlite_dbs. It's
+# kept here as the reference the numpy version gets checked against.
+def reference_matrix(a, b, match_score=3, gap_cost=2):
+    H = np.zeros((len(a) + 1, len(b) + 1))
+    i_range = range(1, H.shape[0])
+    j_range = range(1, H.shape[1])
+    for i, j in itertools.product(i_range, j_range):
+        score = match_score if a[i - 1] == b[j - 1] else -match_score
+        match = H[i - 1, j - 1] + score
+        delete = H[i - 1, j] - gap_cost
+        insert = H[i, j - 1] - gap_cost
+        H[i, j] = max(match, delete, insert, 0)
+    return H
+
+
+def reference_traceback(H, b, b_='', old_i=0):
+    # flip H to get index of **last** occurrence of H.max() with np.argmax()
+    H_flip = np.flip(np.flip(H, 0), 1)
+    i_, j_ = np.unravel_index(H_flip.argmax(), H_flip.shape)
+    # (i, j) are **last** indexes of H.max()
+    i, j = np.subtract(H.shape, (i_ + 1, j_ + 1))
+    if H[i, j] == 0:
+        return b_, j
+    b_ = b[j - 1] + '-' + b_ if old_i - i > 1 else b[j - 1] + b_
+    return reference_traceback(H[0:i, 0:j], b, b_, i)
+
+
+def reference_smith_waterman(a, b, match_score=3, gap_cost=2):
+    a, b = a.lower(), b.lower()
+    H = reference_matrix(a, b, match_score, gap_cost)
+    b_, pos = reference_traceback(H, b)
+    return a[pos: pos + len(b_)]
+
+
+class Command(BaseCommand):
+    help = """
+    Benchmark the table naming alignment used by export_sqlite_dbs against
+    the original pure Python implementation, on each agency's exportable
+    filenames. Fails if the two ever disagree.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--agency', type=str,
+            help='Only benchmark this agency (by name)'
+        )
+        parser.add_argument(
+            '--max-files', type=int, default=50,
+            help=(
+                'Only use this many filenames per agency, the reference '
+                'implementation is very slow'
+            )
+        )
+
+    def agency_filenames(self, agency, max_files):
+        return list(ProcessedDocument.objects.filter(
+            document__agency=agency,
+            document__status__in=ExportCommand.EXPORT_STATUSES,
+            document__no_new_records=False,
+            status__in=ExportCommand.EXPORT_STATUSES,
+        ).exclude(
+            file="",
+        ).values_list("file", flat=True)[:max_files])
+
+    def handle(self, *args, **options):
+        agencies = Agency.objects.all()
+        if options.get('agency'):
+            agencies = agencies.filter(name=options['agency'])
+
+        total_reference = 0
+        total_numpy = 0
+        for agency in agencies:
+            filenames = self.agency_filenames(agency, options['max_files'])
+            if len(filenames) < 2:
+                continue
+
+            start = time.time()
+            expected = common_filename(
+                filenames, align=reference_smith_waterman
+            )
+            reference_elapsed = time.time() - start
+
+            # time it cold, the cache would make this meaningless
+            smith_waterman.cache_clear()
+            start = time.time()
+            result = common_filename(filenames)
+            numpy_elapsed = time.time() - start
+
+            assert result == expected, \
+                f"{agency}: expected {expected!r}, got {result!r}"
+
+            total_reference += reference_elapsed
+            total_numpy += numpy_elapsed
+            print(f"{agency.name}: {len(filenames)} files, "
+                  f"reference {reference_elapsed:.3f}s, "
+                  f"numpy {numpy_elapsed:.3f}s")
+
+        print(f"Total: reference {total_reference:.3f}s, "
+              f"numpy {total_numpy:.3f}s")
+        if total_numpy:
+            print(f"Speedup: {total_reference / total_numpy:.1f}x")
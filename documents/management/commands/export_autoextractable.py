@@ -47,8 +47,8 @@ import email
 from html.parser import HTMLParser
 
 from documents.models import Agency, Document, ProcessedDocument
-from documents.pdf2text import pdf2text
-from documents.util import STATUS_SCORES
+from documents.pdf2text import cached_pdf2pages, pdf2segment
+from documents.util import SEGMENTABLE_STATUSES, STATUS_SCORES
 
 
 VERSION = "2.0.1"
@@ -86,15 +86,6 @@ LABELS = [
 ]
 
 
-SEGMENTABLE_STATUSES = [
-    "awaiting-reading",
-    "auto-extracted",
-    "awaiting-extraction",
-    "case-doc",
-    "unchecked",
-]
-
-
 class Command(BaseCommand):
     help = """
     This exports auto-extractable PDF text, using their pre-segmented forms,
@@ -104,16 +95,11 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('output_json', type=str)
 
-    # NOTE: Sync'd with documents/views.py
     def agency_segmentable_pdocs(self, agency):
-        return ProcessedDocument.objects.filter(
-            # TODO: OR .eml and awaiting-reading OR .txt and awaiting-reading
-            # and do a little processing on the .eml texts, cleaning them up a
-            # little
-            file__endswith=".ocr.pdf",
-            document__agency=agency,
-            document__status__in=SEGMENTABLE_STATUSES,
-        ).order_by("-pages")
+        # TODO: OR .eml and awaiting-reading OR .txt and awaiting-reading
+        # and do a little processing on the .eml texts, cleaning them up a
+        # little
+        return ProcessedDocument.objects.segmentable(agency=agency)
 
     def agency_segmentable_docs_pdocs(self, agency):
         """
@@ -219,8 +205,12 @@ class Command(BaseCommand):
                 # TODO: convert to text using various methods based
                 # on the file extension/type
                 text = None
+                # per-page text for PDFs, segments are sliced out of this
+                pdf_pages = None
                 if cleaned_name.endswith(".pdf"):
-                    text = pdf2text(doc_or_pdoc.file.path)
+                    text, pdf_pages = cached_pdf2pages(
+                        doc_or_pdoc.file.path
+                    )
 
                 elif cleaned_name.endswith(".eml"):
 
@@ -277,7 +267,9 @@ class Command(BaseCommand):
                             "index": index,
                             "range": page_range,
                         }
-                        pdf_text = pdf2text(doc_or_pdoc.file.path, pages=page_range)
+                        pdf_text = pdf2segment(
+                            doc_or_pdoc.file.path, pdf_pages, page_range
+                        )
                         segment_file_data["data_raw"] = pdf_text
                         data["file_data"].append(segment_file_data)
 
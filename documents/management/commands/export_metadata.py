@@ -8,7 +8,9 @@ from django.core.management.base import BaseCommand
 import sqlite3
 import sqlite_utils
 
-from documents.models import Agency, Document, ProcessedDocument
+from documents.models import (
+    Agency, AgencyStatusRollup, Document, ProcessedDocument
+)
 
 
 class Command(BaseCommand):
@@ -61,8 +63,15 @@ class Command(BaseCommand):
 
         db = sqlite_utils.Database(sqlite3.connect(agencies_meta_db))
 
+        # agency_id => {status: n_documents, ...}
+        agency_status_counts = {}
+        for rollup in AgencyStatusRollup.objects.all():
+            counts = agency_status_counts.setdefault(rollup.agency_id, {})
+            counts[rollup.status] = rollup.documents
+
         for agency in Agency.objects.order_by("name"):
             url = self.db_url_from_agency(agency)
+            status_counts = agency_status_counts.get(agency.id, {})
             db["agencies"].insert({
                 "agency": f'<a href="{url}">{agency.name}</a>',
                 "request_complete": agency.request_done,
@@ -74,7 +83,10 @@ class Command(BaseCommand):
                 "have_incident_summaries": agency.have_incident_summaries,
                 "have_full_incident_documents": agency.have_full_incident_documents,
                 "notes": agency.notes_html,
-            }, pk="db")
+                "total_documents": sum(status_counts.values()),
+                "complete_documents": status_counts.get("complete", 0),
+                "unchecked_documents": status_counts.get("unchecked", 0),
+            }, pk="db", alter=True)
             db_name = f"{url[1:]}"
 
             def yn(value):
@@ -1,26 +1,56 @@
 #!/usr/bin/env python
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import csv
-import codecs
-import itertools
+from functools import lru_cache
 import json
 import os
 import re
 import shutil
 import sys
+import time
 
 from django.core.management.base import BaseCommand
+from django.db import connections
 import ftfy
 import numpy as np
 import sqlite3
 import sqlite_utils
 import tablib
 
+from documents.headers import clean_headers, unify_headers
 from documents.models import Agency, Document, ProcessedDocument
+from documents.util import file_sha256
 
 
 csv.field_size_limit(sys.maxsize)
 
 
+# rows per INSERT statement when loading the agency DBs
+INSERT_BATCH_SIZE = 1000
+# the agency DBs get rebuilt from scratch if anything goes wrong, so trade
+# durability for speed while loading them
+LOADER_PRAGMAS = (
+    "PRAGMA journal_mode=MEMORY",
+    "PRAGMA synchronous=OFF",
+    # negative means KiB, so ~200MB
+    "PRAGMA cache_size=-200000",
+)
+
+# bump this when the export changes in a way that needs every agency DB
+# rebuilt, old manifests get ignored
+# 2: near-duplicate CSV headers get unified (see documents/headers.py)
+EXPORT_MANIFEST_VERSION = 2
+# kept in the output directory, next to the agency DBs
+EXPORT_MANIFEST_FILENAME = ".export-manifest.json"
+
+# a CSV to export, the rows get streamed from path when writing the DB
+CSVFile = namedtuple("CSVFile", ("path", "headers"))
+
+# a sequence we'll use to join and split headers pre/post cleaning
+# it should be something that won't naturally be found in headers
+JOIN_SEQ = "-~=~-"
+
 DOCUMENT_TYPES = [
     "collisions",
     "complaints",
@@ -32,33 +62,58 @@ DOCUMENT_TYPES = [
 
 
 def matrix(a, b, match_score=3, gap_cost=2):
+    """
+    Smith-Waterman scoring matrix, filled a row at a time with numpy.
+    The match/mismatch and delete terms of a row only depend on the row
+    above, so they're computed for the whole row at once. The insert term
+    chains along the row, H[i, j] = max(t[j], H[i, j - 1] - gap), which
+    unrolls to max over k <= j of (t[k] - gap * (j - k)), a running max.
+    """
     H = np.zeros((len(a) + 1, len(b) + 1))
-    i_range = range(1, H.shape[0])
-    j_range = range(1, H.shape[1])
-    for i, j in itertools.product(i_range, j_range):
-        score = match_score if a[i - 1] == b[j - 1] else -match_score
-        match = H[i - 1, j - 1] + score
-        delete = H[i - 1, j] - gap_cost
-        insert = H[i, j - 1] - gap_cost
-        H[i, j] = max(match, delete, insert, 0)
+    if not len(a) or not len(b):
+        return H
+    b_chars = np.array([ord(c) for c in b])
+    gaps = gap_cost * np.arange(len(b) + 1)
+    t = np.zeros(len(b) + 1)
+    for i in range(1, H.shape[0]):
+        scores = np.where(b_chars == ord(a[i - 1]), match_score, -match_score)
+        t[1:] = np.maximum.reduce([
+            H[i - 1, :-1] + scores,
+            H[i - 1, 1:] - gap_cost,
+            np.zeros(len(b)),
+        ])
+        H[i] = np.maximum.accumulate(t + gaps) - gaps
     return H
 
 
-def traceback(H, b, b_='', old_i=0):
-    # flip H to get index of **last** occurrence of H.max() with np.argmax()
-    H_flip = np.flip(np.flip(H, 0), 1)
-    i_, j_ = np.unravel_index(H_flip.argmax(), H_flip.shape)
-    # (i, j) are **last** indexes of H.max()
-    i, j = np.subtract(H.shape, (i_ + 1, j_ + 1)) 
-    if H[i, j] == 0:
-        return b_, j
-    b_ = b[j - 1] + '-' + b_ if old_i - i > 1 else b[j - 1] + b_
-    return traceback(H[0:i, 0:j], b, b_, i)
-
-
+def traceback(H, b):
+    """
+    Walk back from the (last) highest scoring cell to build the aligned
+    part of b. Returns (aligned b, position in b).
+    """
+    b_ = ""
+    old_i = 0
+    n_rows, n_cols = H.shape
+    while True:
+        sub = H[:n_rows, :n_cols]
+        best = sub.max()
+        if best == 0:
+            # every cell is zero, so the last cell is the last max
+            return b_, n_cols - 1
+        # np.nonzero is row-major, so the last hit is the last occurrence
+        rows, cols = np.nonzero(sub == best)
+        i, j = rows[-1], cols[-1]
+        b_ = b[j - 1] + '-' + b_ if old_i - i > 1 else b[j - 1] + b_
+        old_i = i
+        n_rows, n_cols = i, j
+
+
+@lru_cache(maxsize=4096)
 def smith_waterman(a, b, match_score=3, gap_cost=2):
     """
     Find the longest common substring between two strings, a and b.
+    Table naming folds this over every file in a group, so the same
+    pairs come up over and over and get cached.
     """
     a, b = a.lower(), b.lower()
     H = matrix(a, b, match_score, gap_cost)
@@ -66,66 +121,19 @@ def smith_waterman(a, b, match_score=3, gap_cost=2):
     return a[pos: pos + len(b_)]
 
 
-def damerau_levenshtein_similarity(a, b):
-    # "Infinity" -- greater than maximum possible edit distance
-    # Used to prevent transpositions for first characters
-    INF = len(a) + len(b)
-
-    # Matrix: (M + 2) x (N + 2)
-    matrix  = [[INF] * (len(b) + 2)]
-    matrix += [[INF] + list(range(len(b) + 1))]
-    matrix += [[INF, m] + [0] * len(b) for m in range(1, len(a) + 1)]
-
-    # Holds last row each element was encountered: DA in the Wikipedia pseudocode
-    last_row = {}
-
-    # Fill in costs
-    for row in range(1, len(a) + 1):
-        # Current character in a
-        ch_a = a[row-1]
-
-        # Column of last match on this row: DB in pseudocode
-        last_match_col = 0
-
-        for col in range(1, len(b) + 1):
-            # Current character in b
-            ch_b = b[col-1]
-
-            # Last row with matching character
-            last_matching_row = last_row.get(ch_b, 0)
-
-            # Cost of substitution
-            cost = 0 if ch_a == ch_b else 1
-
-            # Compute substring distance
-            matrix[row+1][col+1] = min(
-                matrix[row][col] + cost, # Substitution
-                matrix[row+1][col] + 1,  # Addition
-                matrix[row][col+1] + 1,  # Deletion
-
-                # Transposition
-                # Start by reverting to cost before transposition
-                matrix[last_matching_row][last_match_col]
-                    # Cost of letters between transposed letters
-                    # 1 addition + 1 deletion = 1 substitution
-                    + max((row - last_matching_row - 1),
-                          (col - last_match_col - 1))
-                    # Cost of the transposition itself
-                    + 1)
-
-            # If there was a match, update last_match_col
-            if cost == 0:
-                last_match_col = col
-
-        # Update last row for current character
-        last_row[ch_a] = row
-
-    # last element is the difference
-    dl_diff = matrix[-1][-1]
-
-    # this gives us a 1-0 scale of similarity where 1 is exactly
-    # equal and 0 is totally different
-    return 1 - (dl_diff / max(len(a), len(b)))
+def common_filename(filenames, align=smith_waterman):
+    """
+    Fold an alignment over a group of filenames to find the part of their
+    names they share.
+    """
+    common_name = filenames[0]
+    if len(filenames) >= 2:
+        a = filenames[0]
+        b = align(a, filenames[1])
+        for a in filenames[2:]:
+            b = align(a, b)
+        common_name = b
+    return common_name
 
 
 # https://stackoverflow.com/a/18048211
@@ -143,17 +151,155 @@ def print_table(seq, columns=3):
     print(table.strip('\n'))
 
 
-def clean_headers(headers):
-    if isinstance(headers, str):
-        headers = [headers]
-    cleaned_headers = []
-    for raw_h in headers:
-        cleaned_headers.append(re.sub(
-            f"\s+", " ", raw_h.lower().replace(
-                "recevied", "received"
-            )
-        ).strip())
-    return cleaned_headers
+def table_headers(headers):
+    """
+    The column names a CSV's rows get written to the DB with.
+    """
+    table_headers = clean_headers(headers)
+    # a fix for the first column with a blank name, which was caused
+    # by the XLS to CSV exporter leaving the row number in the CSV but
+    # not giving it a header for some reason
+    if table_headers and not table_headers[0] \
+            and "file_row" not in table_headers:
+        table_headers[0] = "file_row"
+    return table_headers
+
+
+def read_csv_headers(path):
+    """
+    Read a CSV's header row and check it has any data rows, without
+    reading the rest of it. Returns (headers, has_rows).
+    """
+    # utf-8-sig strips the BOM Excel starts its CSVs with
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        headers = next(reader, [])
+        for row in reader:
+            if row:
+                return headers, True
+    return headers, False
+
+
+def iter_csv_rows(path, headers):
+    """
+    Stream a CSV's data rows as dicts keyed by headers (in place of the
+    CSV's own header row). Like tablib, blank lines are skipped and short
+    rows get padded. Cells past the last header get dropped.
+    """
+    width = len(headers)
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for line_no, row in enumerate(reader, start=2):
+            if not row:
+                continue
+            if len(row) < width:
+                row += [""] * (width - len(row))
+            elif len(row) > width:
+                if any(cell.strip() for cell in row[width:]):
+                    print("!", "WARNING: dropping cells past the last header",
+                          f"on row {line_no} of", path)
+                row = row[:width]
+            yield dict(zip(headers, row))
+
+
+def open_database(db_filepath):
+    """
+    Open an agency DB, once, set up for bulk loading.
+    """
+    db = sqlite_utils.Database(sqlite3.connect(db_filepath))
+    for pragma in LOADER_PRAGMAS:
+        db.execute(pragma)
+    return db
+
+
+def ensure_table(table, columns):
+    """
+    Create a table with every column its CSVs will need up front, or add
+    the ones an existing table is missing, so the inserts never have to
+    check and alter the schema.
+    """
+    if not table.exists():
+        table.create({column: str for column in columns})
+        return
+    existing = set(table.columns_dict.keys())
+    for column in columns:
+        if column not in existing:
+            table.add_column(column, str)
+
+
+def file_fingerprint(path, previous=None):
+    """
+    Size, mtime and content hash of a file. If the previous fingerprint
+    has the same size and mtime, its hash gets reused instead of reading
+    the whole file again.
+    """
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if previous and previous.get("sha256") and all(
+        previous.get(key) == value for key, value in fingerprint.items()
+    ):
+        fingerprint["sha256"] = previous["sha256"]
+    else:
+        fingerprint["sha256"] = file_sha256(path)
+    return fingerprint
+
+
+def load_export_manifest(output_dir):
+    """
+    The manifest entries, {agency ID: entry}, from the last export into
+    output_dir. Missing, unreadable or out of date manifests just mean
+    every agency gets rebuilt.
+    """
+    path = os.path.join(output_dir, EXPORT_MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable export manifest {path}: {e}")
+        return {}
+    if data.get("version") != EXPORT_MANIFEST_VERSION:
+        return {}
+    return data.get("agencies", {})
+
+
+def save_export_manifest(output_dir, agencies):
+    """
+    Write the export manifest atomically, so an interrupted run never
+    leaves a truncated one behind.
+    """
+    path = os.path.join(output_dir, EXPORT_MANIFEST_FILENAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({
+            "version": EXPORT_MANIFEST_VERSION,
+            "agencies": agencies,
+        }, f)
+    os.replace(tmp_path, path)
+
+
+def export_agency(agency_id, output_dir, previous=None, force=False):
+    """
+    Export a single agency's DB, if it changed. This runs inside the worker
+    processes, each of which opens its own DB connection. Returns the
+    agency's rows, headers, timing and manifest entry for the parent to
+    add up and record.
+    """
+    exporter = Command()
+    exporter.setup_export(output_dir, interactive=False, force=force)
+    agency = Agency.objects.get(pk=agency_id)
+    start = time.time()
+    n_rows, entry = exporter.export_if_changed(agency, previous)
+    return {
+        "agency": agency.name,
+        "rows": n_rows,
+        "total_rows": exporter.total_rows,
+        "filename_headers": [tuple(r) for r in exporter.filename_headers],
+        "elapsed": time.time() - start,
+        "manifest_entry": entry,
+    }
 
 
 class Command(BaseCommand):
@@ -171,6 +317,8 @@ class Command(BaseCommand):
         # 'case-doc',
     ]
     WIPE = False
+    # ask what to do about header mismatches
+    interactive = True
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -183,56 +331,57 @@ class Command(BaseCommand):
             action='store_true',
             help='Wipe entire output directory before running'
         )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help=(
+                'Rebuild every agency DB, even the ones whose inputs '
+                "haven't changed since the last export"
+            )
+        )
         parser.add_argument(
             '--ignore', type=str,
             help='Ignore these agencies (comma separated)'
         )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help=(
+                'Number of agencies to export at once. Anything over 1 '
+                'skips the interactive header mismatch check'
+            )
+        )
 
     def convert_processed_doc(self, pdoc):
         """
-        Open a CSV file attached to a ProcessedDoc, add the headers found to it
-        to the global filename_headers and all_rows data and return the CSV
-        records in tablib Dataset format.
+        Read the headers of a CSV file attached to a ProcessedDoc, add them
+        to the global filename_headers and return a CSVFile. The rows only
+        get read when they're written to the DB (see write_database), so
+        we never hold a whole CSV in memory.
         """
-        with codecs.open(pdoc.file.path, encoding='utf-8-sig') as f:
-            # If file starts with (UTF-8 BOM): 0xEFBBBF4F
-            # >>> with codecs.open('excel_output.csv', encoding='utf-8-sig') as f:
-            # ...     reader = csv.reader(f)
-            # ...     rows = [row for row in reader]
-            try:
-                csv = tablib.Dataset().load(f, format="csv")
-            # except UnicodeDecodeError as e:
-            #     ftfy.fix_encoding()
-            except Exception as e:
-                print("ERROR While reading file:", pdoc.file.name)
-                print("ProcessedDocument:", pdoc)
-                raise e
-
-            if not len(csv):
-                print("No rows in CSV, returning without processing.")
-                return
-
-            self.total_rows += len(csv)
-            for h in csv.headers:
-                self.filename_headers.append([pdoc.file.name, h])
-
-            print("Processed Document:", pdoc)
-            print("Rows:", len(csv))
-            print("Headers:", csv.headers)
-            print_table(csv.headers)
-
-            for row in csv.dict:
-                self.all_rows.append(row)
-            return csv
+        try:
+            headers, has_rows = read_csv_headers(pdoc.file.path)
+        # except UnicodeDecodeError as e:
+        #     ftfy.fix_encoding()
+        except Exception as e:
+            print("ERROR While reading file:", pdoc.file.name)
+            print("ProcessedDocument:", pdoc)
+            raise e
+
+        if not has_rows:
+            print("No rows in CSV, returning without processing.")
+            return
+
+        for h in headers:
+            self.filename_headers.append([pdoc.file.name, h])
+
+        print("Processed Document:", pdoc)
+        print("Headers:", headers)
+        print_table(headers)
+
+        return CSVFile(pdoc.file.path, headers)
 
     def table_name_from_filenames(self, filenames):
-        common_name = filenames[0]
-        if len(filenames) >= 2:
-            a = filenames[0]
-            b = smith_waterman(a, filenames[1])
-            for a in filenames[2:]:
-                b = smith_waterman(a, b)
-            common_name = b
+        common_name = common_filename(filenames)
         table_name = re.sub(
             r"^[\s\-_]+|[\s\-_]+$", "", common_name.rsplit(
                 ".", 2
@@ -243,37 +392,49 @@ class Command(BaseCommand):
         return table_name
 
     def write_database(self, agency, table, csv, unified_headers,
-                       filename=None):
+                       filename=None, header_mapping=None):
+        """
+        Stream a CSV's rows into its table, with its columns renamed by
+        header_mapping (see unify_headers). Returns the number of rows.
+        """
         print("=" * 10)
         print("Table:", table)
         print("Filename:", filename)
         print("Unified Headers:", len(unified_headers), unified_headers)
         print("CSV Headers:", len(csv.headers), csv.headers)
-        std_unified_headers = clean_headers(unified_headers)
-        std_file_headers = clean_headers(csv.headers)
-
-        # get the overall headers not in our file headers
-        diffs = set(std_unified_headers).difference(set(std_file_headers))
-        # do a check to make sure we don't have any weird misalignments
-        if len(diffs):
-            for i, std_file_h in enumerate(std_file_headers):
-                file_h = csv.headers[i]
-                std_uni_h = unified_headers[i]
-                print(i, "std file:", std_file_h, "std_uni:", std_uni_h, "file h:", file_h)
-                if std_file_h != std_uni_h:
-                    if input("Header mismatch. Enter debugger? y/n ") == "y":
-                        import pdb
-                        pdb.set_trace()
-
-        # a fix for the first column with a blank name, which was caused
-        # by the XLS to CSV exporter leaving the row number in the CSV but
-        # not giving it a header for some reason
-        csv.headers = std_file_headers
-        if not csv.headers[0] and "file_row" not in csv.headers:
-            csv.headers[0] = "file_row"
-
-        for row in csv.dict:
-            table.insert(row, alter=True)
+        if header_mapping is None:
+            header_mapping = {}
+        file_headers = [
+            header_mapping.get(h, h) for h in table_headers(csv.headers)
+        ]
+
+        # rows get loaded by column name, so the order doesn't matter, but
+        # every column should be one of the group's unified headers
+        diffs = set(file_headers).difference(unified_headers)
+        for i, file_h in enumerate(file_headers):
+            if file_h not in diffs:
+                continue
+            print(i, "file:", file_h, "file h:", csv.headers[i])
+            if not self.interactive:
+                print("Header mismatch!")
+                continue
+            if input("Header mismatch. Enter debugger? y/n ") == "y":
+                import pdb
+                pdb.set_trace()
+
+        n_rows = 0
+
+        def rows():
+            nonlocal n_rows
+            for row in iter_csv_rows(csv.path, file_headers):
+                n_rows += 1
+                yield row
+
+        # the table already has all our columns, see ensure_table. this
+        # only holds one batch of rows in memory at a time
+        table.insert_all(rows(), batch_size=INSERT_BATCH_SIZE)
+        print("Rows:", n_rows)
+        return n_rows
 
     def db_filepath_from_agency(self, agency):
         # NOTE: if this changes, change export_metadata_yml
@@ -282,22 +443,108 @@ class Command(BaseCommand):
         db_filepath = os.path.join(self.OUTPUT_DIRECTORY, f"{agency_dbname}.db")
         return db_filepath
 
+    def agency_complete_docs(self, agency):
+        return Document.objects.filter(
+            status__in=self.EXPORT_STATUSES,
+            # skip these, they don't have data, even if marked complete
+            no_new_records=False,
+            agency=agency,
+        )
+
+    def agency_pdocs(self, agency_complete_docs):
+        """
+        The deduped processed docs holding the CSVs that get exported from
+        an agency's complete documents.
+        """
+        pdocs = []
+        # store IDs for deduplication
+        pdocs_ids_seen = set()
+        for doc in agency_complete_docs:
+            # process PDF/Excel that got converted to CSV via processed doc
+            if doc.file.name.endswith(".csv"):
+                continue
+            # we can have multiple completed processed docs per Document (Elma PD)
+            for pdoc in doc.processeddocument_set.filter(status__in=self.EXPORT_STATUSES):
+                if not pdoc.file:
+                    print("!", "ERROR: skipping blank Processed Doc",
+                          pdoc, "Skipping.")
+                    continue
+
+                if pdoc.id in pdocs_ids_seen:
+                    continue
+
+                pdocs_ids_seen.add(pdoc.id)
+                pdocs.append(pdoc)
+        return pdocs
+
+    def export_if_changed(self, agency, previous=None):
+        """
+        Rebuild an agency's DB, unless the processed docs it's built from
+        and the DB itself are the same as when its previous manifest entry
+        was recorded. Returns (rows, manifest entry), the entry is None if
+        the agency had nothing to export.
+        """
+        previous = previous or {}
+        previous_inputs = previous.get("inputs") or {}
+        db_filepath = self.db_filepath_from_agency(agency)
+
+        inputs = {}
+        for pdoc in self.agency_pdocs(self.agency_complete_docs(agency)):
+            pdoc_id = str(pdoc.pk)
+            inputs[pdoc_id] = {
+                "file": pdoc.file.name,
+                **file_fingerprint(
+                    pdoc.file.path, previous_inputs.get(pdoc_id)
+                ),
+            }
+
+        previous_db = previous.get("db")
+        if not self.force and previous_db and inputs == previous_inputs \
+                and os.path.exists(db_filepath):
+            db_stat = os.stat(db_filepath)
+            if db_stat.st_size == previous_db["size"] \
+                    and db_stat.st_mtime_ns == previous_db["mtime"]:
+                print("Unchanged, skipping:", agency.name)
+                self.total_rows += previous["total_rows"]
+                return previous["rows"], previous
+
+        old_db = None
+        if os.path.exists(db_filepath):
+            old_db = os.stat(db_filepath)
+        total_rows_before = self.total_rows
+        n_rows = self.process_agency(agency)
+        if not os.path.exists(db_filepath):
+            return n_rows, None
+        new_db = os.stat(db_filepath)
+        if old_db and (new_db.st_ino, new_db.st_mtime_ns) \
+                == (old_db.st_ino, old_db.st_mtime_ns):
+            # nothing got written, this is left over from when the agency
+            # had something to export
+            print("Removing stale DB:", db_filepath)
+            os.remove(db_filepath)
+            return n_rows, None
+
+        return n_rows, {
+            "agency": agency.name,
+            "inputs": inputs,
+            "rows": n_rows,
+            "total_rows": self.total_rows - total_rows_before,
+            "db": {
+                "file": os.path.basename(db_filepath),
+                **file_fingerprint(db_filepath),
+            },
+        }
+
     def process_agency(self, agency):
         """
         Process agency. This does the following:
             - finds the responsive Documents that are eligible for export
             - dedupes them
+            - rebuilds the agency DB from scratch in a temp file and swaps
+              it into place
+        Returns the number of rows exported for the agency.
         """
-        # a sequence we'll use to join and split headers pre/post cleaning
-        # it should be something that won't naturally be found in headers
-        JOIN_SEQ = "-~=~-"
-
-        agency_complete_docs = Document.objects.filter(
-            status__in=self.EXPORT_STATUSES,
-            # skip these, they don't have data, even if marked complete
-            no_new_records=False,
-            agency=agency,
-        )
+        agency_complete_docs = self.agency_complete_docs(agency)
 
         if not agency_complete_docs.count():
             print("No complete documents for", agency.name)
@@ -312,39 +559,34 @@ class Command(BaseCommand):
         agency_filenames = []
         agency_csvs = []
 
-        # store IDs for deduplication
-        pdocs_ids_seen = set()
-        for doc in agency_complete_docs:
-            # process PDF/Excel that got converted to CSV via processed doc
-            if not doc.file.name.endswith(".csv"):
-                # we can have multiple completed processed docs per Document (Elma PD)
-                for pdoc in doc.processeddocument_set.filter(status__in=self.EXPORT_STATUSES):
-                    if not pdoc.file:
-                        print("!", "ERROR: skipping blank Processed Doc",
-                              pdoc, "Skipping.")
-                        continue
-
-                    print("Adding pdoc:", pdoc)
-
-                    if pdoc.id in pdocs_ids_seen:
-                        continue
-
-                    pdocs_ids_seen.add(pdoc.id)
-
-                    csv = self.convert_processed_doc(pdoc)
-                    if csv and (pdoc.file.name not in agency_filenames):
-                        self.total_rows += len(csv)
-                        agency_filenames.append(pdoc.file.name)
-                        agency_csvs.append(csv)
-                        filename_csv_lookup[pdoc.file.name] = csv
+        for pdoc in self.agency_pdocs(agency_complete_docs):
+            print("Adding pdoc:", pdoc)
+            csv = self.convert_processed_doc(pdoc)
+            if csv and (pdoc.file.name not in agency_filenames):
+                agency_filenames.append(pdoc.file.name)
+                agency_csvs.append(csv)
+                filename_csv_lookup[pdoc.file.name] = csv
+
+        # work out which columns are the same across CSVs, except for
+        # punctuation or a typo, and the one name they'll all get
+        file_headers = [table_headers(csv.headers) for csv in agency_csvs]
+        header_mapping = unify_headers(file_headers)
+        renamed = sorted(
+            (h, unified) for h, unified in header_mapping.items()
+            if h != unified
+        )
+        if renamed:
+            print("Unified headers:")
+            for h, unified in renamed:
+                print(f"    {h} => {unified}")
 
         # now we have a list of CSVs, let's try and find ones with
         # duplicate headers and join them together
         # header_row => [csv_filename1, ..., csv_filenameN]
         headers_seen = {}
-        for ix, csv in enumerate(agency_csvs):
-            cleaned_headers = clean_headers(csv.headers)
-            header_text = JOIN_SEQ.join(cleaned_headers)
+        for ix, headers in enumerate(file_headers):
+            unified_headers = [header_mapping[h] for h in headers]
+            header_text = JOIN_SEQ.join(unified_headers)
             if header_text not in headers_seen:
                 headers_seen[header_text] = []
             headers_seen[header_text].append(agency_filenames[ix])
@@ -360,44 +602,44 @@ class Command(BaseCommand):
             if header_text not in headers_seen:
                 continue
             header_prev = header_keys[ix-1]
-            if header_text.startswith(header_prev):
+            # whole headers only, "name" doesn't start "names-~=~-..."
+            if header_text.startswith(f"{header_prev}{JOIN_SEQ}"):
                 # add the previous, shorter header, to this new longer,
                 # but otherwise the same one
                 headers_seen[header_text] += headers_seen.pop(header_prev)
 
-        # TODO: similar to the below, where we add new columns, if most
-        # of the columns are matching, here we want to check for columns
-        # that are the same except for a typo/etc
-        # NOTE: if we do this then we have to keep track of the
-        # original headers that map to a single header
-        # TODO: handle small typos/etc as long we we have
-        # the same number of columns
-
-        # merge headers that only have one or maybe two completely
-        # different columns?
-        header_keys = sorted(headers_seen.keys())
-        for ix1, header_text1 in enumerate(header_keys):
+        # merge headers into ones that have all the same columns plus one
+        # or maybe two others. rows get loaded by column name, so the
+        # order of the columns doesn't matter. smallest first, so chains
+        # of these end up in the largest
+        header_keys = sorted(
+            headers_seen.keys(),
+            key=lambda h: (len(set(h.split(JOIN_SEQ))), h)
+        )
+        for header_text1 in header_keys:
             headers_set1 = set(header_text1.split(JOIN_SEQ))
             best_match = None
-            for ix2, header_text2 in enumerate(header_keys):
-                if ix1 == ix2 or header_text1 == header_text1:
+            best_diff = None
+            for header_text2 in header_keys:
+                if header_text1 == header_text2:
                     continue
                 # skip headers we've already joined
-                if header_text1 not in headers_seen:
-                    continue
                 if header_text2 not in headers_seen:
                     continue
 
                 headers_set2 = set(header_text2.split(JOIN_SEQ))
-                # only move forward if we have a header1 that
-                # is smaller than 2, since header1 gets rolled into
-                # header2 which needs to be larger
-                if len(headers_set1) > len(headers_set2):
+                # header1 gets rolled into header2, which needs to have
+                # every one of its columns
+                if not headers_set1 <= headers_set2:
                     continue
 
-                diff = headers_set2.difference(headers_set1)
-                if len(diff) <= 2:
-                    headers_seen[header_text2] += headers_seen.pop(header_text1)
+                diff = len(headers_set2.difference(headers_set1))
+                if diff <= 2 and (best_diff is None or diff < best_diff):
+                    best_match = header_text2
+                    best_diff = diff
+
+            if best_match:
+                headers_seen[best_match] += headers_seen.pop(header_text1)
 
         # Actually merge the datasets based on the above check scenarios
         n_original = len(agency_csvs)
@@ -421,6 +663,39 @@ class Command(BaseCommand):
                 print("Headers:")
                 print_table(header_array)
 
+        if not headers_seen:
+            return 0
+
+        # build the whole agency DB over one connection, in a temp file next
+        # to the old one, then swap it into place. this isn't one
+        # transaction (insert_all commits batch by batch), the swap is what
+        # keeps readers from seeing it half written and keeps re-runs from
+        # appending to the old tables
+        db_filepath = self.db_filepath_from_agency(agency)
+        tmp_filepath = f"{db_filepath}.tmp"
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        db = open_database(tmp_filepath)
+        try:
+            with db.conn:
+                agency_rows = self.write_tables(
+                    agency, db, headers_seen, filename_csv_lookup,
+                    header_mapping
+                )
+        finally:
+            db.conn.close()
+        os.replace(tmp_filepath, db_filepath)
+
+        self.total_rows += agency_rows
+        return agency_rows
+
+    def write_tables(self, agency, db, headers_seen, filename_csv_lookup,
+                     header_mapping):
+        """
+        Write each group of CSVs to its own table. Returns the number of
+        rows written.
+        """
+        agency_rows = 0
         # keep track of tables that have been created for each filename group.
         # if a second filename group tries to create a table that's already been
         # used by another filename group, we need to add a unique suffix
@@ -444,21 +719,30 @@ class Command(BaseCommand):
 
             used_table_names.add(table_name)
 
-            db_filepath = self.db_filepath_from_agency(agency)
-            db = sqlite_utils.Database(sqlite3.connect(db_filepath))
             table = db[table_name]
+            columns = []
+            for filename in filenames:
+                columns += [
+                    header_mapping[h]
+                    for h in table_headers(filename_csv_lookup[filename].headers)
+                ]
+            ensure_table(table, list(dict.fromkeys(columns)))
             for filename in filenames:
                 csv = filename_csv_lookup[filename]
-                self.write_database(
+                agency_rows += self.write_database(
                     agency, table, csv, unified_headers,
-                    filename=filename or "incidents"
+                    filename=filename or "incidents",
+                    header_mapping=header_mapping
                 )
+        return agency_rows
 
-        return self.total_rows
-
-    def handle(self, *args, **options):
-        self.OUTPUT_DIRECTORY = options["output_data_dir"]
-        self.WIPE = options.get("wipe", self.WIPE)
+    def setup_export(self, output_dir, interactive=True, force=False):
+        self.OUTPUT_DIRECTORY = output_dir
+        self.interactive = interactive
+        # rebuild agencies even if their inputs haven't changed
+        self.force = force
+        # {agency ID: manifest entry}, see export_if_changed
+        self.manifest = {}
 
         # keep track of all headers seen in every file
         self.filename_headers = tablib.Dataset(headers=[
@@ -466,10 +750,85 @@ class Command(BaseCommand):
         ])
         # total number of agencies with completed files
         self.total_agencies = 0
-        # total CSV rows seen
+        # total CSV rows exported
         self.total_rows = 0
-        # every CSV row goes into here (as dicts)
-        self.all_rows = []
+        # (agency name, rows, seconds)
+        self.agency_timings = []
+
+    def add_agency_result(self, result):
+        """
+        Add up the results of exporting an agency (see export_agency).
+        """
+        if result["rows"]:
+            self.total_agencies += 1
+        for row in result["filename_headers"]:
+            self.filename_headers.append(row)
+        self.agency_timings.append(
+            (result["agency"], result["rows"], result["elapsed"])
+        )
+
+    def record_manifest_entry(self, agency_id, entry):
+        """
+        Record an agency's manifest entry and save the manifest, so an
+        interrupted export picks up from the last agency it finished.
+        """
+        if entry:
+            self.manifest[str(agency_id)] = entry
+        else:
+            self.manifest.pop(str(agency_id), None)
+        save_export_manifest(self.OUTPUT_DIRECTORY, self.manifest)
+
+    def export_serial(self, agencies):
+        for agency in agencies:
+            # export_if_changed adds to our totals itself
+            start = time.time()
+            n_rows_processed, entry = self.export_if_changed(
+                agency, self.manifest.get(str(agency.pk))
+            )
+            self.record_manifest_entry(agency.pk, entry)
+            if n_rows_processed:
+                self.total_agencies += 1
+            self.agency_timings.append(
+                (agency.name, n_rows_processed, time.time() - start)
+            )
+
+    def export_parallel(self, agencies, workers):
+        agency_ids = [agency.pk for agency in agencies]
+        print(f"Exporting {len(agency_ids)} agencies with {workers} workers")
+        # don't hand our DB connection down to the forked workers
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    export_agency, agency_id, self.OUTPUT_DIRECTORY,
+                    self.manifest.get(str(agency_id)), self.force
+                ): agency_id
+                for agency_id in agency_ids
+            }
+            for n_done, future in enumerate(as_completed(futures), start=1):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    agency = Agency.objects.get(pk=futures[future])
+                    print(f"[{n_done}/{len(agency_ids)}] FAILED {agency}: {e}")
+                    # make sure it gets rebuilt next time
+                    self.record_manifest_entry(futures[future], None)
+                    continue
+                self.record_manifest_entry(
+                    futures[future], result["manifest_entry"]
+                )
+                self.total_rows += result["total_rows"]
+                self.add_agency_result(result)
+                print(f"[{n_done}/{len(agency_ids)}] {result['agency']}: "
+                      f"{result['rows']} rows in {result['elapsed']:.1f}s")
+
+    def handle(self, *args, **options):
+        self.WIPE = options.get("wipe", self.WIPE)
+        workers = max(1, options.get("workers") or 1)
+        self.setup_export(
+            options["output_data_dir"], interactive=(workers == 1),
+            force=options.get("force", False)
+        )
 
         if self.WIPE and os.path.exists(self.OUTPUT_DIRECTORY):
             print(f"About to delete directory: {self.OUTPUT_DIRECTORY}")
@@ -480,6 +839,9 @@ class Command(BaseCommand):
         if not os.path.exists(self.OUTPUT_DIRECTORY):
             os.makedirs(self.OUTPUT_DIRECTORY)
 
+        self.manifest = load_export_manifest(self.OUTPUT_DIRECTORY)
+        print(f"{len(self.manifest)} agencies in the export manifest")
+
         complete_docs = Document.objects.filter(
             status__in=self.EXPORT_STATUSES
         )
@@ -487,12 +849,17 @@ class Command(BaseCommand):
         print(f"{n_complete_docs} CSVs built from responsive documents")
 
         agencies = Agency.objects.all()
-        for agency in agencies:
-            n_rows_processed = self.process_agency(
-                agency,
-            )
-            if n_rows_processed:
-                self.total_agencies += 1
+        if workers > 1:
+            self.export_parallel(agencies, workers)
+        else:
+            self.export_serial(agencies)
+
+        # forget agencies that don't exist anymore
+        agency_ids = {str(agency.pk) for agency in agencies}
+        for agency_id in list(self.manifest):
+            if agency_id not in agency_ids:
+                self.manifest.pop(agency_id)
+        save_export_manifest(self.OUTPUT_DIRECTORY, self.manifest)
 
         # with open("filename_headers.csv", "w") as f:
         #     f.write(self.filename_headers.csv)
@@ -523,6 +890,11 @@ class Command(BaseCommand):
         # with open(f"all_records.csv", "w") as f:
         #     f.write(data.csv)
 
+        print("Slowest agencies:")
+        timings = sorted(self.agency_timings, key=lambda t: t[2], reverse=True)
+        for agency_name, n_rows, elapsed in timings[:10]:
+            print(f"    {agency_name}: {n_rows} rows in {elapsed:.1f}s")
+
         print(f"{self.total_agencies} agencies with completed records")
         print(f"{self.total_rows} total IA records processed")
 
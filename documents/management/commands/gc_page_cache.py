@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+import os
+
+from django.core.management.base import BaseCommand
+
+from documents.models import ProcessedDocument
+from documents.pages import (
+    PAGE_CACHE_MAX_BYTES, evict_page_images, remove_page_images,
+    remove_stale_tmp_files, stored_page_hashes
+)
+from documents.util import file_sha256
+
+
+class Command(BaseCommand):
+    help = """
+    Garbage collect the rendered page image store. This removes temp files
+    from interrupted renders and evicts least recently used pages until the
+    store is under its size cap. With --orphans, it also removes the images
+    of PDFs that no processed document points at anymore.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-gb', type=float,
+            help=(
+                'Evict down to this size, in GB. Defaults to the '
+                'PAGE_CACHE_MAX_BYTES setting'
+            )
+        )
+        parser.add_argument(
+            '--orphans', action='store_true',
+            help=(
+                'Remove images for PDFs no longer attached to a processed '
+                'document (this hashes every PDF, so it can be slow)'
+            )
+        )
+
+    def live_hashes(self):
+        hashes = set()
+        pdocs = ProcessedDocument.objects.filter(file__endswith=".pdf")
+        for pdoc in pdocs:
+            if not pdoc.file or not os.path.exists(pdoc.file.path):
+                continue
+            hashes.add(file_sha256(pdoc.file.path))
+        return hashes
+
+    def handle(self, *args, **options):
+        max_bytes = PAGE_CACHE_MAX_BYTES
+        if options.get('max_gb') is not None:
+            max_bytes = int(options['max_gb'] * 1024 * 1024 * 1024)
+
+        n_tmp = remove_stale_tmp_files()
+        print(f"Removed {n_tmp} stale temp files")
+
+        if options.get('orphans'):
+            live = self.live_hashes()
+            n_files = 0
+            n_bytes = 0
+            for file_hash in stored_page_hashes():
+                if file_hash in live:
+                    continue
+                removed, removed_bytes = remove_page_images(file_hash)
+                n_files += removed
+                n_bytes += removed_bytes
+            print(f"Removed {n_files} orphaned page images "
+                  f"({n_bytes / 1024 / 1024:.1f} MB)")
+
+        n_files, n_bytes = evict_page_images(max_bytes=max_bytes)
+        print(f"Evicted {n_files} least recently used page images "
+              f"({n_bytes / 1024 / 1024:.1f} MB)")
+        print("Done")
@@ -1,20 +1,22 @@
 #!/usr/bin/env python
 import os
 import re
-from glob import glob
 import sys
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.db.models import Q
 import tablib
 
+from documents.import_rules import (
+    DOCUMENT_TYPE, PROCESSED_TYPE, load_review_queue, load_rules,
+    resolve_files, write_review_queue
+)
 from documents.models import Agency, Document, ProcessedDocument
-from documents.util import document_file_path, STATUSES, STATUS_SCORES
-
-
-PROCESSED_TYPE="Processed"
-DOCUMENT_TYPE="Document"
+from documents.scan import (
+    load_scan_manifest, save_scan_manifest, scan_tree, tree_signature
+)
+from documents.signals import deferred_status_updates
+from documents.util import document_file_path
 
 
 def get_basename_and_ext(filename):
@@ -43,22 +45,52 @@ def normalize_doc_filename(path):
     return re.sub("^.*/?agency_attachments/", "agency_attachments/", path)
 
 
-def files_from_agency_dir(agency_dir):
+def files_from_agency_dir(agency_dir, scan_manifest=None,
+                          new_scan_manifest=None):
     """
     Return a list of all files in an agency directory path, cleaned in
-    the expected document/processed doc format
+    the expected document/processed doc format, along with the signature of
+    the directory tree (see tree_signature).
     """
+    scanned = scan_tree(
+        agency_dir, manifest=scan_manifest, new_manifest=new_scan_manifest
+    )
     files = []
-    for x in os.walk(agency_dir):
-        for y in glob(os.path.join(x[0], '*'), recursive=True):
-            if os.path.isdir(y):
-                continue
-            
-            files.append(normalize_doc_filename(y))
-    return sorted(files, reverse=True)
+    for scanned_file in scanned:
+        path = os.path.join(agency_dir, scanned_file.path)
+        files.append(normalize_doc_filename(path))
+    return sorted(files, reverse=True), tree_signature(scanned)
 
 
-def get_new_agency_files(base_data_dir, only_agency=None, ignore_agencies=None):
+def get_known_files():
+    """
+    Every file path we already have a document or processed document for,
+    in one query per table.
+    """
+    known_files = set(Document.objects.filter(
+        agency__isnull=False
+    ).values_list("file", flat=True))
+    known_files.update(ProcessedDocument.objects.filter(
+        document__agency__isnull=False
+    ).values_list("file", flat=True))
+    return known_files
+
+
+def get_new_agency_files(base_data_dir, only_agency=None, ignore_agencies=None,
+                         scan_manifest=None, new_scan_manifest=None,
+                         signatures=None, new_signatures=None):
+    """
+    Find the files on disk that aren't in the DB yet, by agency. Agencies
+    whose tree signature matches the one in signatures (from the last run)
+    are skipped without looking at the DB. The current signature of every
+    scanned agency gets stored in new_signatures.
+    """
+    if signatures is None:
+        signatures = {}
+    if new_signatures is None:
+        new_signatures = {}
+    # loaded the first time we need it
+    known_files = None
     new_agency_files = {}
     for dirname in os.listdir(base_data_dir):
         if dirname.startswith("."):
@@ -75,27 +107,19 @@ def get_new_agency_files(base_data_dir, only_agency=None, ignore_agencies=None):
         if ignore_agencies and agency in ignore_agencies:
             continue
 
-        for agency_file in files_from_agency_dir(dirpath):
-            try:
-                Document.objects.get(
-                    file=agency_file, agency__isnull=False
-                )
-            except Document.DoesNotExist:
-                pass
-            except Document.MultipleObjectsReturned:
-                pass
-            else:
-                continue
+        agency_files, signature = files_from_agency_dir(
+            dirpath, scan_manifest=scan_manifest,
+            new_scan_manifest=new_scan_manifest
+        )
+        new_signatures[agency] = signature
+        if signatures.get(agency) == signature:
+            continue
 
-            try:
-                ProcessedDocument.objects.get(
-                    file=agency_file, document__agency__isnull=False
-                )
-            except ProcessedDocument.DoesNotExist:
-                pass
-            except ProcessedDocument.MultipleObjectsReturned:
-                pass
-            else:
+        if known_files is None:
+            known_files = get_known_files()
+
+        for agency_file in agency_files:
+            if agency_file in known_files:
                 continue
 
             # tests for known ignorable files
@@ -163,134 +187,75 @@ def get_page_number_from_filename(filename):
             processed_doc.save()
 
 
-def is_definitely_proc_doc(filename):
-    # text files are ambiguous
-    if filename.endswith(".txt"):
-        return False
-    proc_doc_statuses = [
-        "complete",
-        "awaiting-cleaning",
-        "awaiting-csv",
-    ]
-    for status, test in STATUSES.items():
-        # test if is in some completion state
-        if test(filename) and status in proc_doc_statuses:
-            return True
-
-
-def interactively_find_proc_doc_parent(agency, file):
-    parent = None
-    while parent is None:
-        print("  ", " -  Current parent:", parent)
-        parent_file = input("Enter the filename of the parent (s to skip): ")
-        if parent_file == "s":
-            return
-        parent = Document.objects.filter(
-            agency=agency,
-            file=parent_file
-        ).first()
-        print("  ", " -  Found parent:", parent)
-    return parent
-
-
-def is_definitely_responsive_doc(file):
-    lfile = file.lower()
-    if lfile.endswith(".pdf"):
-        return True
-    if lfile.endswith(".xlsx"):
-        return True
-    if lfile.endswith(".doc"):
-        return True
-    if lfile.endswith(".docx"):
-        return True
-    if lfile.endswith(".msg"):
-        return True
-    if lfile.endswith(".eml"):
-        return True
-    if lfile.endswith(".mp3"):
-        return True
-    if lfile.endswith(".wma"):
-        return True
-
-
-def add_doc_by_type(mtype, agency, file):
-    assert agency, f"No agency passed when creating file: {file}!"
-    if mtype == DOCUMENT_TYPE:
-        print("  ", "[+] Adding as document")
-        Document.objects.create(
-            agency=agency,
-            file=file
-        )
-    elif mtype == PROCESSED_TYPE:
-        possible_parent = file
-        strip_extensions = [
-            # normal cleaned/etc processed files
-            ".cleaned.csv", ".complete.csv", ".rough.csv",
-            ".precleaned.csv", ".ocr.pdf", ".rough.csv",
-            # these ones can be dangerous is there's multiple .ext.ext
-            ".csv", ".txt",
-        ]
-        for ext in strip_extensions:
-            if possible_parent.endswith(ext):
-                possible_parent = possible_parent.replace(ext, "")
-        print("  ", " -  Looking for parent with prefix:", possible_parent)
-        docs = Document.objects.filter(
-            agency=agency,
-            file__startswith=possible_parent,
-        )
+def get_agency(agency_name, files, create=False):
+    """
+    Look up an agency by name, creating it if we're allowed to. Returns
+    None if it doesn't exist and we didn't create it.
+    """
+    try:
+        agency = Agency.objects.get(name=agency_name)
+        print(f"\nAgency '{agency_name}'")
+        return agency
+    except Agency.DoesNotExist:
+        pass
+
+    print(f"\nAgency '{agency_name}' doesn't exist.")
+    print("[+] New files:")
+    for f in files:
+        print(f"   - {f}")
+    if not create:
+        print(" -  Not creating it without --create-agencies.")
+        return None
+
+    # Agency.save looks up the population for us
+    agency = Agency.objects.create(name=agency_name)
+    if not agency.population:
+        print(" -  Couldn't automatically find population.")
+    print("[+] Created agency!")
+    return agency
+
+
+def add_agency_files(agency, documents, processed):
+    """
+    Add the new documents and (file, parent file) processed documents
+    for an agency. Returns review queue rows for the processed documents
+    whose parent doesn't exist.
+    """
+    unresolved = []
+    # resolve this agency's statuses and rollups in one pass
+    with deferred_status_updates():
+        for file in documents:
+            print(f"[+] New file: {file} Type: {DOCUMENT_TYPE}")
+            Document.objects.create(
+                agency=agency,
+                file=file
+            )
 
-        # before moving forward, check for failure, then try
-        # for docx extraction
-        if docs.count() == 0:
-            # export from word doc have the following format:
-            # [BASENAME]_[NUMBER].csv (or .complete.csv)
-            possible_parent1 = re.sub(r"_\d\.[^\.]*\.?csv", "", file)
-            # [BASENAME]-[SHEETNAME].csv (or .complete.csv)
-            possible_parent2 = file.rsplit("-", 1)[:-1][0]
-            docs = Document.objects.filter(
+        parents = {
+            doc.file.name: doc
+            for doc in Document.objects.filter(
                 agency=agency,
-            ).filter(Q(
-                file__startswith=f"{possible_parent1}.",
-            ) | Q(
-                file__startswith=f"{possible_parent2}.",
-            )).filter(Q(
-                file__endswith=".doc",
-            ) | Q(
-                file__endswith=".docx",
-            ) | Q(
-                file__endswith=".xls",
-            ) | Q(
-                file__endswith=".xlsx",
-            ))
-            if docs.count() > 0:
-                print(" ", " -  Found doc/xls possible parents")
-
-        # now either set parent, or try and rope in user for help
-        parent = None
-        if docs.count() == 1:
-            parent = docs[0]
-        elif docs.count() == 0:
-            print("  ", f"[!] Couldn't find parent for file: {file}")
-            parent = interactively_find_proc_doc_parent(agency, file)
-        else:
-            print("  ", f" -  Found possible parents:")
-            for ix in range(len(docs)):
-                d = docs[ix]
-                print("  ", "    -", ix, d.file)
-            p_ix = int(input("Which file is the parent? (enter number) "))
-            parent = docs[p_ix]
-
-        if parent is None:
-            print("  ", f"[!] Couldn't find parent for file: {file}")
-        else:
-            print("  ", "[+] Adding as processed doc")
+                file__in=set(parent for _, parent in processed),
+            )
+        }
+        for file, parent_file in processed:
+            parent = parents.get(parent_file)
+            if parent is None:
+                print("  ", f"[!] Couldn't find parent for file: {file}")
+                unresolved.append({
+                    "agency": agency.name, "file": file,
+                    "type": PROCESSED_TYPE, "parent": "",
+                    "reason": f"Parent doesn't exist: {parent_file}",
+                    "candidates": "",
+                })
+                continue
+            print(f"[+] New file: {file} Type: {PROCESSED_TYPE}")
             print("  ", " -  Parent:", parent)
             ProcessedDocument.objects.create(
                 document=parent,
                 file=file,
             )
-    else:
-        print("  ", f"[!] ERROR: Couldn't add file with type: {mtype}")
+    return unresolved
 
 
 class Command(BaseCommand):
@@ -306,6 +271,41 @@ class Command(BaseCommand):
             '--ignore', type=str,
             help='Ignore these agencies (comma separated)'
         )
+        parser.add_argument(
+            '--rules', type=str,
+            help=(
+                'YAML file overriding the default file type and parent '
+                'matching rules (see documents/import_rules.py)'
+            )
+        )
+        parser.add_argument(
+            '--review-csv', type=str,
+            help='Write files that need a human decision to this CSV'
+        )
+        parser.add_argument(
+            '--resume-from', type=str,
+            help='Apply the decisions filled into a review CSV'
+        )
+        parser.add_argument(
+            '--create-agencies', action='store_true',
+            help="Create agencies that don't exist yet"
+        )
+        parser.add_argument(
+            '--manifest', type=str,
+            help=(
+                'Keep a manifest of the agency directories here. Agencies '
+                'whose files haven\'t changed since the last run are skipped'
+            )
+        )
+        parser.add_argument(
+            '--full-scan', action='store_true',
+            help=(
+                'Ignore what the manifest says and look at every agency '
+                'directory again (the manifest still gets updated). '
+                'Files overwritten in place, or removed from the DB, don\'t '
+                'change the manifest'
+            )
+        )
 
     def handle(self, *args, **options):
         base_data_dir = options['base_data_dir']
@@ -315,79 +315,91 @@ class Command(BaseCommand):
             a.strip() for a in ignore_str.strip().split(",")
             if a.strip()
         ]
+        manifest_path = options.get('manifest')
+        full_scan = options.get('full_scan')
+        rules = load_rules(options.get('rules'))
+        review_csv = options.get('review_csv')
+        create_agencies = options.get('create_agencies')
+        resolutions = {}
+        if options.get('resume_from'):
+            resolutions = load_review_queue(options['resume_from'])
 
         print("Importing with args:")
         print(f"    Base data directory: {base_data_dir}")
         print(f"    Only agency: {only_agency}")
         print(f"    Ignore agencies: {ignore_agencies}")
-
+        print(f"    Manifest: {manifest_path}")
+        print(f"    Full scan: {full_scan}")
+        print(f"    Rules: {options.get('rules') or 'default'}")
+        print(f"    Review CSV: {review_csv}")
+        print(f"    Resuming with {len(resolutions)} reviewed files")
 
         print("Searching for new agency files...")
+        scan_manifest = load_scan_manifest(manifest_path)
+        signatures = load_scan_manifest(manifest_path, section="agencies")
+        new_scan_manifest = {}
+        new_signatures = {}
         new_agency_files = get_new_agency_files(
             base_data_dir, only_agency=only_agency,
-            ignore_agencies=ignore_agencies
+            ignore_agencies=ignore_agencies,
+            # the old ones still get kept for agencies we don't scan
+            scan_manifest={} if full_scan else scan_manifest,
+            new_scan_manifest=new_scan_manifest,
+            signatures={} if full_scan else signatures,
+            new_signatures=new_signatures,
         )
         print(f"Found new files from {len(new_agency_files)} agencies")
 
+        # everything we couldn't figure out, for the review queue
+        unresolved = []
         for agency_name, files in new_agency_files.items():
-            agency = None
-            try:
-                agency = Agency.objects.get(name=agency_name)
-                print(f"\nAgency '{agency_name}'")
-            except Agency.DoesNotExist:
-                print(f"\nAgency '{agency_name}' doesn't exist.")
-                print("[+] New files:")
-                for f in files:
-                    print(f"   - {f}")
-                yn = input(f"Create '{agency_name}'? (y/n) ")
-                if yn.lower() == "y":
-                    agency = Agency.objects.create(
-                        name=agency_name
-                    )
-                    pop = Agency.try_to_get_population(agency_name)
-                    if not pop:
-                        print(" -  Couldn't automatically find population.")
-                        try:
-                            pop = int(input("Enter population: "))
-                        except Exception as e:
-                            print("[!] Parse error:", e)
-                            print(" -  Not adding population.")
-                            pop = None
-                    if pop:
-                        agency.population = pop
-                    agency.save()
-                    print("[+] Created agency!")
-                else:
-                    continue
-
-            for file in files:
-                mtype = None
-                # check this first as .pdf will get caught for document, when
-                # in fact ocr.pdf is a processed doc
-                if is_definitely_proc_doc(file):
-                    mtype = PROCESSED_TYPE
-                elif is_definitely_responsive_doc(file):
-                    mtype = DOCUMENT_TYPE
-                else:
-                    print("[!] Can't figure out what type of doc this is:")
-                    print(file)
-                    pd = input(
-                        f"What type is it? (p)rocessed, (d)ocument or (s)kip "
-                    ).lower().strip()
-
-                    if pd == "s":
-                        print(" -  Skipping file")
-                        continue
-                    elif pd == "d":
-                        mtype = DOCUMENT_TYPE
-                    elif pd == "p":
-                        mtype = PROCESSED_TYPE
-                    # this should be a catch all
-                    elif pd not in ["p", "d"]:
-                        print(" -  Unrecognized option! Skipping file.")
-                        continue
-
-                print(f"[+] New file: {file} Type: {mtype}")
-                add_doc_by_type(mtype, agency, file)
+            agency = get_agency(agency_name, files, create=create_agencies)
+            if agency is None:
+                # look at this agency again next time
+                new_signatures.pop(agency_name, None)
+                unresolved += [{
+                    "agency": agency_name, "file": file, "type": "",
+                    "parent": "", "reason": "Agency doesn't exist",
+                    "candidates": "",
+                } for file in files]
+                continue
+
+            document_files = Document.objects.filter(
+                agency=agency
+            ).values_list("file", flat=True)
+            documents, processed, agency_unresolved = resolve_files(
+                agency_name, files, document_files, rules,
+                resolutions=resolutions
+            )
+            agency_unresolved += add_agency_files(agency, documents, processed)
+            print(f"Added {len(documents)} documents and {len(processed)} "
+                  f"processed documents, {len(agency_unresolved)} files "
+                  "need review")
+
+            # only trust the signature if everything new got added,
+            # otherwise the unresolved files would never come up again
+            if agency_unresolved:
+                new_signatures.pop(agency_name, None)
+            unresolved += agency_unresolved
+
+        if unresolved:
+            print(f"\n{len(unresolved)} files need review:")
+            for row in unresolved:
+                print(f"   - {row['file']}: {row['reason']}")
+            if review_csv:
+                write_review_queue(review_csv, unresolved)
+                print(f"Wrote review queue to {review_csv}. Fill in the type "
+                      "and parent columns and re-run with --resume-from")
+
+        if manifest_path:
+            if only_agency or ignore_agencies:
+                # keep what we know about the agencies we didn't scan
+                for agency_name, signature in signatures.items():
+                    new_signatures.setdefault(agency_name, signature)
+                for dirpath, entry in scan_manifest.items():
+                    new_scan_manifest.setdefault(dirpath, entry)
+            save_scan_manifest(
+                manifest_path, new_scan_manifest, agencies=new_signatures
+            )
 
         print("Complete!")
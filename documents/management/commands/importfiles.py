@@ -5,29 +5,39 @@ import sys
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import transaction
 import tablib
 
 from documents.models import Agency, Document, ProcessedDocument
-from documents.util import document_file_path, STATUSES, STATUS_SCORES
+from documents.scan import load_scan_manifest, save_scan_manifest, scan_tree
+from documents.signals import deferred_status_updates, flush_status_updates
+from documents.util import (
+    STATUS_SCORES, classify, classify_many, document_file_path
+)
 
 
-def get_status(files_group, basepath=None, agency=None):
-    s_fn = lambda n: os.path.getmtime(os.path.join(basepath, agency, n))
+# rows per INSERT (and per file__in lookup) when writing to the DB
+BULK_CREATE_SIZE = 1000
+
+
+def get_status(files_group, basepath=None, agency=None, mtimes=None):
+    # use the mtimes from our scan if we have them, stats can be slow
+    if mtimes is not None:
+        s_fn = lambda n: mtimes[n]
+    else:
+        s_fn = lambda n: os.path.getmtime(os.path.join(basepath, agency, n))
     sorted_files = sorted(files_group, key=s_fn, reverse=True)
 
     final_status = None
     lowest_score = None
     original_file = sorted_files.pop()
     current_file = None
-    for filename in files_group:
-        for status, test_fn in STATUSES.items():
-            if test_fn(filename):
-                score = STATUS_SCORES[status]
-                if lowest_score is None or lowest_score > score:
-                    lowest_score = score
-                    final_status = status
-                    current_file = filename
-                break
+    for filename, status in zip(files_group, classify_many(files_group)):
+        score = STATUS_SCORES[status]
+        if lowest_score is None or lowest_score > score:
+            lowest_score = score
+            final_status = status
+            current_file = filename
 
     # PDF Pre-processing correction: we have a page-extracted file here, so we
     # add the original file (without the -p[num]) suffix.
@@ -66,35 +76,48 @@ def get_file_groups(agency_files):
         if basename not in groups:
             groups[basename] = []
         groups[basename].append(file)
-    remove_groups = []
+
+    # basename: files of the XLS/X and DOCX groups. sheet CSVs are named
+    # [name]-[sheet].csv and DOCX table CSVs [name]_[table_no].csv, so a
+    # CSV's parent basename is always a prefix of its name ending right
+    # before a - or _. that lets us find parents with a lookup per
+    # separator instead of comparing every group against every other one
+    xls_files = {}
+    docx_files = {}
     for basename, group in groups.items():
         for file in group:
-            # combine [name].xls and its [name]-[sheet].csv files
             if ".xls" in file:
-                for basename2, group2 in groups.items():
-                    if basename == basename2:
-                        continue
-                    for file2 in group2:
-                        if re.findall(f"{basename}-.+\.csv", file2):
-                            # add the base xls/x file to the sheetgroup
-                            group2.append(file)
-                            # we have a match on the base XLS, so don't add
-                            # it as its own group
-                            if basename not in remove_groups:
-                                remove_groups.append(basename)
-            # combine [name].docx and its [name]_[table_no].csv files
+                xls_files.setdefault(basename, []).append(file)
             elif ".docx" in file:
-                for basename2, group2 in groups.items():
-                    if basename == basename2:
-                        continue
-                    for file2 in group2:
-                        if re.findall(f"{basename}_.+\.csv", file2):
-                            # add the base xls/x file to the sheetgroup
-                            group2.append(file)
-                            # we have a match on the base XLS, so don't add
-                            # it as its own group
-                            if basename not in remove_groups:
-                                remove_groups.append(basename)
+                docx_files.setdefault(basename, []).append(file)
+
+    remove_groups = set()
+    for basename2, group2 in groups.items():
+        parent_files = []
+        for file2 in group2:
+            name = os.path.basename(file2)
+            if not name.endswith(".csv"):
+                continue
+            for ix, char in enumerate(name):
+                # the separator needs at least one char after it
+                if ix == 0 or ix >= len(name) - len(".csv") - 1:
+                    continue
+                if char == "-":
+                    parents = xls_files
+                elif char == "_":
+                    parents = docx_files
+                else:
+                    continue
+                basename = name[:ix]
+                if basename == basename2 or basename not in parents:
+                    continue
+                # we have a match on the base XLS/DOCX, so add it to the
+                # sheet/table group and don't add it as its own group
+                for file in parents[basename]:
+                    if file not in parent_files:
+                        parent_files.append(file)
+                remove_groups.add(basename)
+        group2 += parent_files
 
     for basename in remove_groups:
         del groups[basename]
@@ -105,7 +128,13 @@ def get_file_groups(agency_files):
     return groups
 
 
-def get_agency_files(base_data_dir, only_agency=None, ignore_agencies=None):
+def get_agency_files(base_data_dir, only_agency=None, ignore_agencies=None,
+                     scan_manifest=None, new_scan_manifest=None):
+    """
+    Scan the agency directories. Returns {agency: {rel_path: ScannedFile}},
+    with the paths relative to the agency directory. Pass in a scan manifest
+    to skip listing directories that haven't changed since the last run.
+    """
     cleaned_agency_files = {}
     for dirname in os.listdir(base_data_dir):
         if dirname.startswith("."):
@@ -121,44 +150,196 @@ def get_agency_files(base_data_dir, only_agency=None, ignore_agencies=None):
         if ignore_agencies and agency in ignore_agencies:
             continue
 
-        for basedir, _, files in os.walk(dirpath):
-            # if we're in a subdirectory of a agency directory, get
-            # the relative path to our files
-            dir_part = ''
-            end_position = basedir.index(agency) + len(agency)
-            # if we have another folder, we'll have at least '/' and
-            # a (minimum one char) folder appended
-            if len(basedir) >= end_position + 2:
-                # we have subdirs, add it to basedir
-                dir_part = basedir[end_position + 1:]
-
-            for name in files:
-                # ignore my own request document
-                if name.lower() == "records-request.pdf":
-                    continue
-                elif "exemption log" in name.lower():
-                    continue
-                elif "redaction log" in name.lower():
-                    continue
-                elif name.endswith(".extractor.yaml"):
-                    continue
-                elif name.endswith(".py"):
-                    continue
-                elif name.endswith(".sh"):
-                    continue
-                elif name.endswith(".zip"):
-                    continue
-                elif name.startswith("."):
-                    continue
-                elif name.lower() == "joined.csv":
-                    continue
-                if agency not in cleaned_agency_files:
-                    cleaned_agency_files[agency] = []
-                rel_path = os.path.join(dir_part, name)
-                cleaned_agency_files[agency].append(rel_path)
+        scanned = scan_tree(
+            dirpath, manifest=scan_manifest, new_manifest=new_scan_manifest
+        )
+        for scanned_file in scanned:
+            name = os.path.basename(scanned_file.path)
+            # ignore my own request document
+            if name.lower() == "records-request.pdf":
+                continue
+            elif "exemption log" in name.lower():
+                continue
+            elif "redaction log" in name.lower():
+                continue
+            elif name.endswith(".extractor.yaml"):
+                continue
+            elif name.endswith(".py"):
+                continue
+            elif name.endswith(".sh"):
+                continue
+            elif name.endswith(".zip"):
+                continue
+            elif name.startswith("."):
+                continue
+            elif name.lower() == "joined.csv":
+                continue
+            if agency not in cleaned_agency_files:
+                cleaned_agency_files[agency] = {}
+            cleaned_agency_files[agency][scanned_file.path] = scanned_file
 
     return cleaned_agency_files
 
+
+def get_sources(original_file, current_file):
+    """
+    Work out the source page(s), for a CSV extracted from a PDF, and the
+    source sheet, for a CSV exported from an XLS/X, of a processed file.
+    Returns (source_page, source_sheet), either can be None.
+    """
+    source_page = None
+    found_page_parts = re.findall(r"-p([0-9\-]+)\.csv$", current_file)
+    if found_page_parts:
+        assert len(found_page_parts) == 1
+        source_page = found_page_parts[0]
+
+    source_sheet = None
+    basename, ext = get_basename_and_ext(original_file)
+    safe_basename = re.escape(basename)
+    sheet_name = re.findall(f"{safe_basename}-(.+)\\.csv", current_file)
+    if sheet_name:
+        assert len(sheet_name) == 1
+        source_sheet = sheet_name[0]
+
+    return source_page, source_sheet
+
+
+def existing_files(model, files):
+    """
+    Of the given file paths, return the set that already belong to a model
+    (Document or ProcessedDocument), in one query per BULK_CREATE_SIZE files.
+    """
+    files = list(files)
+    existing = set()
+    for i in range(0, len(files), BULK_CREATE_SIZE):
+        existing.update(model.objects.filter(
+            file__in=files[i:i + BULK_CREATE_SIZE]
+        ).values_list("file", flat=True))
+    return existing
+
+
+def get_agencies(names):
+    """
+    Agency name => Agency, creating any agencies we don't have yet.
+    """
+    agencies = {
+        agency.name: agency
+        for agency in Agency.objects.filter(name__in=names)
+    }
+    for name in sorted(set(names) - set(agencies)):
+        # one at a time, so Agency.save can look up the population
+        agencies[name] = Agency.objects.create(name=name)
+        print("Created agency", agencies[name])
+    return agencies
+
+
+def import_rows(rows, agency_middle_files):
+    """
+    Write import rows (status, agency, current_file, original_file) and their
+    middle files to the DB. Everything that already exists is looked up up
+    front, so the new documents and processed documents can go in with a
+    handful of bulk INSERTs, instead of a get_or_create (and the signals
+    that come with it) per file. Document statuses and agency rollups get
+    resolved once, at the end.
+    """
+    rows = list(rows)
+    agencies = get_agencies(set(row["agency"] for row in rows))
+
+    # documents first, we need their IDs for the processed documents
+    doc_keys = []
+    for row in rows:
+        agency = agencies[row["agency"]]
+        doc_path = document_file_path(agency.name, row["original_file"])
+        doc_keys.append((agency.pk, doc_path))
+
+    existing_docs = set(Document.objects.filter(
+        agency__in=agencies.values()
+    ).values_list("agency_id", "file"))
+    new_docs = {}
+    for agency_id, doc_path in doc_keys:
+        key = (agency_id, doc_path)
+        if key in existing_docs or key in new_docs:
+            continue
+        new_docs[key] = Document(agency_id=agency_id, file=doc_path)
+
+    # file => ProcessedDocument, the processed file paths are unique.
+    # the first row to claim a file gets it, like get_or_create would
+    new_pdocs = {}
+    # file => (agency_id, doc_path) of the document it goes with. unsaved
+    # model instances aren't hashable, so this is keyed by file too
+    pdoc_doc_keys = {}
+    for row, (agency_id, doc_path) in zip(rows, doc_keys):
+        agency_name = row["agency"]
+        original_file = row["original_file"]
+        current_file = row["current_file"]
+
+        middle_filenames = agency_middle_files[f"{agency_name}-{original_file}"]
+        for middle_filename in middle_filenames:
+            p_file = document_file_path(agency_name, middle_filename)
+            if p_file in new_pdocs:
+                continue
+            new_pdocs[p_file] = ProcessedDocument(
+                file=p_file,
+                # bulk_create skips ProcessedDocument.save
+                status=classify(p_file),
+            )
+            pdoc_doc_keys[p_file] = (agency_id, doc_path)
+
+        if current_file == original_file:
+            continue
+
+        p_file = document_file_path(agency_name, current_file)
+        if p_file in new_pdocs:
+            continue
+        source_page, source_sheet = get_sources(original_file, current_file)
+        new_pdocs[p_file] = ProcessedDocument(
+            file=p_file,
+            status=classify(p_file),
+            source_page=source_page,
+            source_sheet=source_sheet,
+        )
+        pdoc_doc_keys[p_file] = (agency_id, doc_path)
+
+    for p_file in existing_files(ProcessedDocument, new_pdocs.keys()):
+        del new_pdocs[p_file]
+
+    agency_docs = Document.objects.filter(agency__in=agencies.values())
+    with transaction.atomic():
+        # ignore_conflicts skips rows someone else inserted in the meantime
+        # without telling us, so count what actually went in
+        n_docs_before = agency_docs.count()
+        Document.objects.bulk_create(
+            new_docs.values(), batch_size=BULK_CREATE_SIZE,
+            ignore_conflicts=True
+        )
+
+        # ignore_conflicts means we don't get the new IDs back
+        doc_ids = {
+            (agency_id, file): pk
+            for pk, agency_id, file in agency_docs.values_list(
+                "pk", "agency_id", "file"
+            )
+        }
+        print(f"Created {len(doc_ids) - n_docs_before} documents")
+
+        for p_file, pdoc in new_pdocs.items():
+            pdoc.document_id = doc_ids[pdoc_doc_keys[p_file]]
+        n_pdocs_before = len(
+            existing_files(ProcessedDocument, new_pdocs.keys())
+        )
+        ProcessedDocument.objects.bulk_create(
+            new_pdocs.values(), batch_size=BULK_CREATE_SIZE,
+            ignore_conflicts=True
+        )
+        n_pdocs = len(existing_files(ProcessedDocument, new_pdocs.keys()))
+        print(f"Created {n_pdocs - n_pdocs_before} processed documents")
+
+    # bulk_create doesn't fire any signals
+    document_ids = set(doc_ids[key] for key in new_docs)
+    document_ids.update(pdoc.document_id for pdoc in new_pdocs.values())
+    flush_status_updates(document_ids)
+
+
 class Command(BaseCommand):
     help = """Scan agency directory, copying and setting up the database. This command will optionally output a CSV if the second arg is provided."""
 
@@ -179,6 +360,13 @@ class Command(BaseCommand):
             '--dryrun-output', type=str,
             help='Ouput CSV instead of writing to DB/copying files'
         )
+        parser.add_argument(
+            '--scan-manifest', type=str,
+            help=(
+                'Keep a manifest of the scanned directories here, so the '
+                'next run only lists directories that changed'
+            )
+        )
 
     def handle(self, *args, **options):
         base_data_dir = options['base_data_dir']
@@ -186,12 +374,14 @@ class Command(BaseCommand):
         wipe_agency = None
         if only_agency:
             wipe_agency = options.get('wipe_agency', None)
-        output_csv = options.get('dryrun-output')
+        output_csv = options.get('dryrun_output')
+        scan_manifest_path = options.get('scan_manifest')
 
         print("Importing with args:")
         print(f"    Only agency: {only_agency}")
         print(f"    Wipe agency: {wipe_agency}")
         print(f"    Dryrun, output to CSV: {output_csv}")
+        print(f"    Scan manifest: {scan_manifest_path}")
 
         # if os.path.exists(output_csv):
         #     with open(output_csv, "r") as f:
@@ -205,18 +395,36 @@ class Command(BaseCommand):
             agency = row["agency"]
             name = row["original_file"]
             unique_hash = f"{agency}-{name}"
-            existing[unique_hash] = True
+            existing.add(unique_hash)
 
         ignore_agencies = []
 
         # {agency-original_filename: [file1, file2, ..., fileN]}
         agency_middle_files = {}
+        scan_manifest = load_scan_manifest(scan_manifest_path)
+        new_scan_manifest = {}
         agency_files = get_agency_files(base_data_dir, only_agency=only_agency,
-                                        ignore_agencies=ignore_agencies)
+                                        ignore_agencies=ignore_agencies,
+                                        scan_manifest=scan_manifest,
+                                        new_scan_manifest=new_scan_manifest)
+        if scan_manifest_path:
+            if only_agency:
+                # keep the entries for the agencies we didn't scan this time
+                agency_dir = os.path.join(base_data_dir, only_agency)
+                for dirpath, entry in scan_manifest.items():
+                    if dirpath == agency_dir:
+                        continue
+                    if dirpath.startswith(f"{agency_dir}{os.sep}"):
+                        continue
+                    new_scan_manifest.setdefault(dirpath, entry)
+            save_scan_manifest(scan_manifest_path, new_scan_manifest)
+
         for agency, files in agency_files.items():
+            mtimes = {path: f.mtime for path, f in files.items()}
             for basename, group in get_file_groups(files).items():
                 status, current_filename, original_filename = get_status(
-                    group, basepath=base_data_dir, agency=agency
+                    group, basepath=base_data_dir, agency=agency,
+                    mtimes=mtimes
                 )
 
                 unique_hash = f"{agency}-{original_filename}"
@@ -250,69 +458,12 @@ class Command(BaseCommand):
             agency = Agency.objects.get(
                 name=only_agency
             )
-            for doc in agency.document_set.all():
-                doc.processeddocument_set.all().delete()
+            with deferred_status_updates():
+                for doc in agency.document_set.all():
+                    doc.processeddocument_set.all().delete()
 
-            agency.document_set.all().delete()
+                agency.document_set.all().delete()
 
-        for row in data.dict:
-            agency, created = Agency.objects.get_or_create(
-                name=row["agency"]
-            )
-            if created:
-                print("Created agency", agency)
-
-            original_file = row["original_file"]
-            current_file = row["current_file"]
-            status = row["status"]
-
-            document, created = Document.objects.get_or_create(
-                agency=agency,
-                file=document_file_path(agency.name, original_file)
-            )
-            if created:
-                print("Created document", document)
-                print("  - Doc agency", agency)
-
-            middle_filenames = agency_middle_files[f"{agency.name}-{original_file}"]
-            for middle_filename in middle_filenames:
-                m_proc_doc, created = ProcessedDocument.objects.get_or_create(
-                    document=document,
-                    file=document_file_path(agency.name, middle_filename),
-                )
-                if created:
-                    print("Created middle processed document", m_proc_doc)
-                    print("  - Parent document", document)
-
-            if current_file != original_file:
-                p_file = document_file_path(agency.name, current_file)
-                if ProcessedDocument.objects.filter(file=p_file).count():
-                    # print("ProcessedDocument for file Exists!", p_file)
-                    continue
-                processed_doc, created = ProcessedDocument.objects.get_or_create(
-                    document=document,
-                    file=document_file_path(agency.name, current_file),
-                )
-                if created:
-                    print("Created processed document", processed_doc)
-                    print("  - Parent document", document)
-
-                processed_doc.save()
-
-            # set the source page number for a CSV
-            found_page_parts = re.findall(r"-p([0-9\-]+)\.csv$", current_file)
-            if found_page_parts:
-                assert len(found_page_parts) == 1
-                processed_doc.source_page = found_page_parts[0]
-                processed_doc.save()
-
-            # set the source sheet from an XLS for a CSV
-            basename, ext = get_basename_and_ext(original_file)
-            safe_basename = re.escape(basename)
-            sheet_name = re.findall(f"{safe_basename}-(.+)\.csv", current_file)
-            if sheet_name:
-                assert len(sheet_name) == 1
-                processed_doc.source_sheet = sheet_name[0]
-                processed_doc.save()
+        import_rows(data.dict, agency_middle_files)
 
         print("Complete!")
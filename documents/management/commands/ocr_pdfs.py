@@ -1,11 +1,69 @@
 #!/usr/bin/env python
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
 import shutil
+import signal
 import subprocess
 
 from django.core.management.base import BaseCommand
+from django.db import connections
+import tablib
 
 from documents.models import Agency, Document, ProcessedDocument
+from documents.signals import flush_status_updates
+
+
+# how many finished OCR jobs to collect before writing their
+# processed documents to the DB in one go
+BULK_CREATE_SIZE = 25
+
+
+def ocrmypdf_args(pdf_input, ocr_output, jobs=None):
+    args = [
+        "ocrmypdf",
+        "--threshold",
+        "--remove-background",
+        "--unpaper-args=--no-grayfilter",
+        "--force-ocr",
+        "--clean-final",
+        "--remove-vectors",
+        "--oversample", "600",
+        "--tesseract-oem", "1",
+        "--tesseract-pagesegmode", "12",
+    ]
+    if jobs:
+        args += ["--jobs", str(jobs)]
+    return args + [pdf_input, ocr_output]
+
+
+def run_ocr(pdf_input, ocr_output, jobs=None, timeout=None, quiet=False):
+    """
+    Run ocrmypdf on a single PDF. Returns an error message on failure or
+    None if everything worked. This runs inside the worker processes, so
+    it must not touch the DB.
+    """
+    output = subprocess.DEVNULL if quiet else None
+    # new session so we can kill ocrmypdf and all its tesseract children
+    proc = subprocess.Popen(
+        ocrmypdf_args(pdf_input, ocr_output, jobs=jobs),
+        stdout=output, stderr=output,
+        start_new_session=True,
+    )
+    error = None
+    try:
+        returncode = proc.wait(timeout=timeout)
+        if returncode != 0:
+            error = f"Bad return code: {returncode}"
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        error = f"Timed out after {timeout}s"
+
+    # don't leave a partial OCR file around, otherwise the next run
+    # will think this one is done
+    if error and os.path.exists(ocr_output):
+        os.remove(ocr_output)
+    return error
 
 
 class Command(BaseCommand):
@@ -17,22 +75,73 @@ class Command(BaseCommand):
             '--pre-ocr-folder', type=str,
             help='Check in this folder for already OCRd PDFs'
         )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help=(
+                'Number of PDFs to OCR at once. Anything over 1 runs '
+                'non-interactively in a process pool'
+            )
+        )
+        parser.add_argument(
+            '--ocr-jobs', type=int,
+            help=(
+                'Value for ocrmypdf --jobs. Defaults to splitting the CPU '
+                'cores evenly between workers'
+            )
+        )
+        parser.add_argument(
+            '--timeout', type=int,
+            help='Give up on a single PDF after this many seconds'
+        )
+        parser.add_argument(
+            '--no-prompt', action='store_true',
+            help="Don't ask to continue between files"
+        )
+        parser.add_argument(
+            '--failures-report', type=str,
+            help='Write a CSV of failed PDFs and the reason to this path'
+        )
 
-    def handle(self, *args, **options):
-        pre_ocr_folder = options.get('pre_ocr_folder')
-        # basename => filepath
-        pre_ocr_files = {}
-        if pre_ocr_folder:
-            for file in os.listdir(pre_ocr_folder):
-                # look for either acceptable OCRd extenaion
-                if file.endswith(".ocr-pdf") or file.endswith(".ocr.pdf"):
-                    # convert the lookup to the assumed lookup extension, leave
-                    # the filepath the real extension though
-                    key = file.replace(".ocr-pdf", ".ocr.pdf")
-                    pre_ocr_files[key] = os.path.join(pre_ocr_folder, file)
+    def ocr_budget(self, workers, ocr_jobs):
+        """
+        Split the CPU cores between our workers and ocrmypdf's own
+        parallelism so the two don't oversubscribe the machine.
+        """
+        n_cores = os.cpu_count() or 1
+        if not ocr_jobs:
+            return max(1, n_cores // workers)
+        if workers * ocr_jobs > n_cores:
+            ocr_jobs = max(1, n_cores // workers)
+            print(f"Clamping --ocr-jobs to {ocr_jobs} ({n_cores} cores)")
+        return ocr_jobs
 
-        prompt = True
-        failures = []
+    def create_pdocs(self, completed):
+        """
+        Create the OCR'd processed documents for a batch of finished
+        jobs, a list of (document, ocr_output) pairs.
+        """
+        if not completed:
+            return
+        ProcessedDocument.objects.bulk_create([
+            ProcessedDocument(
+                document=document,
+                file=ocr_output,
+                status="awaiting-reading"
+            )
+            for document, ocr_output in completed
+        ], ignore_conflicts=True)
+        # bulk_create doesn't fire post_save, so resolve the statuses of
+        # the whole batch ourselves
+        flush_status_updates([document.pk for document, _ in completed])
+        print(f"Created {len(completed)} OCR'd processed documents")
+        completed.clear()
+
+    def find_jobs(self, pre_ocr_files):
+        """
+        Find all the PDFs that need OCRing. Documents with a matching
+        pre-OCR'd file get their processed document created right away
+        and aren't returned. Yields (document, pdf_input, ocr_output).
+        """
         for agency in Agency.objects.all():
             agency_unprocessed_docs = Document.objects.filter(
                 status__in=[
@@ -54,9 +163,6 @@ class Command(BaseCommand):
                 if pdf_input.endswith(".ocr.pdf"):
                     print("Skipping OCR'd document", pdf_input);
                     continue
-                if os.path.exists(ocr_output):
-                    print("OCR'd already complete", ocr_output);
-                    continue
                 pdocs = ProcessedDocument.objects.filter(
                     document=doc,
                     file__endswith=".ocr.pdf"
@@ -64,27 +170,19 @@ class Command(BaseCommand):
                 if pdocs.count():
                     print("OCR'd processed document already exists", ocr_output);
                     continue
-
-
-                def create_pdoc(document, ocr_output):
-                    pdoc = ProcessedDocument.objects.create(
-                        document=document,
-                        file=ocr_output,
-                        status="awaiting-reading"
-                    )
-                    pdoc.save()
-
-                    print("OCR complete!")
-                    print(pdoc.file.path)
-                    print(os.stat(pdoc.file.path))
-
+                if os.path.exists(ocr_output):
+                    # OCR'd by a run that stopped before it got to
+                    # creating the processed document
+                    print("OCR'd already complete", ocr_output);
+                    self.create_pdocs([(doc, ocr_output)])
+                    continue
 
                 # look for pre-converted file first
                 search = os.path.basename(ocr_output)
                 if search in pre_ocr_files:
                     print("Found matching pre-OCR'd file", search)
                     print("Checking for dupes...", end=" ")
-                    
+
                     # make sure this PDF file is uniquye to this agency
                     # since the pre-OCR'd files aren't grouped by agency
                     matches = Document.objects.filter(
@@ -98,45 +196,119 @@ class Command(BaseCommand):
                         ocr_path = pre_ocr_files[search]
                         print(f"Copying {ocr_path} to {ocr_output}")
                         shutil.copy(ocr_path, ocr_output)
-                        create_pdoc(doc, ocr_output)
+                        self.create_pdocs([(doc, ocr_output)])
                         continue
 
-                print("OCRing Document:", pdf_input)
-                result = subprocess.run([
-                    "ocrmypdf",
-                    "--threshold",
-                    "--remove-background",
-                    "--unpaper-args=--no-grayfilter",
-                    "--force-ocr",
-                    "--clean-final",
-                    "--remove-vectors",
-                    "--oversample", "600",
-                    "--tesseract-oem", "1",
-                    "--tesseract-pagesegmode", "12",
-                    pdf_input, ocr_output
-                ])
-
-                if result.returncode != 0:
-                    print("Bad return code:", result.returncode)
-                    print("PDF File:", pdf_input)
-                    failures.append(pdf_input)
-                    continue
+                yield doc, pdf_input, ocr_output
+
+    def run_serial(self, jobs, ocr_jobs, timeout, prompt):
+        completed = []
+        failures = []
+        for doc, pdf_input, ocr_output in jobs:
+            print("OCRing Document:", pdf_input)
+            error = run_ocr(pdf_input, ocr_output, jobs=ocr_jobs,
+                            timeout=timeout)
+            if error:
+                print(error)
+                print("PDF File:", pdf_input)
+                failures.append((pdf_input, error))
+                continue
+
+            completed.append((doc, ocr_output))
+            self.create_pdocs(completed)
+            print("OCR complete!", ocr_output)
+
+            if prompt:
+               yn = input("Continue? [Y]es/(n)o/(a)ll ").lower()
+               if yn == "y":
+                   continue
+               elif yn == "n":
+                   break
+               elif yn == "a":
+                   prompt = False
+                   continue
+        return failures
+
+    def run_parallel(self, jobs, workers, ocr_jobs, timeout):
+        completed = []
+        failures = []
+        jobs = list(jobs)
+        print(f"OCRing {len(jobs)} documents with {workers} workers "
+              f"({ocr_jobs} ocrmypdf jobs each)")
 
-                create_pdoc(doc, ocr_output)
+        # don't hand our DB connection down to the forked workers
+        connections.close_all()
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(
+                        run_ocr, pdf_input, ocr_output,
+                        jobs=ocr_jobs, timeout=timeout, quiet=True
+                    ): (doc, pdf_input, ocr_output)
+                    for doc, pdf_input, ocr_output in jobs
+                }
+                for n_done, future in enumerate(
+                    as_completed(futures), start=1
+                ):
+                    doc, pdf_input, ocr_output = futures[future]
+                    try:
+                        error = future.result()
+                    except Exception as e:
+                        error = f"Worker error: {e}"
 
-                if prompt:
-                   yn = input("Continue? [Y]es/(n)o/(a)ll ").lower()
-                   if yn == "y":
-                       continue
-                   elif yn == "n":
-                       break
-                   elif yn == "a":
-                       prompt = False
-                       continue
+                    if error:
+                        print(f"[{n_done}/{len(jobs)}] FAILED {pdf_input}: "
+                              f"{error}")
+                        failures.append((pdf_input, error))
+                        continue
+
+                    print(f"[{n_done}/{len(jobs)}] OCR complete: "
+                          f"{ocr_output}")
+                    completed.append((doc, ocr_output))
+                    if len(completed) >= BULK_CREATE_SIZE:
+                        self.create_pdocs(completed)
+        finally:
+            # even if we're interrupted, so the finished OCR files don't
+            # end up on disk without a processed document
+            self.create_pdocs(completed)
+        return failures
+
+    def handle(self, *args, **options):
+        pre_ocr_folder = options.get('pre_ocr_folder')
+        workers = max(1, options.get('workers') or 1)
+        ocr_jobs = self.ocr_budget(workers, options.get('ocr_jobs'))
+        timeout = options.get('timeout')
+        failures_report = options.get('failures_report')
+
+        # basename => filepath
+        pre_ocr_files = {}
+        if pre_ocr_folder:
+            for file in os.listdir(pre_ocr_folder):
+                # look for either acceptable OCRd extenaion
+                if file.endswith(".ocr-pdf") or file.endswith(".ocr.pdf"):
+                    # convert the lookup to the assumed lookup extension, leave
+                    # the filepath the real extension though
+                    key = file.replace(".ocr-pdf", ".ocr.pdf")
+                    pre_ocr_files[key] = os.path.join(pre_ocr_folder, file)
+
+        jobs = self.find_jobs(pre_ocr_files)
+        if workers > 1:
+            failures = self.run_parallel(jobs, workers, ocr_jobs, timeout)
+        else:
+            prompt = not options.get('no_prompt')
+            failures = self.run_serial(jobs, ocr_jobs, timeout, prompt)
 
         print("Conversion complete!")
 
         if failures:
             print("Failures:")
-            for file in failures:
-                print(file)
+            for file, reason in failures:
+                print(file, "-", reason)
+
+        if failures_report:
+            report = tablib.Dataset(headers=("file", "reason"))
+            for row in failures:
+                report.append(row)
+            with open(failures_report, "w") as f:
+                f.write(report.csv)
+            print(f"Wrote {len(failures)} failures to {failures_report}")
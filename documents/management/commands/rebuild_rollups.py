@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+from django.core.management.base import BaseCommand
+
+from documents.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = """
+    Recompute the per-agency document status rollups from scratch. These
+    are normally kept up to date by signals, but anything that changes
+    documents without firing them (queryset updates, raw SQL, moving a
+    document between agencies) can leave them stale.
+    """
+
+    def handle(self, *args, **options):
+        n_rollups = rebuild_rollups()
+        print(f"Rebuilt {n_rollups} agency status rollups")
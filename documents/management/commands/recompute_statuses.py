@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from documents.models import Agency, Document, ProcessedDocument
+from documents.rollups import rebuild_rollups, refresh_agency_rollups
+from documents.signals import resolve_document_statuses
+from documents.util import status_case
+
+
+class Command(BaseCommand):
+    help = """
+    Re-classify processed documents by filename, in the DB, after changing
+    the status suffix rules in documents/util.py. Like ProcessedDocument.save,
+    this only touches unchecked processed documents unless --force is given.
+    Document statuses and the agency rollups are re-derived afterwards.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true',
+            help=(
+                'Re-classify every processed document. This overwrites '
+                'statuses that were set by hand!'
+            )
+        )
+        parser.add_argument(
+            '--agency', type=str,
+            help='Only re-classify documents for this agency (by name)'
+        )
+
+    def handle(self, *args, **options):
+        pdocs = ProcessedDocument.objects.all()
+        if not options.get('force'):
+            pdocs = pdocs.filter(status="unchecked")
+
+        agency = None
+        document_ids = None
+        if options.get('agency'):
+            agency = Agency.objects.get(name=options['agency'])
+            pdocs = pdocs.filter(document__agency=agency)
+            document_ids = Document.objects.filter(
+                agency=agency
+            ).values_list("pk", flat=True)
+
+        with transaction.atomic():
+            # one UPDATE ... SET status = CASE WHEN file LIKE ... END
+            n_pdocs = pdocs.update(status=status_case("file"))
+            print(f"Re-classified {n_pdocs} processed documents")
+
+            # the update doesn't fire any signals
+            changed_agency_ids = resolve_document_statuses(
+                document_ids, refresh_rollups=False
+            )
+            print(f"Updated document statuses for "
+                  f"{len(changed_agency_ids)} agencies")
+
+        if agency:
+            refresh_agency_rollups([agency.pk])
+        else:
+            n_rollups = rebuild_rollups()
+            print(f"Rebuilt {n_rollups} agency status rollups")
+        print("Done")
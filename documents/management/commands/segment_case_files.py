@@ -1,77 +1,113 @@
 #!/usr/bin/env python
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
-import shutil
+import time
 
 from django.core.management.base import BaseCommand
-from django.conf import settings
-from pdf2image import convert_from_path
+from django.db import connections
 
 from documents.models import Agency, ProcessedDocument
+from documents.pages import (
+    PAGE_THUMBNAIL_WIDTH, cached_page_image, pdf_page_count
+)
+from documents.rollups import refresh_agency_rollups
+
+
+# the sizes the segmentation UI asks for: grid thumbnails and full size
+# pages for the zoom pane
+PRERENDER_WIDTHS = (PAGE_THUMBNAIL_WIDTH, None)
+
+
+def prerender_pdf(pdf_path):
+    """
+    Render every page of a PDF into the page image cache, skipping pages
+    that are already there. Single page documents don't need segmenting,
+    so we only count those. Returns the page count. This runs inside the
+    worker processes, so it must not touch the DB.
+    """
+    page_count = pdf_page_count(pdf_path)
+    if page_count <= 1:
+        return page_count
+    for page in range(page_count):
+        for width in PRERENDER_WIDTHS:
+            cached_page_image(pdf_path, page, width=width)
+    return page_count
 
 
 class Command(BaseCommand):
     help = """
-    Find OCR'd case documents and allow us to segment them into individual
-    cases/incidents. This will skip documents with a single page.
+    Find OCR'd case documents that are ready to be segmented into individual
+    cases/incidents and pre-render their page images, so reviewers don't
+    wait on PDF rendering in the segmentation UI. Page counts get recorded
+    on the processed documents as we go. Already rendered pages are skipped,
+    so this can be stopped and re-run at any time.
     """
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--agency', type=str,
+            help='Only pre-render documents for this agency (by name)'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of documents to render at once'
+        )
+
     def handle(self, *args, **options):
-        pdoc_images = []
-        total_pages = 0
-        for agency in Agency.objects.all():
-            if "Pouls" not in agency.name: continue
-            pdocs = ProcessedDocument.objects.filter(
-                file__endswith=".ocr.pdf",
-                document__agency=agency,
-                document__status__in=[
-                    "awaiting-reading",
-                    "auto-extracted",
-                    "awaiting-extraction",
-                    "case-doc",
-                    "unchecked",
-                ])
-
-            for pdoc in pdocs:
-                if not pdoc.file:
-                    continue
-                if not pdoc.file.path or not os.path.exists(pdoc.file.path):
-                    continue
+        workers = max(1, options.get('workers') or 1)
 
-                print(f"Parsing: {pdoc}")
+        agency = None
+        if options.get('agency'):
+            agency = Agency.objects.get(name=options['agency'])
 
-                pages = convert_from_path(pdoc.file.path, dpi=200)
-                page_count = len(pages)
+        pdocs = []
+        segmentable = ProcessedDocument.objects.segmentable(agency=agency)
+        for pdoc in segmentable.select_related("document"):
+            if not pdoc.file:
+                continue
+            if not pdoc.file.path or not os.path.exists(pdoc.file.path):
+                continue
+            pdocs.append(pdoc)
 
-                pdoc.pages = page_count
-                pdoc.save()
+        print(f"Pre-rendering {len(pdocs)} processed documents "
+              f"with {workers} workers")
 
-                if not page_count or page_count <= 1:
+        total_pages = 0
+        n_rendered = 0
+        # page counts are set with update(), so no signals fire
+        # and we have to refresh these rollups ourselves
+        changed_agency_ids = set()
+        start = time.time()
+
+        # don't hand our DB connection down to the forked workers
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(prerender_pdf, pdoc.file.path): pdoc
+                for pdoc in pdocs
+            }
+            for n_done, future in enumerate(as_completed(futures), start=1):
+                pdoc = futures[future]
+                try:
+                    page_count = future.result()
+                except Exception as e:
+                    print(f"[{n_done}/{len(pdocs)}] FAILED {pdoc}: {e}")
                     continue
 
-                tmpdir = os.path.join(settings.MEDIA_ROOT, "wapd-segment-temp")
-
-                # # clear it (delete all files)
-                # if os.path.exists(tmpdir):
-                #     shutil.rmtree(tmpdir)
-                # os.makedirs(tmpdir)
-
-                img_files = []
-                for idx, page in enumerate(pages):
-                    tmpfile_path = os.path.join(
-                        tmpdir, f"page-{idx}.jpg"
+                if pdoc.pages != page_count:
+                    ProcessedDocument.objects.filter(pk=pdoc.pk).update(
+                        pages=page_count
                     )
-                    page.save(tmpfile_path, "JPEG")
-                    img_files.append(tmpfile_path)
+                    changed_agency_ids.add(pdoc.document.agency_id)
 
-                total_pages += len(img_files)
-                pdoc_images.append({
-                    "id": pdoc.id,
-                    "file": pdoc.file.path,
-                    "pages": img_files
-                })
+                print(f"[{n_done}/{len(pdocs)}] {pdoc} - Pages: {page_count}")
+                if page_count > 1:
+                    n_rendered += 1
+                    total_pages += page_count
 
-                print(f" - Pages: {len(img_files)}")
+        refresh_agency_rollups(changed_agency_ids)
 
-        print(f"Processed Documents: {len(pdoc_images)}")
+        print(f"Processed Documents: {n_rendered}")
         print(f"Total Pages: {total_pages}")
+        print(f"Elapsed: {time.time() - start:.1f}s")
         print("Done")
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.2 on 2026-10-18 14:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0030_auto_20220328_2306'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgencyStatusRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('complete', 'Complete'), ('awaiting-cleaning', 'Awaiting final cleaning'), ('auto-extracted', 'Auto-Extracted CSV'), ('awaiting-csv', 'Awaiting conversion to CSV'), ('awaiting-reading', 'Awaiting reading/processing'), ('awaiting-extraction', 'Awaiting extraction'), ('non-request', 'Misc file/unrelated to response'), ('supporting-document', 'Supporting document (complete)'), ('case-doc', 'Document related to an incident (to be linked/parsed)'), ('extractor', 'Code/script used for processing document'), ('exemption-log', 'Exemption log'), ('unchecked', 'New/Unprocessed')], max_length=30)),
+                ('documents', models.IntegerField(default=0, help_text='Documents with this status')),
+                ('pages', models.IntegerField(default=0, help_text="Pages of OCR'd PDFs belonging to documents with this status")),
+                ('segmentable_pdocs', models.IntegerField(default=0, help_text="OCR'd PDFs belonging to documents with this status")),
+                ('segmented_pdocs', models.IntegerField(default=0, help_text="OCR'd PDFs (as above) that have been split into incidents")),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('agency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_rollups', to='documents.agency')),
+            ],
+            options={
+                'ordering': ('agency', 'status'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='agencystatusrollup',
+            constraint=models.UniqueConstraint(fields=('agency', 'status'), name='unique-agency-status-rollup'),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 3.1.2 on 2026-10-18 14:05
+
+from django.db import migrations
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+
+
+def build_rollups(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    ProcessedDocument = apps.get_model('documents', 'ProcessedDocument')
+    AgencyStatusRollup = apps.get_model('documents', 'AgencyStatusRollup')
+
+    # (agency_id, status) => rollup
+    rollups = {}
+
+    def rollup(agency_id, status):
+        key = (agency_id, status)
+        if key not in rollups:
+            rollups[key] = AgencyStatusRollup(
+                agency_id=agency_id, status=status
+            )
+        return rollups[key]
+
+    doc_counts = Document.objects.filter(
+        agency__isnull=False,
+    ).order_by().values(
+        "agency_id", "status",
+    ).annotate(
+        n_documents=Count("id"),
+    )
+    for row in doc_counts:
+        rollup(row["agency_id"], row["status"]).documents = row["n_documents"]
+
+    pdoc_counts = ProcessedDocument.objects.filter(
+        file__endswith=".ocr.pdf",
+        document__agency__isnull=False,
+    ).order_by().values(
+        agency_id=F("document__agency"),
+        doc_status=F("document__status"),
+    ).annotate(
+        n_pages=Coalesce(Sum("pages"), 0),
+        n_pdocs=Count("id"),
+        n_segmented=Count("id", filter=Q(
+            incident_pgs__isnull=False,
+            incident_pgs__len__gt=0
+        )),
+    )
+    for row in pdoc_counts:
+        r = rollup(row["agency_id"], row["doc_status"])
+        r.pages = row["n_pages"]
+        r.segmentable_pdocs = row["n_pdocs"]
+        r.segmented_pdocs = row["n_segmented"]
+
+    AgencyStatusRollup.objects.bulk_create(rollups.values(), batch_size=1000)
+
+
+def remove_rollups(apps, schema_editor):
+    AgencyStatusRollup = apps.get_model('documents', 'AgencyStatusRollup')
+    AgencyStatusRollup.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0031_agencystatusrollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_rollups, remove_rollups)
+    ]
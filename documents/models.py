@@ -1,16 +1,17 @@
 import os
-import json
 
 from cities.models import City, Subregion
-from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import ArrayField
 from django.db import models
 from markdownfield.models import MarkdownField, RenderedMarkdownField
 from markdownfield.validators import VALIDATOR_STANDARD
-from pdf2image import convert_from_path
 
-from .util import STATUSES, STATUS_NAMES, STATUS_SCORES, document_file_path
+from .pages import cached_page_image, page_image_url, pdf_page_count
+from .util import (
+    STATUS_NAMES, SEGMENTABLE_STATUSES, classify,
+    document_file_path
+)
 
 
 class FieldCategory(models.Model):
@@ -286,6 +287,42 @@ class Document(models.Model):
         return super().save(*args, **kwargs)
 
 
+class ProcessedDocumentQuerySet(models.QuerySet):
+    def segmentable(self, agency=None):
+        """
+        OCR'd PDFs of documents that can be segmented into individual
+        incidents, biggest first. Optionally, only for a single agency.
+        """
+        qs = self.filter(
+            file__endswith=".ocr.pdf",
+            document__status__in=SEGMENTABLE_STATUSES,
+            # pages__gt=1,
+        )
+        if agency is not None:
+            qs = qs.filter(document__agency=agency)
+        return qs.order_by("-pages")
+
+    def segmentation_counts(self):
+        """
+        Count processed documents per agency, in total and by whether
+        they've been segmented into incidents, in a single grouped query.
+        Returns dicts with agency_id, total, segmented and unsegmented.
+        """
+        # NULL and an empty array both mean not segmented. this has to be
+        # spelled out, NOT (array_length(...) > 0) is NULL, not true, for []
+        unsegmented = (
+            models.Q(incident_pgs__isnull=True) | models.Q(incident_pgs=[])
+        )
+        # clear any ordering so it doesn't end up in the GROUP BY
+        return self.order_by().values(
+            agency_id=models.F("document__agency"),
+        ).annotate(
+            total=models.Count("id"),
+            segmented=models.Count("id", filter=~unsegmented),
+            unsegmented=models.Count("id", filter=unsegmented),
+        )
+
+
 class ProcessedDocument(models.Model):
     """
     A processed version of a single file. There is a one-to-one relationship
@@ -359,6 +396,8 @@ class ProcessedDocument(models.Model):
         related_name='processed_documents_updated',
     )
 
+    objects = ProcessedDocumentQuerySet.as_manager()
+
     class Meta:
         constraints = (
             models.UniqueConstraint(
@@ -378,56 +417,44 @@ class ProcessedDocument(models.Model):
         return os.path.basename(self.file.name)
 
     def images(self, overwrite=False):
+        """
+        Render (or look up in the page store) an image of every page of
+        this processed document. Returns [{"page": idx, "url": url}, ...].
+        """
         if not self.file:
             return []
-        if not self.file.path:
+        if not self.file.path or not os.path.exists(self.file.path):
             return []
 
-        pg_filename = "{pdoc_id}-page-{page}.jpg"
-        media_path = "wapd-segment-temp"
-        tmpdir = os.path.join(settings.MEDIA_ROOT, media_path)
-        json_filename = os.path.join(tmpdir, f"{self.pk}-pages.json")
-
-        if not overwrite and os.path.exists(json_filename):
-            print(f"Not overwriting existing pdoc ({self}) images")
-            with open(json_filename, "r") as f:
-                return json.load(f)
-
         print(f"Parsing: {self}")
 
-        pages = convert_from_path(self.file.path, dpi=200)
-
-        page_count = len(pages)
+        page_count = pdf_page_count(self.file.path)
         if not page_count:
             return []
 
-        if not os.path.exists(tmpdir):
-            os.makedirs(tmpdir)
-
+        if self.pages != page_count:
+            # models is imported by rollups
+            from .rollups import document_rollup_changes
+            # don't fire the save signals just for a page count, but the
+            # page totals in the rollups still need updating
+            with document_rollup_changes([self.document_id]):
+                ProcessedDocument.objects.filter(pk=self.pk).update(
+                    pages=page_count
+                )
+            self.pages = page_count
+
+        # render one page at a time, straight to disk, so memory use
+        # doesn't grow with the size of the document
         img_files = []
-        total_pages = 0
-        for idx, page in enumerate(pages):
-            filename = pg_filename.format(
-                pdoc_id=self.pk, page=idx
-            )
-            tmpfile_path = os.path.join(
-                tmpdir, filename
+        for idx in range(page_count):
+            image_path = cached_page_image(
+                self.file.path, idx, overwrite=overwrite
             )
-
-            if not overwrite and os.path.exists(tmpfile_path):
-                print(f"Not overwriting existing page ({idx})")
-                continue
-
-            page.save(tmpfile_path, "JPEG")
-            url = os.path.join(settings.MEDIA_URL, media_path, filename)
             img_files.append({
                 "page": idx,
-                "url": url,
+                "url": page_image_url(image_path),
             })
 
-        with open(json_filename, "w") as f:
-            f.write(json.dumps(img_files))
-
         if len(img_files) >= 2:
             print(f"Pages: {len(img_files)}")
 
@@ -443,10 +470,7 @@ class ProcessedDocument(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.status or self.status == "unchecked":
-            for status, test_fn in STATUSES.items():
-                if test_fn(self.file.name):
-                    self.status = status
-                    break
+            self.status = classify(self.file.name)
         return super().save(*args, **kwargs)
 
 
@@ -530,3 +554,78 @@ class SyntheticDocument(models.Model):
         else:
             text += "(no source documents)"
         return text
+
+
+class AgencyStatusRollupQuerySet(models.QuerySet):
+    def segmentation_counts(self):
+        """
+        Per-agency counts of segmentable processed documents, in total and
+        by whether they've been segmented into incidents. Same output as
+        ProcessedDocumentQuerySet.segmentation_counts, without touching
+        the documents tables.
+        """
+        return self.filter(
+            status__in=SEGMENTABLE_STATUSES,
+            segmentable_pdocs__gt=0,
+        ).order_by().values(
+            "agency_id",
+        ).annotate(
+            total=models.Sum("segmentable_pdocs"),
+            segmented=models.Sum("segmented_pdocs"),
+            unsegmented=(
+                models.Sum("segmentable_pdocs") - models.Sum("segmented_pdocs")
+            ),
+        )
+
+
+class AgencyStatusRollup(models.Model):
+    """
+    Per-agency counts of documents (and their OCR'd PDFs) by document
+    status. This is a denormalized copy of what's in the Document and
+    ProcessedDocument tables so dashboards and exporters don't need to
+    scan every document. It's kept up to date by the signals in
+    documents/signals.py and can be rebuilt with the rebuild_rollups
+    mgmt command.
+    """
+    agency = models.ForeignKey(
+        Agency, on_delete=models.CASCADE,
+        related_name="status_rollups",
+    )
+
+    status = models.CharField(
+        max_length=30,
+        choices=STATUS_NAMES,
+    )
+
+    documents = models.IntegerField(
+        default=0,
+        help_text="Documents with this status"
+    )
+    pages = models.IntegerField(
+        default=0,
+        help_text="Pages of OCR'd PDFs belonging to documents with this status"
+    )
+    segmentable_pdocs = models.IntegerField(
+        default=0,
+        help_text="OCR'd PDFs belonging to documents with this status"
+    )
+    segmented_pdocs = models.IntegerField(
+        default=0,
+        help_text="OCR'd PDFs (as above) that have been split into incidents"
+    )
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = AgencyStatusRollupQuerySet.as_manager()
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=('agency', 'status'),
+                name='unique-agency-status-rollup'
+            ),
+        )
+        ordering = ('agency', 'status')
+
+    def __str__(self):
+        return f"{self.agency_id} {self.status}: {self.documents}"
@@ -0,0 +1,216 @@
+import os
+import time
+import uuid
+
+from django.conf import settings
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+from .util import file_sha256
+
+
+# resolution we render page images at for segmentation
+PAGE_DPI = 200
+# widths (px) we'll render page images at via ?w=, no width means full size
+PAGE_IMAGE_WIDTHS = (160, 320, 640, 1280)
+# width of the page grid images in the segmentation UI
+PAGE_THUMBNAIL_WIDTH = 320
+
+# Rendered page images are stored by the content hash of the PDF they came
+# from, so they're shared by everything that renders pages (views, models,
+# mgmt commands) and by every processed document pointing at the same
+# file. Layout: PAGE_CACHE_DIR/<hash[:2]>/<hash>/<page>-<dpi>-<width>.jpg
+PAGE_CACHE_DIR = os.path.join(settings.MEDIA_ROOT, "page-cache")
+# once the store grows past this, least recently used pages get evicted.
+# that's done by the gc_page_cache command (run it from cron), never while
+# rendering, so page loads don't pay for walking the whole store
+PAGE_CACHE_MAX_BYTES = getattr(
+    settings, "PAGE_CACHE_MAX_BYTES", 20 * 1024 * 1024 * 1024
+)
+
+
+def pdf_page_count(pdf_path):
+    """
+    Number of pages in a PDF, without rendering any of them.
+    """
+    return pdfinfo_from_path(pdf_path)["Pages"]
+
+
+def render_page(pdf_path, page, output_path, dpi=PAGE_DPI, width=None):
+    """
+    Render a single page (zero indexed) of a PDF to a JPEG at output_path,
+    which must end in .jpg. Optionally, scale the page to the given width
+    in pixels (keeping the aspect ratio).
+
+    pdftoppm writes the image straight to disk, so the page is never
+    decoded into memory on our side. Rendering a whole document this way,
+    page by page, keeps memory use flat regardless of the page count.
+    """
+    output_folder, filename = os.path.split(output_path)
+    output_file, ext = os.path.splitext(filename)
+    assert ext == ".jpg", f"Page images must be .jpg, got: {output_path}"
+
+    kwargs = {}
+    if width:
+        kwargs["size"] = (width, None)
+
+    paths = convert_from_path(
+        pdf_path,
+        dpi=dpi,
+        first_page=page + 1,
+        last_page=page + 1,
+        output_folder=output_folder,
+        output_file=output_file,
+        single_file=True,
+        fmt="jpeg",
+        paths_only=True,
+        **kwargs
+    )
+    if not paths:
+        return None
+    return paths[0]
+
+
+def page_image_path(file_hash, page, dpi=PAGE_DPI, width=None):
+    size = width or "full"
+    return os.path.join(
+        PAGE_CACHE_DIR, file_hash[:2], file_hash, f"{page}-{dpi}-{size}.jpg"
+    )
+
+
+def page_image_url(image_path):
+    relpath = os.path.relpath(image_path, settings.MEDIA_ROOT)
+    return os.path.join(settings.MEDIA_URL, relpath)
+
+
+def cached_page_image(pdf_path, page, dpi=PAGE_DPI, width=None,
+                      overwrite=False):
+    """
+    Return the path to a JPEG of a single page (zero indexed) of a PDF,
+    rendering it into the page store only if it isn't already there.
+
+    Pages are rendered to a temp file and moved into place, so concurrent
+    renders of the same page (two reviewers, or a view racing the
+    pre-render command) never see a partial image.
+    """
+    output_path = page_image_path(
+        file_sha256(pdf_path), page, dpi=dpi, width=width
+    )
+    if not overwrite and os.path.exists(output_path):
+        try:
+            # the mtime is our LRU clock
+            os.utime(output_path)
+            return output_path
+        except FileNotFoundError:
+            # evicted out from under us, render it again
+            pass
+
+    output_folder = os.path.dirname(output_path)
+    os.makedirs(output_folder, exist_ok=True)
+    tmp_path = os.path.join(output_folder, f".{uuid.uuid4().hex}.tmp.jpg")
+    try:
+        if not render_page(pdf_path, page, tmp_path, dpi=dpi, width=width):
+            return None
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return output_path
+
+
+def page_store_files():
+    """
+    Yield (path, size, mtime) for every file in the page store.
+    """
+    for basedir, _, files in os.walk(PAGE_CACHE_DIR):
+        for name in files:
+            path = os.path.join(basedir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+
+def is_tmp_file(path):
+    return os.path.basename(path).endswith(".tmp.jpg")
+
+
+def evict_page_images(max_bytes=PAGE_CACHE_MAX_BYTES):
+    """
+    Delete least recently used page images until the page store is under
+    max_bytes. Returns (files removed, bytes removed).
+    """
+    images = [f for f in page_store_files() if not is_tmp_file(f[0])]
+    total_bytes = sum(size for _, size, _ in images)
+    n_removed = 0
+    bytes_removed = 0
+    # oldest first
+    for path, size, _ in sorted(images, key=lambda f: f[2]):
+        if total_bytes - bytes_removed <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        n_removed += 1
+        bytes_removed += size
+    return n_removed, bytes_removed
+
+
+def stored_page_hashes():
+    """
+    All the PDF hashes we have page images stored for.
+    """
+    if not os.path.isdir(PAGE_CACHE_DIR):
+        return []
+    hashes = []
+    for prefix in os.listdir(PAGE_CACHE_DIR):
+        prefix_dir = os.path.join(PAGE_CACHE_DIR, prefix)
+        if os.path.isdir(prefix_dir):
+            hashes += os.listdir(prefix_dir)
+    return hashes
+
+
+def remove_page_images(file_hash):
+    """
+    Delete every stored page image for a given PDF hash.
+    Returns (files removed, bytes removed).
+    """
+    n_removed = 0
+    bytes_removed = 0
+    hash_dir = os.path.dirname(page_image_path(file_hash, 0))
+    if not os.path.isdir(hash_dir):
+        return n_removed, bytes_removed
+    for name in os.listdir(hash_dir):
+        path = os.path.join(hash_dir, name)
+        try:
+            bytes_removed += os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        n_removed += 1
+    try:
+        os.rmdir(hash_dir)
+    except OSError:
+        # a render just put a new page in here (or another GC run
+        # removed it first), leave it be
+        pass
+    return n_removed, bytes_removed
+
+
+def remove_stale_tmp_files(max_age=60 * 60):
+    """
+    Clean up temp files left behind by renders that were killed partway
+    through. Returns the number of files removed.
+    """
+    n_removed = 0
+    now = time.time()
+    for path, _, mtime in page_store_files():
+        if not is_tmp_file(path) or now - mtime < max_age:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        n_removed += 1
+    return n_removed
@@ -1,30 +1,253 @@
+import atexit
+import json
 import os
+import queue
 import subprocess
+import threading
+import time
+
+from django.conf import settings
+from pdf2image import pdfinfo_from_path
+
+from .util import file_sha256
 
 
 # Don't steal focus while PDF->Texting
 os.environ["JAVA_TOOL_OPTIONS"] = "-Djava.awt.headless=true"
 
 
+PDF_TO_TEXT_JAR = "../pdf_to_text_snowtide/target/PDFtoTextSnowtide-uber.jar"
+PDF_TO_TEXT_THRESHOLD = "0.5"
+
 DOCUMENT_TEXT_PROG = lambda inp_file: [
     "java",
     "-jar",
-    "../pdf_to_text_snowtide/target/PDFtoTextSnowtide-uber.jar",
+    PDF_TO_TEXT_JAR,
     inp_file,
-    "0.5"
+    PDF_TO_TEXT_THRESHOLD,
 ]
 
+# Long-running mode, for a jar that implements it. Instead of paying JVM
+# startup for every PDF (or every page range of a PDF), we keep one JVM
+# around and feed it jobs over stdin/stdout. The protocol is:
+#
+#   server -> client, once on startup:  READY\n
+#   client -> server, one per job:      {"file": ..., "pages": ..., "threshold": ...}\n
+#   server -> client, one per job:      OK <n_bytes>\n<n_bytes of UTF-8 text>
+#                                   or  ERR <n_bytes>\n<n_bytes of error message>
+#
+# The bundled jar doesn't, so this is off unless settings.PDF_TO_TEXT_SERVER_JAR
+# points at one that does. If the handshake fails we fall back to launching
+# a JVM per call like we always have.
+DOCUMENT_TEXT_SERVER_PROG = lambda jar: [
+    "java",
+    "-jar",
+    jar,
+    "--server",
+]
 
-def pdf2text(filepath, pages=None):
+SERVER_STARTUP_TIMEOUT = 60
+# longest we'll wait on a single job before giving up on the server
+SERVER_JOB_TIMEOUT = 600
+
+# what the extractor puts at the end of every page
+PAGE_DELIMITER = "\f"
+
+# whole document and per-page text, keyed by PDF content hash. see
+# cached_pdf2pages. bump the version when the format changes
+TEXT_CACHE_DIR = os.path.join(settings.MEDIA_ROOT, "text-cache")
+TEXT_CACHE_VERSION = 2
+
+
+class PDFTextServerError(Exception):
     """
-    Convert a PDF, by path, to text. Optionally, only grab a subset of
-    pages. Pages is a list of [start, end], zero indexed and inclusive.
+    The extraction server died or said something we didn't understand.
+    This is different from a PDF failing to extract, which the server
+    reports back to us and we treat the same as a bad return code.
     """
-    args = DOCUMENT_TEXT_PROG(filepath)
+    pass
+
+
+class PDFTextServer:
+    """
+    A warm JVM running the PDF to text jar in server mode. One job is
+    in flight at a time, so this is safe to share between threads.
+
+    The server's stdout is drained by a reader thread into a queue, so
+    every read has a real timeout, even if the server hangs mid-line.
+    """
+    def __init__(self, args, startup_timeout=SERVER_STARTUP_TIMEOUT,
+                 job_timeout=SERVER_JOB_TIMEOUT):
+        self.args = args
+        self.startup_timeout = startup_timeout
+        self.job_timeout = job_timeout
+        self.proc = None
+        self.lock = threading.Lock()
+        self.output = None
+        self.buffer = b""
+
+    def start(self):
+        try:
+            self.proc = subprocess.Popen(
+                self.args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        except OSError as e:
+            raise PDFTextServerError(f"Couldn't start server: {e}")
+
+        self.output = queue.Queue()
+        self.buffer = b""
+        reader = threading.Thread(
+            target=self._read_stdout,
+            args=(self.proc.stdout, self.output),
+            daemon=True,
+        )
+        reader.start()
+
+        try:
+            line = self._readline(time.monotonic() + self.startup_timeout)
+        except PDFTextServerError as e:
+            self.close()
+            raise PDFTextServerError(f"Bad handshake from server: {e}")
+        if line.strip() != b"READY":
+            self.close()
+            raise PDFTextServerError(f"Bad handshake from server: {line!r}")
+
+    @staticmethod
+    def _read_stdout(stdout, output):
+        # raw reads on the fd, an empty chunk means EOF
+        fd = stdout.fileno()
+        while True:
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError:
+                chunk = b""
+            output.put(chunk)
+            if not chunk:
+                return
+
+    def _fill(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise PDFTextServerError("Timed out waiting on server")
+        try:
+            chunk = self.output.get(timeout=remaining)
+        except queue.Empty:
+            raise PDFTextServerError("Timed out waiting on server")
+        if not chunk:
+            raise PDFTextServerError("Server closed its output")
+        self.buffer += chunk
+
+    def _readline(self, deadline):
+        while b"\n" not in self.buffer:
+            self._fill(deadline)
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line + b"\n"
+
+    def _read(self, n_bytes, deadline):
+        while len(self.buffer) < n_bytes:
+            self._fill(deadline)
+        data = self.buffer[:n_bytes]
+        self.buffer = self.buffer[n_bytes:]
+        return data
+
+    def extract(self, filepath, pages=None):
+        job = {
+            "file": os.path.abspath(filepath),
+            "threshold": PDF_TO_TEXT_THRESHOLD,
+        }
+        if pages:
+            job["pages"] = pages
+
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                raise PDFTextServerError("Server isn't running")
+            deadline = time.monotonic() + self.job_timeout
+            try:
+                self.proc.stdin.write(json.dumps(job).encode("utf-8") + b"\n")
+                self.proc.stdin.flush()
+                header = self._readline(deadline).decode("utf-8").split()
+                if len(header) != 2 or header[0] not in ("OK", "ERR"):
+                    raise PDFTextServerError(f"Bad response header: {header}")
+                body = self._read(int(header[1]), deadline)
+            except (OSError, ValueError) as e:
+                raise PDFTextServerError(f"Server communication failed: {e}")
+
+        if header[0] == "ERR":
+            print("PDF to text server error:", body.decode("utf-8", "replace"))
+            print("PDF File:", filepath)
+            return None
+        return body.decode("utf-8")
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+        self.proc = None
+
+
+# one server per process, so forked workers get their own JVM
+_server = None
+_server_pid = None
+_server_failed = False
+_server_lock = threading.Lock()
+
+
+def get_server():
+    """
+    Return the running extraction server for this process, starting it if
+    necessary. Returns None if server mode isn't configured (see
+    settings.PDF_TO_TEXT_SERVER_JAR) or the server is unavailable.
+    """
+    global _server, _server_pid, _server_failed
+    server_jar = getattr(settings, "PDF_TO_TEXT_SERVER_JAR", None)
+    if not server_jar or _server_failed:
+        return None
+    with _server_lock:
+        if _server is not None and _server_pid == os.getpid():
+            return _server
+        server = PDFTextServer(DOCUMENT_TEXT_SERVER_PROG(server_jar))
+        try:
+            server.start()
+        except PDFTextServerError as e:
+            print("PDF to text server unavailable, using subprocess mode:", e)
+            _server_failed = True
+            return None
+        _server = server
+        _server_pid = os.getpid()
+        return _server
+
+
+@atexit.register
+def shutdown_server():
+    global _server
+    if _server is not None and _server_pid == os.getpid():
+        _server.close()
+    _server = None
+
+
+def pages_arg(pages):
     if isinstance(pages, str):
+        return pages
+    elif isinstance(pages, (list, tuple)):
+        return "-".join([str(p) for p in pages])
+    return None
+
+
+def pdf2text_subprocess(filepath, pages=None):
+    """
+    Convert a PDF to text by launching a fresh JVM. This is the fallback
+    when the extraction server isn't available.
+    """
+    args = DOCUMENT_TEXT_PROG(filepath)
+    if pages:
         args.append(pages)
-    elif isinstance(pages, list):
-        args.append("-".join([str(p) for p in pages]))
 
     # print("Extracting using args:", args)
     result = subprocess.run(
@@ -42,3 +265,121 @@ def pdf2text(filepath, pages=None):
     if isinstance(text, bytes):
         return text.decode("utf-8")
     return text
+
+
+def pdf2text(filepath, pages=None):
+    """
+    Convert a PDF, by path, to text. Optionally, only grab a subset of
+    pages. Pages is a list of [start, end], zero indexed and inclusive.
+
+    This uses the long-running extraction server when one is configured
+    and falls back to running the jar once per call otherwise.
+    """
+    global _server_failed
+    pages = pages_arg(pages)
+
+    server = get_server()
+    if server is not None:
+        try:
+            return server.extract(filepath, pages=pages)
+        except PDFTextServerError as e:
+            print("PDF to text server failed, using subprocess mode:", e)
+            _server_failed = True
+            shutdown_server()
+
+    return pdf2text_subprocess(filepath, pages=pages)
+
+
+def split_pages(text):
+    """
+    Split a whole document's text on the extractor's page delimiters. Each
+    page keeps the delimiter that ends it, so join_pages(split_pages(text))
+    is exactly text.
+    """
+    parts = text.split(PAGE_DELIMITER)
+    pages = [f"{part}{PAGE_DELIMITER}" for part in parts[:-1]]
+    if parts[-1]:
+        pages.append(parts[-1])
+    return pages
+
+
+def pdf2pages(filepath):
+    """
+    Convert a PDF to its whole text plus a list of text, one entry per page
+    (zero indexed). This is one extraction of the whole document, split on
+    the page delimiters. If that doesn't come out to one entry per page,
+    we only extract page by page when the extraction server is up, it'd
+    be a JVM launch per page otherwise. Returns (text, pages), pages is None
+    if we couldn't split the text (see pdf2segment) and both are None if
+    the extraction failed.
+    """
+    text = pdf2text(filepath)
+    if text is None:
+        return None, None
+
+    n_pages = pdfinfo_from_path(filepath)["Pages"]
+    pages = split_pages(text)
+    if len(pages) == n_pages:
+        return text, pages
+
+    if get_server() is None:
+        return text, None
+
+    pages = []
+    for page in range(n_pages):
+        page_text = pdf2text(filepath, pages=[page, page])
+        if page_text is None:
+            return text, None
+        pages.append(page_text)
+    return text, pages
+
+
+def cached_pdf2pages(filepath):
+    """
+    Same as pdf2pages, but the text is stored on disk by the content hash
+    of the PDF, so a given file is only ever parsed once no matter how many
+    times (or how) it gets segmented.
+    """
+    cache_file = os.path.join(
+        TEXT_CACHE_DIR,
+        f"{file_sha256(filepath)}.v{TEXT_CACHE_VERSION}.json"
+    )
+    if os.path.exists(cache_file):
+        with open(cache_file, "r") as f:
+            cached = json.load(f)
+        return cached["text"], cached["pages"]
+
+    text, pages = pdf2pages(filepath)
+    if text is None:
+        return None, None
+
+    os.makedirs(TEXT_CACHE_DIR, exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(json.dumps({"text": text, "pages": pages}))
+    os.replace(tmp_file, cache_file)
+    return text, pages
+
+
+def join_pages(pages, page_range=None):
+    """
+    Assemble text from a list of page texts. Page range is [start, end],
+    zero indexed and inclusive, same as pdf2text.
+    """
+    if pages is None:
+        return None
+    if page_range:
+        start, end = page_range
+        pages = pages[start:end + 1]
+    return "".join(pages)
+
+
+def pdf2segment(filepath, pages, page_range):
+    """
+    The text of a range of pages of a PDF, out of its pages (from
+    cached_pdf2pages) when we have them. Otherwise this extracts just the
+    range, like we used to for every segment.
+    """
+    if pages is None:
+        return pdf2text(filepath, pages=page_range)
+    return join_pages(pages, page_range)
@@ -0,0 +1,195 @@
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Agency, AgencyStatusRollup, Document, ProcessedDocument
+
+
+def build_rollups(agency_ids):
+    """
+    Count up the documents for a set of agencies, by status, and return
+    (unsaved) AgencyStatusRollup objects. This is two grouped queries no
+    matter how many agencies or documents there are.
+    """
+    # (agency_id, status) => rollup
+    rollups = {}
+
+    def rollup(agency_id, status):
+        key = (agency_id, status)
+        if key not in rollups:
+            rollups[key] = AgencyStatusRollup(
+                agency_id=agency_id, status=status
+            )
+        return rollups[key]
+
+    doc_counts = Document.objects.filter(
+        agency_id__in=agency_ids,
+    ).order_by().values(
+        "agency_id", "status",
+    ).annotate(
+        n_documents=Count("id"),
+    )
+    for row in doc_counts:
+        rollup(row["agency_id"], row["status"]).documents = row["n_documents"]
+
+    pdoc_counts = ProcessedDocument.objects.filter(
+        file__endswith=".ocr.pdf",
+        document__agency_id__in=agency_ids,
+    ).order_by().values(
+        agency_id=F("document__agency"),
+        doc_status=F("document__status"),
+    ).annotate(
+        n_pages=Coalesce(Sum("pages"), 0),
+        n_pdocs=Count("id"),
+        n_segmented=Count("id", filter=Q(
+            incident_pgs__isnull=False,
+            incident_pgs__len__gt=0
+        )),
+    )
+    for row in pdoc_counts:
+        r = rollup(row["agency_id"], row["doc_status"])
+        r.pages = row["n_pages"]
+        r.segmentable_pdocs = row["n_pdocs"]
+        r.segmented_pdocs = row["n_segmented"]
+
+    return list(rollups.values())
+
+
+# rollup fields a single document adds to its (agency, status) row
+ROLLUP_FIELDS = ("documents", "pages", "segmentable_pdocs", "segmented_pdocs")
+
+
+def lock_agencies(agency_ids):
+    """
+    Lock the given agencies' rows until the end of the transaction, so
+    only one writer at a time touches their rollups. Without this, two
+    concurrent refreshes can both delete and then both insert the same
+    (agency, status) rows. Always locks in ID order, to avoid deadlocks.
+    """
+    list(Agency.objects.select_for_update().filter(
+        pk__in=agency_ids
+    ).order_by("pk").values_list("pk", flat=True))
+
+
+def refresh_agency_rollups(agency_ids):
+    """
+    Recompute the status rollups for the given agencies (IDs) and replace
+    the stored ones.
+    """
+    agency_ids = set(a for a in agency_ids if a is not None)
+    if not agency_ids:
+        return
+    with transaction.atomic():
+        lock_agencies(agency_ids)
+        rollups = build_rollups(agency_ids)
+        AgencyStatusRollup.objects.filter(agency_id__in=agency_ids).delete()
+        AgencyStatusRollup.objects.bulk_create(rollups)
+
+
+def rebuild_rollups():
+    """
+    Recompute the status rollups for every agency.
+    """
+    with transaction.atomic():
+        agency_ids = list(Agency.objects.values_list("id", flat=True))
+        lock_agencies(agency_ids)
+        rollups = build_rollups(agency_ids)
+        AgencyStatusRollup.objects.all().delete()
+        AgencyStatusRollup.objects.bulk_create(rollups, batch_size=1000)
+    return len(rollups)
+
+
+def document_rollup(document_id):
+    """
+    What a single document adds to its agency's rollups, going by what's
+    in the DB right now: (agency ID, status, {field: amount}), or None if
+    it doesn't count towards any (it doesn't exist or has no agency).
+    """
+    if document_id is None:
+        return None
+    ocr = Q(processeddocument__file__endswith=".ocr.pdf")
+    segmented = Q(
+        processeddocument__incident_pgs__isnull=False,
+        processeddocument__incident_pgs__len__gt=0,
+    )
+    row = next(iter(Document.objects.filter(
+        pk=document_id,
+        agency__isnull=False,
+    ).order_by().values(
+        "agency_id", "status",
+    ).annotate(
+        pages=Coalesce(Sum("processeddocument__pages", filter=ocr), 0),
+        segmentable_pdocs=Count("processeddocument", filter=ocr),
+        segmented_pdocs=Count(
+            "processeddocument", filter=ocr & segmented
+        ),
+    )), None)
+    if row is None:
+        return None
+    counts = {field: row[field] for field in ROLLUP_FIELDS[1:]}
+    counts["documents"] = 1
+    return row["agency_id"], row["status"], counts
+
+
+def apply_rollup_deltas(before, after):
+    """
+    Update the stored rollups by the difference between documents'
+    contributions (see document_rollup) before and after a change, instead
+    of recounting their agencies. before and after are lists, entries can
+    be None.
+    """
+    # (agency_id, status) => {field: change}
+    deltas = {}
+    for contributions, sign in ((before, -1), (after, 1)):
+        for contribution in contributions:
+            if contribution is None:
+                continue
+            agency_id, status, counts = contribution
+            delta = deltas.setdefault((agency_id, status), {})
+            for field, amount in counts.items():
+                delta[field] = delta.get(field, 0) + sign * amount
+
+    deltas = {
+        key: {field: n for field, n in delta.items() if n}
+        for key, delta in deltas.items()
+    }
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    with transaction.atomic():
+        lock_agencies(set(agency_id for agency_id, _ in deltas))
+        for (agency_id, status), delta in sorted(deltas.items()):
+            n_updated = AgencyStatusRollup.objects.filter(
+                agency_id=agency_id, status=status,
+            ).update(**{
+                field: F(field) + amount for field, amount in delta.items()
+            })
+            if n_updated:
+                continue
+            # there's nothing to take away from a missing row (e.g. its
+            # agency is being deleted), rebuild_rollups fixes any drift
+            if any(amount < 0 for amount in delta.values()):
+                continue
+            # we hold the agency lock, so nobody else can create it
+            AgencyStatusRollup.objects.create(
+                agency_id=agency_id, status=status, **delta
+            )
+
+
+@contextmanager
+def document_rollup_changes(document_ids):
+    """
+    Keep the rollups in sync with changes to documents (or their processed
+    documents) made with QuerySet.update(), which fires no signals:
+
+        with document_rollup_changes([pdoc.document_id]):
+            ProcessedDocument.objects.filter(pk=pdoc.pk).update(pages=10)
+    """
+    document_ids = set(d for d in document_ids if d is not None)
+    before = [document_rollup(d) for d in document_ids]
+    yield
+    after = [document_rollup(d) for d in document_ids]
+    apply_rollup_deltas(before, after)
@@ -0,0 +1,130 @@
+from collections import namedtuple
+import hashlib
+import json
+import os
+
+
+# bump this when the manifest format changes, old manifests get ignored
+SCAN_MANIFEST_VERSION = 1
+
+# path is relative to the directory being scanned
+ScannedFile = namedtuple("ScannedFile", ("path", "size", "mtime", "inode"))
+
+
+def scan_dir(dirpath, manifest=None, new_manifest=None):
+    """
+    List the files and subdirectories of a single directory, stat'ing each
+    file once. If the manifest has an entry for this directory with the same
+    mtime, nothing was added, removed or renamed in it since the last scan,
+    so we use that instead of listing it again. The entry we used (or made)
+    gets added to new_manifest. Returns ([(name, size, mtime, inode)], [subdir
+    names]).
+
+    NOTE: a file overwritten in place doesn't change its directory's mtime,
+    so its size/mtime can be stale until something else in the directory
+    changes. Scan without a manifest (e.g. import_safe --full-scan) to
+    pick those up.
+    """
+    if manifest is None:
+        manifest = {}
+    dir_mtime = os.stat(dirpath).st_mtime_ns
+    entry = manifest.get(dirpath)
+    if not entry or entry["mtime"] != dir_mtime:
+        files = []
+        subdirs = []
+        with os.scandir(dirpath) as it:
+            for dir_entry in it:
+                # like os.walk, don't follow symlinked directories
+                if dir_entry.is_dir():
+                    if not dir_entry.is_symlink():
+                        subdirs.append(dir_entry.name)
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((
+                    dir_entry.name, stat.st_size, stat.st_mtime,
+                    dir_entry.inode()
+                ))
+        entry = {
+            "mtime": dir_mtime,
+            "files": sorted(files),
+            "dirs": sorted(subdirs),
+        }
+    if new_manifest is not None:
+        new_manifest[dirpath] = entry
+    return entry["files"], entry["dirs"]
+
+
+def scan_tree(root, manifest=None, new_manifest=None):
+    """
+    Recursively scan a directory tree in one pass. Returns a list of
+    ScannedFiles with paths relative to root. Only directories whose mtime
+    changed since the manifest was written get listed again.
+    """
+    scanned = []
+    # (absolute dir, dir relative to root)
+    pending = [(root, "")]
+    while pending:
+        dirpath, reldir = pending.pop()
+        try:
+            files, subdirs = scan_dir(
+                dirpath, manifest=manifest, new_manifest=new_manifest
+            )
+        except FileNotFoundError:
+            continue
+        for name, size, mtime, inode in files:
+            scanned.append(ScannedFile(
+                os.path.join(reldir, name), size, mtime, inode
+            ))
+        for name in subdirs:
+            pending.append((
+                os.path.join(dirpath, name), os.path.join(reldir, name)
+            ))
+    return scanned
+
+
+def tree_signature(scanned):
+    """
+    A hash of every path, size and mtime in a scanned tree. If it's the same
+    as last time, nothing in the tree changed.
+    """
+    digest = hashlib.sha256()
+    for f in sorted(scanned):
+        digest.update(f"{f.path}\0{f.size}\0{f.mtime}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_scan_manifest(path, section="dirs"):
+    """
+    Load a manifest written by save_scan_manifest. Missing, unreadable or
+    out of date manifests just mean everything gets scanned. Commands can
+    keep their own data in other sections of the manifest.
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable scan manifest {path}: {e}")
+        return {}
+    if data.get("version") != SCAN_MANIFEST_VERSION:
+        return {}
+    return data.get(section, {})
+
+
+def save_scan_manifest(path, manifest, **sections):
+    """
+    Write a scan manifest, plus any other sections, atomically, so an
+    interrupted run never leaves a truncated one behind.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({
+            "version": SCAN_MANIFEST_VERSION,
+            "dirs": manifest,
+            **sections,
+        }, f)
+    os.replace(tmp_path, path)
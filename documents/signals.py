@@ -1,73 +1,331 @@
-from django.db.models.signals import post_save
+from contextlib import contextmanager
+import sys
+import threading
+
+from django.db import transaction
+from django.db.models import Case, Exists, IntegerField, Min, OuterRef, Q, Value, When
+from django.db.models.signals import (
+    post_delete, post_save, pre_delete, pre_save
+)
 from django.dispatch import receiver
 
-from .util import STATUS_SCORES
+from .util import STATUS_KEYS, STATUS_SCORES
 from .models import Document, ProcessedDocument, SyntheticDocument
+from .rollups import (
+    apply_rollup_deltas, document_rollup, refresh_agency_rollups
+)
 
 
-def update_doc_status(document):
+# once a document is set to one of these, its processed documents
+# don't change its status anymore
+LOCKED_STATUSES = [
+    "complete", "case-doc", "supporting-document", "non-request",
+]
+
+
+def status_score(field="status"):
     """
-    Keep a document's status in sync with its most processed document.
+    A CASE expression ranking a status field by STATUS_SCORES, so the
+    best (most complete) status can be found with Min().
     """
-    # don't update if we've set to one of these
-    if document.status in ["complete", "case-doc",
-                           "supporting-document", "non-request"]:
-        return
+    return Case(
+        *[When(**{field: st}, then=Value(score))
+          for st, score in STATUS_SCORES.items()],
+        default=Value(STATUS_SCORES["unchecked"]),
+        output_field=IntegerField(),
+    )
+
+
+def resolve_document_statuses(document_ids=None, refresh_rollups=True):
+    """
+    Set each document's status to the most complete status of its processed
+    documents, or to complete if it belongs to a completed synthetic document.
+    This is the set-based version of update_doc_status: it finds the best
+    status for every given document (all documents if None) in one grouped
+    query and writes any changes with a single UPDATE. Returns the IDs of
+    the agencies whose documents changed.
+    """
+    documents = Document.objects.exclude(
+        status__in=LOCKED_STATUSES,
+    ).exclude(
+        # these are always complete, see Document.save
+        no_new_records=True,
+    )
+    if document_ids is not None:
+        document_ids = set(d for d in document_ids if d is not None)
+        if not document_ids:
+            return set()
+        documents = documents.filter(pk__in=document_ids)
+
+    completed_synthetic = SyntheticDocument.objects.filter(
+        documents=OuterRef("pk"),
+        completed=True,
+    )
+    rows = documents.order_by().annotate(
+        # without the filter, the CASE turns the NULL row of a document
+        # with no processed documents into an unchecked one
+        best_score=Min(
+            status_score("processeddocument__status"),
+            filter=Q(processeddocument__isnull=False),
+        ),
+        synthetic_complete=Exists(completed_synthetic),
+    ).values_list(
+        "pk", "agency_id", "status", "best_score", "synthetic_complete",
+    )
 
-    for syndoc in document.syntheticdocument_set.all():
-        if not syndoc.completed:
+    # new status => [document_id, ...]
+    changes = {}
+    agency_ids = set()
+    for pk, agency_id, status, best_score, synthetic_complete in rows:
+        if synthetic_complete:
+            new_status = "complete"
+        elif best_score is None:
+            # no processed documents, nothing to go on
+            continue
+        else:
+            new_status = STATUS_KEYS[best_score]
+        if new_status == status:
             continue
-        document.status = "complete"
-        document.save()
+        changes.setdefault(new_status, []).append(pk)
+        agency_ids.add(agency_id)
+
+    if not changes:
+        return agency_ids
+
+    changed_ids = [pk for pks in changes.values() for pk in pks]
+    # update() doesn't fire post_save, so this can't cascade
+    Document.objects.filter(pk__in=changed_ids).update(status=Case(
+        *[When(pk__in=pks, then=Value(st)) for st, pks in changes.items()],
+        default="status",
+    ))
+    if refresh_rollups:
+        refresh_agency_rollups(agency_ids)
+    return agency_ids
+
+
+def complete_synthetic_dependents(syn_document):
+    """
+    Mark every document a completed synthetic document was built from,
+    directly or through its processed documents, complete. Returns the IDs
+    of the agencies whose documents changed.
+    """
+    documents = Document.objects.filter(
+        Q(syntheticdocument=syn_document)
+        | Q(processeddocument__syntheticdocument=syn_document)
+    ).exclude(status="complete")
+    document_ids = set(documents.values_list("pk", flat=True))
+    if not document_ids:
+        return set()
+    changed = Document.objects.filter(pk__in=document_ids)
+    agency_ids = set(changed.values_list("agency_id", flat=True).distinct())
+    changed.update(status="complete")
+    return agency_ids
+
+
+# per-thread state for deferred_status_updates
+_deferred = threading.local()
+
+
+def _defer(document_ids=(), agency_ids=()):
+    """
+    If we're inside deferred_status_updates, remember the documents and
+    agencies that need resolving and return True. Otherwise do nothing and
+    return False, so the caller handles it right away.
+    """
+    if not getattr(_deferred, "depth", 0):
+        return False
+    _deferred.document_ids.update(d for d in document_ids if d is not None)
+    _deferred.agency_ids.update(a for a in agency_ids if a is not None)
+    return True
+
+
+@contextmanager
+def deferred_status_updates():
+    """
+    Hold off on the per-row status and rollup signal handlers while creating
+    or saving lots of documents. The affected document and agency IDs get
+    collected instead and resolved in one pass, inside one transaction, when
+    the outermost block exits. Usage:
+
+        with deferred_status_updates():
+            for file in files:
+                ProcessedDocument.objects.create(...)
+
+    The block isn't a transaction, whatever it saved before an error (or
+    Ctrl-C, or sys.exit) stays saved, so those documents still get resolved
+    on the way out. If that fails too, the original error is the one raised.
+    """
+    if not getattr(_deferred, "depth", 0):
+        _deferred.depth = 0
+        _deferred.document_ids = set()
+        _deferred.agency_ids = set()
+    _deferred.depth += 1
+    try:
+        yield
+    except BaseException:
+        try:
+            _exit_deferred()
+        except Exception as e:
+            print(f"Couldn't resolve deferred statuses: {e}", file=sys.stderr)
+        raise
+    _exit_deferred()
+
+
+def _exit_deferred():
+    """
+    Leave a deferred_status_updates block, flushing everything it collected
+    if it was the outermost one.
+    """
+    _deferred.depth -= 1
+    if _deferred.depth:
+        return
+    document_ids = _deferred.document_ids
+    agency_ids = _deferred.agency_ids
+    _deferred.document_ids = set()
+    _deferred.agency_ids = set()
+    flush_status_updates(document_ids, agency_ids)
+
+
+def flush_status_updates(document_ids, agency_ids=()):
+    """
+    Resolve the statuses of a batch of documents and refresh the rollups of
+    their agencies (plus any other given agency IDs).
+    """
+    agency_ids = set(agency_ids)
+    if not document_ids and not agency_ids:
         return
+    print(f"Resolving statuses for {len(document_ids)} documents")
+    with transaction.atomic():
+        agency_ids.update(Document.objects.filter(
+            pk__in=document_ids
+        ).order_by().values_list("agency_id", flat=True).distinct())
+        resolve_document_statuses(document_ids, refresh_rollups=False)
+        refresh_agency_rollups(agency_ids)
+
+
+def update_doc_status(document):
+    """
+    Keep a document's status in sync with its most processed document.
+    """
+    resolve_document_statuses([document.pk])
+    document.refresh_from_db(fields=["status"])
 
-    processed = document.processeddocument_set.all()
-    if not processed.count():
+
+# per-thread rollup contributions of the documents a save/delete is about
+# to change, keyed by id() of the instance being saved/deleted
+_snapshots = threading.local()
+
+
+def _snapshot_rollups(instance, document_ids):
+    """
+    Before a save or delete, remember what the affected documents add to
+    their agencies' rollups, so afterwards we only have to apply the
+    difference (see _apply_rollup_changes).
+    """
+    if getattr(_deferred, "depth", 0):
+        # the whole agency gets refreshed when the deferred block exits
         return
+    if not hasattr(_snapshots, "by_instance"):
+        _snapshots.by_instance = {}
+    _snapshots.by_instance[id(instance)] = {
+        document_id: document_rollup(document_id)
+        for document_id in set(document_ids)
+        if document_id is not None
+    }
 
-    # dict, {score: processed, ...}
-    scores = {}
-    for proc in processed:
-        score = STATUS_SCORES[proc.status]
-        scores[score] = proc
 
-    most_complete_score = min(scores.keys())
-    most_complete_proc = scores[most_complete_score]
+def _apply_rollup_changes(instance, document_ids=()):
+    """
+    After a save or delete, update the rollups by the change in what the
+    affected documents (the ones snapshotted beforehand plus document_ids)
+    add to them.
+    """
+    before = getattr(_snapshots, "by_instance", {}).pop(id(instance), {})
+    document_ids = set(before) | set(
+        d for d in document_ids if d is not None
+    )
+    apply_rollup_deltas(
+        list(before.values()),
+        [document_rollup(document_id) for document_id in document_ids],
+    )
 
-    if most_complete_proc.status != document.status:
-        document.status = most_complete_proc.status
-        document.save()
+
+@receiver(pre_save, sender=ProcessedDocument)
+def snapshot_rollups_from_processed(sender, **kwargs):
+    p_document = kwargs['instance']
+    document_ids = [p_document.document_id]
+    if p_document.pk:
+        # it might be moving away from another document
+        document_ids += ProcessedDocument.objects.filter(
+            pk=p_document.pk
+        ).values_list("document_id", flat=True)
+    _snapshot_rollups(p_document, document_ids)
 
 
 @receiver(post_save, sender=ProcessedDocument)
 def update_document_status_from_processed(sender, **kwargs):
-    instance = kwargs['instance']
-    update_doc_status(instance.document)
+    p_document = kwargs['instance']
+    if _defer(document_ids=[p_document.document_id]):
+        return
+    before = getattr(_snapshots, "by_instance", {}).get(id(p_document), {})
+    document_ids = set(before) | {p_document.document_id}
+    document_ids.discard(None)
+    if document_ids:
+        resolve_document_statuses(document_ids, refresh_rollups=False)
+    # page counts, segmentation, etc, can change without a status change
+    _apply_rollup_changes(p_document, document_ids)
+
+
+@receiver(pre_save, sender=Document)
+def snapshot_rollups_from_document(sender, **kwargs):
+    document = kwargs['instance']
+    _snapshot_rollups(document, [document.pk])
 
 
 @receiver(post_save, sender=Document)
 def update_document_status(sender, **kwargs):
     document = kwargs['instance']
-    # only override status if file is marked as no records
-    # this means this document will never have a completed status
-    if not document.no_new_records and not document.status == "complete":
-        update_doc_status(document)
+    if _defer(document_ids=[document.pk]):
+        return
+    # the resolver leaves no records and completed documents alone
+    resolve_document_statuses([document.pk], refresh_rollups=False)
+    _apply_rollup_changes(document, [document.pk])
+
 
 @receiver(post_save, sender=SyntheticDocument)
 def update_synthetic_dependent_status(sender, **kwargs):
     syn_document = kwargs['instance']
-    print("syn_document", syn_document)
     if not syn_document.completed:
-        print("not completed")
         return
-    for document in syn_document.documents.all():
-        print(document.id, "document", document, "status", document.status, "file", document.file)
-        # if document.status == "complete": continue
-        document.status = "complete"
-        document.save()
-    for p_document in syn_document.processed_documents.all():
-        print(p_document.id, "p_document", p_document, "status", p_document.status)
-        print(p_document.document.id, "p_document.document", p_document.document, "status", p_document.document.status, "file", p_document.document.status)
-        # if p_document.document.status == "complete": continue
-        p_document.document.status = "complete"
-        p_document.document.save()
+    agency_ids = complete_synthetic_dependents(syn_document)
+    if _defer(agency_ids=agency_ids):
+        return
+    refresh_agency_rollups(agency_ids)
+
+
+@receiver(pre_delete, sender=Document)
+def snapshot_rollups_from_deleted_document(sender, **kwargs):
+    document = kwargs['instance']
+    _snapshot_rollups(document, [document.pk])
+
+
+@receiver(post_delete, sender=Document)
+def update_rollups_from_document(sender, **kwargs):
+    document = kwargs['instance']
+    if _defer(agency_ids=[document.agency_id]):
+        return
+    _apply_rollup_changes(document)
+
+
+@receiver(pre_delete, sender=ProcessedDocument)
+def snapshot_rollups_from_deleted_processed(sender, **kwargs):
+    p_document = kwargs['instance']
+    _snapshot_rollups(p_document, [p_document.document_id])
+
+
+@receiver(post_delete, sender=ProcessedDocument)
+def update_rollups_from_processed(sender, **kwargs):
+    p_document = kwargs['instance']
+    if _defer(document_ids=[p_document.document_id]):
+        return
+    _apply_rollup_changes(p_document)
@@ -1,3 +1,1571 @@
-from django.test import TestCase
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import product
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import (
+    RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+    override_settings
+)
+from django.urls import reverse
+import numpy as np
+from pdf2image.exceptions import PDFPageCountError
+import sqlite_utils
+import tablib
+
+from documents import pdf2text, signals, views
+from documents.admin import AgencyAdmin
+from documents.headers import edit_distance, header_key, unify_headers
+from documents.import_rules import (
+    DEFAULT_RULES, PrefixIndex, find_parent, load_review_queue, load_rules,
+    resolve_files, write_review_queue
+)
+from documents.management.commands import (
+    export_sqlite_dbs, importfiles, ocr_pdfs
+)
+from documents.management.commands.importfiles import get_file_groups
+from documents.models import (
+    Agency, AgencyStatusRollup, Document, ProcessedDocument, SyntheticDocument
+)
+from documents.rollups import (
+    build_rollups, document_rollup_changes, rebuild_rollups
+)
+from documents.scan import (
+    SCAN_MANIFEST_VERSION, load_scan_manifest, save_scan_manifest, scan_tree,
+    tree_signature
+)
+from documents.util import (
+    STATUS_SUFFIXES, classify, classify_many, file_sha256, status_case
+)
+
+
+class GetFileGroupsTestCase(SimpleTestCase):
+    def test_groups_by_basename(self):
+        groups = get_file_groups([
+            "report.pdf", "report.ocr.pdf", "report.complete.csv",
+            "other.pdf",
+        ])
+        self.assertEqual(groups, {
+            "report": [
+                "report.complete.csv", "report.ocr.pdf", "report.pdf",
+            ],
+            "other": ["other.pdf"],
+        })
+
+    def test_xls_sheet_csvs(self):
+        groups = get_file_groups([
+            "roster.xlsx", "roster-Sheet1.csv", "roster-Sheet2.csv",
+            "roster-Sheet2.complete.csv",
+        ])
+        self.assertEqual(groups, {
+            "roster-Sheet1": ["roster-Sheet1.csv", "roster.xlsx"],
+            "roster-Sheet2": [
+                "roster-Sheet2.complete.csv", "roster-Sheet2.csv",
+                "roster.xlsx",
+            ],
+        })
+
+    def test_docx_table_csvs(self):
+        groups = get_file_groups([
+            "log.docx", "log_1.csv", "log_2.csv", "log_2.cleaned.csv",
+        ])
+        self.assertEqual(groups, {
+            "log_1": ["log.docx", "log_1.csv"],
+            "log_2": ["log.docx", "log_2.cleaned.csv", "log_2.csv"],
+        })
+
+    def test_docx_needs_underscore_and_xls_needs_dash(self):
+        groups = get_file_groups([
+            "a.docx", "a-1.csv", "b.xls", "b_1.csv",
+        ])
+        self.assertEqual(groups, {
+            "a": ["a.docx"],
+            "a-1": ["a-1.csv"],
+            "b": ["b.xls"],
+            "b_1": ["b_1.csv"],
+        })
+
+    def test_xls_without_sheets(self):
+        groups = get_file_groups(["lone.xls", "lone.complete.csv"])
+        self.assertEqual(groups, {
+            "lone": ["lone.complete.csv", "lone.xls"],
+        })
+
+    def test_regex_characters_in_names(self):
+        groups = get_file_groups([
+            "file (1).xlsx", "file (1)-Sheet1.csv", "file 1-Sheet1.csv",
+        ])
+        self.assertEqual(groups, {
+            "file (1)-Sheet1": ["file (1)-Sheet1.csv", "file (1).xlsx"],
+            "file 1-Sheet1": ["file 1-Sheet1.csv"],
+        })
+
+    def test_parent_must_be_a_prefix(self):
+        groups = get_file_groups(["b.xls", "ab-Sheet1.csv"])
+        self.assertEqual(groups, {
+            "b": ["b.xls"],
+            "ab-Sheet1": ["ab-Sheet1.csv"],
+        })
+
+    def test_subdirectories(self):
+        groups = get_file_groups([
+            "2020/roster.xlsx", "2020/roster-Sheet1.csv",
+        ])
+        self.assertEqual(groups, {
+            "roster-Sheet1": ["2020/roster-Sheet1.csv", "2020/roster.xlsx"],
+        })
+
+
+class ImportRulesTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def path(self, name):
+        # the dash in the agency name mustn't look like a sheet name
+        return f"agency_attachments/Test-PD/{name}"
+
+    def test_prefix_index(self):
+        index = PrefixIndex([self.path("b.pdf"), self.path("a.pdf")])
+        index.add(self.path("a.docx"))
+        index.add(self.path("a.pdf"))
+        self.assertEqual(index.startswith(self.path("a")), [
+            self.path("a.docx"), self.path("a.pdf"),
+        ])
+        self.assertEqual(index.startswith(self.path("c")), [])
+
+    def test_find_parent(self):
+        index = PrefixIndex(self.path(name) for name in (
+            "Report (2020) [final]+.pdf",
+            "Use of Force.docx",
+            "Use of Force.pdf",
+            "Arrests $1.xlsx",
+            "Arrests $1.csv",
+        ))
+        for file, parent, reason in (
+            # prefix
+            ("Report (2020) [final]+.ocr.pdf",
+             "Report (2020) [final]+.pdf", None),
+            ("Report (2020) [final]+.pdf.cleaned.csv",
+             "Report (2020) [final]+.pdf", None),
+            # tables from a DOC/X, sheets from an XLS/X
+            ("Use of Force_1.csv", "Use of Force.docx", None),
+            ("Use of Force_2.cleaned.csv", "Use of Force.docx", None),
+            ("Arrests $1-Sheet (1).csv", "Arrests $1.xlsx", None),
+            ("Use of Force.ocr.pdf", None, "Ambiguous parent"),
+            ("Unknown.ocr.pdf", None, "No parent found"),
+            ("Unknown-Sheet1.csv", None, "No parent found"),
+        ):
+            found, found_reason, candidates = find_parent(
+                self.path(file), index, DEFAULT_RULES
+            )
+            self.assertEqual(found, parent and self.path(parent), file)
+            self.assertEqual(found_reason, reason, file)
+            if reason == "Ambiguous parent":
+                self.assertEqual(len(candidates), 2)
+
+    def test_custom_rules(self):
+        rules_path = os.path.join(self.tmp_dir, "rules.yaml")
+        with open(rules_path, "w") as f:
+            f.write(
+                "types:\n"
+                "  - type: processed\n"
+                "    suffixes: ['.txt']\n"
+                "  - type: document\n"
+                "    suffixes: ['.pdf']\n"
+                "parent_strategies: [[prefix]]\n"
+            )
+        rules = load_rules(rules_path)
+        self.assertEqual(
+            rules["parent_suffixes"], DEFAULT_RULES["parent_suffixes"]
+        )
+        self.assertEqual(load_rules(), DEFAULT_RULES)
+
+        files = [self.path(name) for name in (
+            "notes.txt", "notes.pdf", "Use of Force_1.txt", "data.csv",
+        )]
+        documents, processed, unresolved = resolve_files(
+            "Test-PD", files, [self.path("Use of Force.docx")], rules
+        )
+        self.assertEqual(documents, [self.path("notes.pdf")])
+        # the parent can be one of the new documents
+        self.assertEqual(processed, [
+            (self.path("notes.txt"), self.path("notes.pdf")),
+        ])
+        self.assertEqual(
+            [(row["file"], row["reason"]) for row in unresolved], [
+                # not a type in these rules
+                (self.path("data.csv"), "Unknown file type"),
+                # table matching is turned off
+                (self.path("Use of Force_1.txt"), "No parent found"),
+            ]
+        )
+
+    def test_review_queue_round_trip(self):
+        files = [self.path(name) for name in (
+            "notes.txt", "Report.ocr.pdf", "letter.rtf", "junk.txt",
+        )]
+        document_files = [self.path("Report.pdf"), self.path("Report.docx")]
+        documents, processed, unresolved = resolve_files(
+            "Test-PD", files, document_files, DEFAULT_RULES
+        )
+        self.assertEqual((documents, processed), ([], []))
+        self.assertEqual(len(unresolved), 4)
+
+        queue_path = os.path.join(self.tmp_dir, "review.csv")
+        write_review_queue(queue_path, unresolved)
+
+        # what a reviewer would fill in
+        with open(queue_path, "r") as f:
+            queue = tablib.Dataset().load(f.read(), format="csv")
+        decisions = {
+            self.path("notes.txt"): ("processed", self.path("Report.pdf")),
+            self.path("Report.ocr.pdf"): (
+                "processed", f" {self.path('Report.pdf')} "
+            ),
+            self.path("letter.rtf"): ("Document", ""),
+            self.path("junk.txt"): ("skip", ""),
+        }
+        reviewed = tablib.Dataset(headers=queue.headers)
+        for row in queue.dict:
+            if row["candidates"]:
+                self.assertIn(self.path("Report.docx"), row["candidates"])
+            row["type"], row["parent"] = decisions[row["file"]]
+            reviewed.append([row[h] for h in queue.headers])
+        # and one they didn't get to
+        reviewed.append(["Test-PD", self.path("later.txt"), "", "", "", ""])
+        with open(queue_path, "w") as f:
+            f.write(reviewed.csv)
+
+        resolutions = load_review_queue(queue_path)
+        self.assertEqual(resolutions, {
+            ("Test-PD", self.path("notes.txt")):
+                ("processed", self.path("Report.pdf")),
+            ("Test-PD", self.path("Report.ocr.pdf")):
+                ("processed", self.path("Report.pdf")),
+            ("Test-PD", self.path("letter.rtf")): ("document", None),
+            ("Test-PD", self.path("junk.txt")): ("skip", None),
+        })
+
+        documents, processed, unresolved = resolve_files(
+            "Test-PD", files + [self.path("later.txt")], document_files,
+            DEFAULT_RULES, resolutions=resolutions,
+        )
+        self.assertEqual(documents, [self.path("letter.rtf")])
+        self.assertEqual(sorted(processed), [
+            (self.path("Report.ocr.pdf"), self.path("Report.pdf")),
+            (self.path("notes.txt"), self.path("Report.pdf")),
+        ])
+        self.assertEqual(
+            [row["file"] for row in unresolved], [self.path("later.txt")]
+        )
+
+
+class UnifyHeadersTestCase(SimpleTestCase):
+    def test_edit_distance(self):
+        self.assertEqual(edit_distance("received", "received", 2), 0)
+        self.assertEqual(edit_distance("received", "recieved", 2), 1)
+        self.assertEqual(edit_distance("received", "recevied", 2), 1)
+        self.assertEqual(edit_distance("received", "rcvd", 2), 3)
+        self.assertEqual(edit_distance("", "abc", 3), 3)
+
+    def test_header_key(self):
+        self.assertEqual(header_key("date_received"), "date received")
+        self.assertEqual(header_key("Date - Received:"), "date received")
+        self.assertEqual(header_key("case #"), "case")
+
+    def test_punctuation_and_typos(self):
+        mapping = unify_headers([
+            ["officer name", "date received"],
+            ["officer_name", "date received"],
+            ["officer name", "date recieved"],
+        ])
+        self.assertEqual(mapping, {
+            "officer name": "officer name",
+            "officer_name": "officer name",
+            "date received": "date received",
+            "date recieved": "date received",
+        })
+
+    def test_headers_in_the_same_csv_stay_apart(self):
+        mapping = unify_headers([
+            ["officer name", "officer names"],
+            ["officer name"],
+        ])
+        self.assertEqual(mapping["officer names"], "officer names")
+
+    def test_numbered_headers_stay_apart(self):
+        mapping = unify_headers([
+            ["officer 1"], ["officer 2"], ["allegation 10"], ["allegation 1"],
+        ])
+        self.assertEqual(
+            mapping, {h: h for h in mapping}
+        )
+
+    def test_short_headers_need_exact_keys(self):
+        mapping = unify_headers([["dob"], ["doa"], ["race"], ["rank"]])
+        self.assertEqual(mapping, {h: h for h in mapping})
+
+
+# a stand-in for a jar speaking the pdf2text server protocol, which
+# "extracts" a file by echoing its name and page range
+FAKE_TEXT_SERVER = """
+import json, sys
+sys.stdout.write("READY\\n")
+sys.stdout.flush()
+for line in sys.stdin:
+    job = json.loads(line)
+    if job["file"].endswith("hang.pdf"):
+        sys.stdout.write("OK 10")
+        sys.stdout.flush()
+        sys.stdin.readline()
+    body = f"{job['file']} {job.get('pages')}".encode("utf-8")
+    sys.stdout.buffer.write(b"OK %d\\n" % len(body) + body)
+    sys.stdout.flush()
+"""
+
+
+class PDFTextServerTestCase(SimpleTestCase):
+    def server(self, script=FAKE_TEXT_SERVER, **kwargs):
+        server = pdf2text.PDFTextServer(
+            [sys.executable, "-c", script], **kwargs
+        )
+        self.addCleanup(server.close)
+        return server
+
+    def test_extract(self):
+        server = self.server()
+        server.start()
+        self.assertEqual(
+            server.extract("/tmp/a.pdf", pages="0-1"), "/tmp/a.pdf 0-1"
+        )
+        self.assertEqual(server.extract("/tmp/b.pdf"), "/tmp/b.pdf None")
+
+    def test_bad_handshake(self):
+        server = self.server(script="print('hello')")
+        with self.assertRaises(pdf2text.PDFTextServerError):
+            server.start()
+
+    def test_partial_line_times_out(self):
+        server = self.server(job_timeout=0.5)
+        server.start()
+        with self.assertRaises(pdf2text.PDFTextServerError):
+            server.extract("/tmp/hang.pdf")
+
+    @override_settings(PDF_TO_TEXT_SERVER_JAR=None)
+    def test_off_by_default(self):
+        self.assertIsNone(pdf2text.get_server())
+
+
+FIXTURE_PDF = os.path.join(
+    os.path.dirname(__file__), "test_data", "three_pages.pdf"
+)
+
+
+class PDFPagesTestCase(SimpleTestCase):
+    def test_split_pages_round_trip(self):
+        for text in ("one\fTWO\fthree\f", "one\fTWO\fthree", ""):
+            pages = pdf2text.split_pages(text)
+            self.assertEqual(pdf2text.join_pages(pages), text)
+        self.assertEqual(
+            pdf2text.split_pages("one\ftwo\f"), ["one\f", "two\f"]
+        )
+
+    @mock.patch("documents.pdf2text.pdfinfo_from_path")
+    @mock.patch("documents.pdf2text.pdf2text")
+    def test_one_extraction_per_document(self, pdf2text_mock, pdfinfo):
+        pdfinfo.return_value = {"Pages": 3}
+        pdf2text_mock.return_value = "one\ftwo\fthree\f"
+        text, pages = pdf2text.pdf2pages("doc.pdf")
+        self.assertEqual(pdf2text_mock.call_count, 1)
+        self.assertEqual(text, "one\ftwo\fthree\f")
+        self.assertEqual(
+            pdf2text.join_pages(pages, [1, 2]), "two\fthree\f"
+        )
+
+    @override_settings(PDF_TO_TEXT_SERVER_JAR=None)
+    @mock.patch("documents.pdf2text.pdfinfo_from_path")
+    @mock.patch("documents.pdf2text.pdf2text")
+    def test_no_per_page_jobs_without_server(self, pdf2text_mock, pdfinfo):
+        pdfinfo.return_value = {"Pages": 3}
+        pdf2text_mock.return_value = "no page delimiters here"
+        text, pages = pdf2text.pdf2pages("doc.pdf")
+        self.assertEqual(pdf2text_mock.call_count, 1)
+        self.assertEqual(text, "no page delimiters here")
+        self.assertIsNone(pages)
+
+    @skipUnless(
+        shutil.which("java") and os.path.exists(pdf2text.PDF_TO_TEXT_JAR),
+        "needs java and the PDF to text jar"
+    )
+    def test_pages_match_whole_document_extraction(self):
+        text, pages = pdf2text.pdf2pages(FIXTURE_PDF)
+        self.assertEqual(pdf2text.join_pages(pages), text)
+        self.assertEqual(pdf2text.pdf2text_subprocess(FIXTURE_PDF), text)
+        self.assertEqual(
+            pdf2text.pdf2segment(FIXTURE_PDF, pages, [1, 2]),
+            pdf2text.pdf2text_subprocess(FIXTURE_PDF, pages="1-2"),
+        )
+
+
+class RollupAssertionsMixin:
+    def assertRollupsMatchRecount(self, agency):
+        fields = (
+            "status", "documents", "pages", "segmentable_pdocs",
+            "segmented_pdocs",
+        )
+        stored = set(
+            tuple(getattr(r, f) for f in fields)
+            for r in AgencyStatusRollup.objects.filter(agency=agency)
+            # deltas can leave emptied rows behind, a recount doesn't
+            if r.documents or r.segmentable_pdocs
+        )
+        recounted = set(
+            tuple(getattr(r, f) for f in fields)
+            for r in build_rollups([agency.pk])
+        )
+        self.assertEqual(stored, recounted)
+
+
+class DeferredStatusUpdatesTestCase(SimpleTestCase):
+    @mock.patch("documents.signals.flush_status_updates")
+    def test_flushes_on_normal_exit(self, flush):
+        with signals.deferred_status_updates():
+            with signals.deferred_status_updates():
+                signals._defer(document_ids=[1], agency_ids=[2])
+            flush.assert_not_called()
+        flush.assert_called_once_with({1}, {2})
+
+    @mock.patch("documents.signals.flush_status_updates")
+    def test_flushes_on_error(self, flush):
+        with self.assertRaises(SystemExit):
+            with signals.deferred_status_updates():
+                signals._defer(document_ids=[1], agency_ids=[2])
+                sys.exit(1)
+        flush.assert_called_once_with({1}, {2})
+        self.assertFalse(signals._defer(document_ids=[3]))
+
+    @mock.patch("documents.signals.flush_status_updates")
+    @mock.patch("sys.stderr")
+    def test_flush_error_doesnt_hide_original_error(self, stderr, flush):
+        flush.side_effect = RuntimeError("flush failed")
+        with self.assertRaises(ValueError):
+            with signals.deferred_status_updates():
+                signals._defer(document_ids=[1])
+                raise ValueError()
+        self.assertTrue(stderr.write.called)
+
+        # nothing left over for the next block to flush
+        flush.reset_mock(side_effect=True)
+        with signals.deferred_status_updates():
+            pass
+        flush.assert_called_once_with(set(), set())
+
+
+class DeferredStatusUpdatesDBTestCase(RollupAssertionsMixin, TestCase):
+    @mock.patch("sys.stdout")
+    def test_saved_rows_get_resolved_after_error(self, stdout):
+        agency = Agency.objects.create(name="Test PD")
+        doc = Document.objects.create(agency=agency, file="test/report.pdf")
+        with self.assertRaises(KeyboardInterrupt):
+            with signals.deferred_status_updates():
+                ProcessedDocument.objects.create(
+                    document=doc, file="test/report.ocr.pdf", pages=3,
+                )
+                ProcessedDocument.objects.create(
+                    document=doc, file="test/report.auto.csv",
+                )
+                raise KeyboardInterrupt()
+
+        doc.refresh_from_db()
+        self.assertEqual(doc.status, "auto-extracted")
+        self.assertRollupsMatchRecount(agency)
+        self.assertEqual(AgencyStatusRollup.objects.get(
+            agency=agency, status="auto-extracted"
+        ).pages, 3)
+
+
+class ImportRowsTestCase(TestCase):
+    rows = [{
+        "status": "", "agency": "Test PD",
+        "original_file": "report.pdf", "current_file": "report.csv",
+    }]
+    middle_files = {"Test PD-report.pdf": ["report.ocr.pdf"]}
+
+    def import_rows(self):
+        with mock.patch("sys.stdout") as stdout:
+            importfiles.import_rows(self.rows, self.middle_files)
+        return "".join(c.args[0] for c in stdout.write.call_args_list)
+
+    def test_reports_inserted_rows(self):
+        output = self.import_rows()
+        self.assertIn("Created 1 documents", output)
+        self.assertIn("Created 2 processed documents", output)
+        self.assertEqual(ProcessedDocument.objects.count(), 2)
+
+        output = self.import_rows()
+        self.assertIn("Created 0 documents", output)
+        self.assertIn("Created 0 processed documents", output)
+
+    def test_conflicts_arent_counted(self):
+        self.import_rows()
+        ProcessedDocument.objects.filter(file__endswith=".csv").delete()
+
+        # another import adding the OCR'd PDF after we checked for it
+        existing_files = importfiles.existing_files
+        results = [set()]
+
+        def racing_existing_files(*args):
+            if results:
+                return results.pop()
+            return existing_files(*args)
+
+        with mock.patch.object(
+            importfiles, "existing_files", racing_existing_files
+        ):
+            output = self.import_rows()
+        self.assertIn("Created 1 processed documents", output)
+
+
+class ExportManifestTestCase(SimpleTestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.db_filepath = os.path.join(self.output_dir, "test-pd.sqlite")
+        with open(self.db_filepath, "w") as f:
+            f.write("db")
+
+        self.exporter = export_sqlite_dbs.Command()
+        self.exporter.setup_export(self.output_dir, interactive=False)
+        self.exporter.db_filepath_from_agency = lambda agency: self.db_filepath
+        self.exporter.agency_complete_docs = lambda agency: []
+        self.exporter.agency_pdocs = lambda docs: []
+        self.exporter.process_agency = mock.Mock(side_effect=self.write_db)
+
+        self.agency = Agency(pk=1, name="Test PD")
+        stat = os.stat(self.db_filepath)
+        export_sqlite_dbs.save_export_manifest(self.output_dir, {"1": {
+            "agency": self.agency.name,
+            "inputs": {},
+            "rows": 10,
+            "total_rows": 10,
+            "db": {"size": stat.st_size, "mtime": stat.st_mtime_ns},
+        }})
+
+    def write_db(self, agency):
+        os.remove(self.db_filepath)
+        with open(self.db_filepath, "w") as f:
+            f.write("rebuilt db")
+        return 10
+
+    def export_if_changed(self):
+        manifest = export_sqlite_dbs.load_export_manifest(self.output_dir)
+        return self.exporter.export_if_changed(self.agency, manifest.get("1"))
+
+    def test_unchanged_agency_is_skipped(self):
+        self.assertEqual(self.export_if_changed()[0], 10)
+        self.exporter.process_agency.assert_not_called()
+
+    def test_version_mismatch_forces_rebuild(self):
+        path = os.path.join(
+            self.output_dir, export_sqlite_dbs.EXPORT_MANIFEST_FILENAME
+        )
+        with open(path, "r") as f:
+            data = json.load(f)
+        data["version"] = export_sqlite_dbs.EXPORT_MANIFEST_VERSION - 1
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+        self.assertEqual(
+            export_sqlite_dbs.load_export_manifest(self.output_dir), {}
+        )
+        n_rows, entry = self.export_if_changed()
+        self.exporter.process_agency.assert_called_once_with(self.agency)
+        self.assertEqual(entry["db"]["size"], len("rebuilt db"))
+
+
+class SegmentationCountsTestCase(TestCase):
+    def test_null_and_empty_incident_pgs_are_unsegmented(self):
+        agency = Agency.objects.create(name="Test PD")
+        doc = Document.objects.create(agency=agency, file="test/report.pdf")
+        for name, incident_pgs in (
+            ("null", None), ("empty", []), ("segmented", [[0, 1], [2, 3]]),
+        ):
+            ProcessedDocument.objects.create(
+                document=doc, file=f"test/{name}.ocr.pdf",
+                incident_pgs=incident_pgs,
+            )
+        # no signals, so nothing changes it back
+        Document.objects.filter(pk=doc.pk).update(status="case-doc")
+
+        counts = ProcessedDocument.objects.segmentable().segmentation_counts()
+        self.assertEqual(list(counts), [{
+            "agency_id": agency.pk,
+            "total": 3,
+            "segmented": 1,
+            "unsegmented": 2,
+        }])
+
+
+class RollupDeltasTestCase(RollupAssertionsMixin, TestCase):
+    def test_saves_and_deletes(self):
+        agency = Agency.objects.create(name="Test PD")
+        doc = Document.objects.create(agency=agency, file="test/a.pdf")
+        other = Document.objects.create(agency=agency, file="test/b.pdf")
+        self.assertRollupsMatchRecount(agency)
+
+        pdoc = ProcessedDocument.objects.create(
+            document=doc, file="test/a.ocr.pdf", pages=10,
+        )
+        self.assertRollupsMatchRecount(agency)
+
+        pdoc.incident_pgs = [[0, 4], [5, 9]]
+        pdoc.save()
+        self.assertRollupsMatchRecount(agency)
+
+        # moving to another document
+        pdoc.document = other
+        pdoc.save()
+        self.assertRollupsMatchRecount(agency)
+
+        ProcessedDocument.objects.create(
+            document=other, file="test/b.complete.csv",
+        )
+        self.assertRollupsMatchRecount(agency)
+
+        with document_rollup_changes([other.pk]):
+            ProcessedDocument.objects.filter(pk=pdoc.pk).update(pages=12)
+        self.assertRollupsMatchRecount(agency)
+
+        pdoc.delete()
+        self.assertRollupsMatchRecount(agency)
+
+        other.delete()
+        self.assertRollupsMatchRecount(agency)
+
+
+def process_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            state = f.read().rsplit(")", 1)[1].split()[0]
+    except FileNotFoundError:
+        return False
+    # killed, but not reaped yet
+    return state not in ("Z", "X")
+
+
+class OCRPDFsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.ocr_output = os.path.join(self.tmp_dir, "report.ocr.pdf")
+
+    def run_ocr(self, script, **kwargs):
+        args = ["sh", "-c", script, "sh", self.ocr_output, self.tmp_dir]
+        with mock.patch.object(
+            ocr_pdfs, "ocrmypdf_args", lambda *a, **kw: args
+        ):
+            return ocr_pdfs.run_ocr(
+                "report.pdf", self.ocr_output, quiet=True, **kwargs
+            )
+
+    def test_success(self):
+        self.assertIsNone(self.run_ocr('echo ocr > "$1"'))
+        self.assertTrue(os.path.exists(self.ocr_output))
+
+    def test_bad_return_code_removes_output(self):
+        error = self.run_ocr('echo partial > "$1"; exit 3')
+        self.assertEqual(error, "Bad return code: 3")
+        self.assertFalse(os.path.exists(self.ocr_output))
+
+    @skipUnless(os.path.exists("/proc/self/stat"), "needs /proc")
+    def test_timeout_kills_process_group(self):
+        # like ocrmypdf, leave a partial file and a child (tesseract)
+        # running behind
+        error = self.run_ocr(
+            'echo partial > "$1"; sleep 60 & echo $! > "$2/child"; wait',
+            timeout=1,
+        )
+        self.assertEqual(error, "Timed out after 1s")
+        self.assertFalse(os.path.exists(self.ocr_output))
+
+        with open(os.path.join(self.tmp_dir, "child"), "r") as f:
+            child_pid = int(f.read())
+        for _ in range(50):
+            if not process_running(child_pid):
+                break
+            time.sleep(0.1)
+        self.assertFalse(process_running(child_pid))
+
+    @mock.patch("os.cpu_count", return_value=8)
+    @mock.patch("sys.stdout")
+    def test_ocr_budget(self, stdout, cpu_count):
+        command = ocr_pdfs.Command()
+        # split the cores evenly by default
+        self.assertEqual(command.ocr_budget(1, None), 8)
+        self.assertEqual(command.ocr_budget(3, None), 2)
+        self.assertEqual(command.ocr_budget(16, None), 1)
+        # asked for jobs that fit
+        self.assertEqual(command.ocr_budget(2, 4), 4)
+        self.assertEqual(command.ocr_budget(2, 1), 1)
+        # too many, clamped
+        self.assertEqual(command.ocr_budget(2, 8), 4)
+        self.assertEqual(command.ocr_budget(16, 2), 1)
+
+
+@mock.patch("sys.stdout")
+class OCRPDFsDBTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.agency = Agency.objects.create(name="Test PD")
+        self.docs = []
+        for name in ("a", "b", "c"):
+            doc = Document.objects.create(
+                agency=self.agency, file=f"test/{name}.pdf",
+                status="awaiting-reading",
+            )
+            self.docs.append(doc)
+        os.makedirs(os.path.join(self.media_root, "test"))
+
+    def ocr_output(self, doc):
+        return f"{os.path.splitext(doc.file.path)[0]}.ocr.pdf"
+
+    def ocr_pdocs(self):
+        return set(ProcessedDocument.objects.filter(
+            file__endswith=".ocr.pdf"
+        ).values_list("document_id", flat=True))
+
+    def test_find_jobs_recovers_finished_ocr(self, stdout):
+        # OCR'd by an interrupted run, no processed document
+        with open(self.ocr_output(self.docs[0]), "w") as f:
+            f.write("ocr")
+
+        jobs = list(ocr_pdfs.Command().find_jobs({}))
+        self.assertEqual(
+            [doc.pk for doc, _, _ in jobs],
+            [doc.pk for doc in self.docs[1:]],
+        )
+        self.assertEqual(self.ocr_pdocs(), {self.docs[0].pk})
+
+    def test_interrupted_run_keeps_finished_ocr(self, stdout):
+        def fake_run_ocr(pdf_input, ocr_output, **kwargs):
+            with open(ocr_output, "w") as f:
+                f.write("ocr")
+
+        def interrupted(futures):
+            for n_done, future in enumerate(as_completed(futures)):
+                if n_done == 2:
+                    raise KeyboardInterrupt()
+                yield future
+
+        command = ocr_pdfs.Command()
+        jobs = [
+            (doc, doc.file.path, self.ocr_output(doc)) for doc in self.docs
+        ]
+        with mock.patch.multiple(
+            ocr_pdfs,
+            ProcessPoolExecutor=ThreadPoolExecutor,
+            as_completed=interrupted,
+            run_ocr=fake_run_ocr,
+            # would lose the test's transaction
+            connections=mock.DEFAULT,
+        ), self.assertRaises(KeyboardInterrupt):
+            command.run_parallel(jobs, 2, 1, None)
+
+        ocr_done = set(
+            doc.pk for doc in self.docs
+            if os.path.exists(self.ocr_output(doc))
+        )
+        self.assertEqual(len(ocr_done), 3)
+        # the two jobs we saw finish got their processed documents right
+        # away, the other gets picked up by the next run
+        self.assertEqual(len(self.ocr_pdocs()), 2)
+        list(command.find_jobs({}))
+        self.assertEqual(self.ocr_pdocs(), ocr_done)
+
+
+@mock.patch("sys.stdout")
+class PageImageViewTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        os.makedirs(os.path.join(self.media_root, "test"))
+        shutil.copy(
+            FIXTURE_PDF,
+            os.path.join(self.media_root, "test", "report.ocr.pdf"),
+        )
+        self.image_path = os.path.join(self.media_root, "page.jpg")
+        with open(self.image_path, "wb") as f:
+            f.write(b"jpeg")
+
+        agency = Agency.objects.create(name="Test PD")
+        doc = Document.objects.create(agency=agency, file="test/report.pdf")
+        self.pdoc = ProcessedDocument.objects.create(
+            document=doc, file="test/report.ocr.pdf",
+        )
+        self.file_hash = file_sha256(self.pdoc.file.path)
+
+        # no poppler needed, we don't look at the images themselves
+        for name, value in (
+            ("pdf_page_count", 3), ("cached_page_image", self.image_path)
+        ):
+            patcher = mock.patch.object(views, name, return_value=value)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def get(self, page, **kwargs):
+        url = reverse("pdoc_page_image", args=(self.pdoc.pk, page))
+        return self.client.get(url, **kwargs)
+
+    def test_etag_and_not_modified(self, stdout):
+        response = self.get(1, data={"v": self.file_hash})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"jpeg")
+        etag = response["ETag"]
+        self.assertIn(self.file_hash, etag)
+        self.assertEqual(response["Cache-Control"], "private, max-age=86400")
+
+        response = self.get(
+            1, data={"v": self.file_hash}, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.cached_page_image.assert_called_once()
+
+        # other pages and sizes are different images
+        response = self.get(2, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        response = self.get(1, data={"w": 320}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_stale_version_isnt_cached(self, stdout):
+        response = self.get(1, data={"v": "old-hash"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+    def test_page_out_of_range(self, stdout):
+        self.assertIsNone(self.pdoc.pages)
+        response = self.get(3)
+        self.assertEqual(response.status_code, 404)
+        self.cached_page_image.assert_not_called()
+        # counted once and kept
+        self.pdoc.refresh_from_db()
+        self.assertEqual(self.pdoc.pages, 3)
+        self.assertEqual(self.get(2).status_code, 200)
+        self.pdf_page_count.assert_called_once()
+
+    def test_unreadable_pdf(self, stdout):
+        self.pdf_page_count.side_effect = PDFPageCountError("bad PDF")
+        self.assertEqual(self.get(0).status_code, 404)
+        self.cached_page_image.assert_not_called()
+
+
+class ScanTreeTestCase(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, "a", "b"))
+        self.write("a/report.pdf", "pdf")
+        self.write("a/b/report.csv", "csv")
+        self.manifest_path = os.path.join(self.root, "manifest.json")
+
+    def write(self, name, content):
+        with open(os.path.join(self.root, name), "w") as f:
+            f.write(content)
+
+    def touch_dir(self, name):
+        # don't rely on the clock ticking between writes
+        path = os.path.join(self.root, name)
+        mtime = os.stat(path).st_mtime_ns + 10 ** 9
+        os.utime(path, ns=(mtime, mtime))
+
+    def scan(self, manifest=None, new_manifest=None):
+        scanned = scan_tree(
+            os.path.join(self.root, "a"), manifest=manifest,
+            new_manifest=new_manifest,
+        )
+        return {f.path: f.size for f in scanned}, tree_signature(scanned)
+
+    def test_manifest_round_trip(self):
+        manifest = {}
+        files, signature = self.scan(new_manifest=manifest)
+        self.assertEqual(files, {"report.pdf": 3, "b/report.csv": 3})
+        save_scan_manifest(self.manifest_path, manifest, agencies={"a": 1})
+
+        loaded = load_scan_manifest(self.manifest_path)
+        self.assertEqual(set(loaded), set(manifest))
+        self.assertEqual(
+            load_scan_manifest(self.manifest_path, section="agencies"),
+            {"a": 1},
+        )
+        with mock.patch("os.scandir") as scandir:
+            self.assertEqual(self.scan(loaded), (files, signature))
+        scandir.assert_not_called()
+
+    def test_changed_dirs_get_rescanned(self):
+        manifest = {}
+        _, signature = self.scan(new_manifest=manifest)
+        self.write("a/b/report.cleaned.csv", "cleaned")
+        self.touch_dir("a/b")
+
+        with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            files, new_signature = self.scan(manifest)
+        # only the directory that changed
+        scandir.assert_called_once_with(os.path.join(self.root, "a", "b"))
+        self.assertIn("b/report.cleaned.csv", files)
+        self.assertNotEqual(new_signature, signature)
+
+    def test_overwritten_files_are_missed(self):
+        """
+        The known limitation: overwriting a file doesn't change its
+        directory's mtime, so the manifest's copy of it is used, stale
+        size and all. Only a scan without the manifest notices.
+        """
+        manifest = {}
+        files, signature = self.scan(new_manifest=manifest)
+        dir_mtime = os.stat(os.path.join(self.root, "a")).st_mtime_ns
+        self.write("a/report.pdf", "a longer pdf")
+        os.utime(os.path.join(self.root, "a"), ns=(dir_mtime, dir_mtime))
+
+        self.assertEqual(self.scan(manifest), (files, signature))
+        full_files, full_signature = self.scan()
+        self.assertEqual(full_files["report.pdf"], len("a longer pdf"))
+        self.assertNotEqual(full_signature, signature)
+
+    @mock.patch("sys.stdout")
+    def test_old_or_broken_manifests_are_ignored(self, stdout):
+        self.assertEqual(load_scan_manifest(None), {})
+        self.assertEqual(load_scan_manifest(self.manifest_path), {})
+        with open(self.manifest_path, "w") as f:
+            json.dump({"version": SCAN_MANIFEST_VERSION - 1, "dirs": {
+                "x": {"mtime": 1, "files": [], "dirs": []},
+            }}, f)
+        self.assertEqual(load_scan_manifest(self.manifest_path), {})
+        with open(self.manifest_path, "w") as f:
+            f.write("{not json")
+        self.assertEqual(load_scan_manifest(self.manifest_path), {})
+
+
+@mock.patch("sys.stdout")
+class ImportSafeManifestTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.data_dir = os.path.join(self.tmp_dir, "agency_attachments")
+        os.makedirs(os.path.join(self.data_dir, "Test PD"))
+        report = os.path.join(self.data_dir, "Test PD", "report.pdf")
+        with open(report, "w") as f:
+            f.write("pdf")
+        self.manifest_path = os.path.join(self.tmp_dir, "manifest.json")
+        Agency.objects.create(name="Test PD")
+
+    def import_safe(self, *args):
+        call_command(
+            "import_safe", self.data_dir, "--manifest", self.manifest_path,
+            *args
+        )
+        return list(Document.objects.values_list("file", flat=True))
+
+    def test_unchanged_agencies_are_skipped_until_full_scan(self, stdout):
+        imported = ["agency_attachments/Test PD/report.pdf"]
+        self.assertEqual(self.import_safe(), imported)
+
+        # gone from the DB, but the agency's directory didn't change
+        Document.objects.all().delete()
+        self.assertEqual(self.import_safe(), [])
+        self.assertEqual(self.import_safe("--full-scan"), imported)
+
+
+@mock.patch("sys.stdout")
+class ResolveDocumentStatusesTestCase(RollupAssertionsMixin, TestCase):
+    def setUp(self):
+        self.agency = Agency.objects.create(name="Test PD")
+        self.other_agency = Agency.objects.create(name="Other PD")
+
+    def document(self, name, pdoc_statuses=(), agency=None, **fields):
+        """
+        A document and its processed documents, with exactly the given
+        statuses. They're set with update() at the end, so the signal
+        handlers haven't resolved anything yet.
+        """
+        doc = Document.objects.create(
+            agency=agency or self.agency, file=f"test/{name}.pdf",
+        )
+        for ix, status in enumerate(pdoc_statuses):
+            pdoc = ProcessedDocument.objects.create(
+                document=doc, file=f"test/{name}-{ix}.csv",
+            )
+            ProcessedDocument.objects.filter(pk=pdoc.pk).update(
+                status=status
+            )
+        Document.objects.filter(pk=doc.pk).update(**{
+            "status": "unchecked", **fields
+        })
+        return doc
+
+    def statuses(self):
+        return dict(Document.objects.values_list("file", "status"))
+
+    def test_resolve(self, stdout):
+        self.document("best", [
+            "extractor", "awaiting-csv", "awaiting-cleaning",
+        ])
+        synthetic = self.document("synthetic", ["awaiting-csv"])
+        syn_document, = SyntheticDocument.objects.bulk_create([
+            SyntheticDocument(completed=True),
+        ])
+        syn_document.documents.add(synthetic)
+        # only completed synthetic documents count
+        incomplete = self.document("incomplete", ["awaiting-csv"])
+        syn_document, = SyntheticDocument.objects.bulk_create([
+            SyntheticDocument(completed=False),
+        ])
+        syn_document.documents.add(incomplete)
+        self.document("locked", ["complete"], status="case-doc")
+        self.document("no_records", ["awaiting-csv"], no_new_records=True)
+        self.document("empty", [], status="awaiting-reading")
+        # already right
+        self.document(
+            "other", ["complete"], agency=self.other_agency,
+            status="complete",
+        )
+
+        # the fixtures went around the signal handlers
+        rebuild_rollups()
+
+        agency_ids = signals.resolve_document_statuses()
+        self.assertEqual(agency_ids, {self.agency.pk})
+        self.assertEqual(self.statuses(), {
+            "test/best.pdf": "awaiting-cleaning",
+            "test/synthetic.pdf": "complete",
+            "test/incomplete.pdf": "awaiting-csv",
+            "test/locked.pdf": "case-doc",
+            "test/no_records.pdf": "unchecked",
+            "test/empty.pdf": "awaiting-reading",
+            "test/other.pdf": "complete",
+        })
+        self.assertRollupsMatchRecount(self.agency)
+        self.assertRollupsMatchRecount(self.other_agency)
+
+        # nothing left to do
+        self.assertEqual(signals.resolve_document_statuses(), set())
+
+    def test_only_given_documents(self, stdout):
+        first = self.document("first", ["awaiting-cleaning"])
+        self.document("second", ["awaiting-cleaning"])
+
+        self.assertEqual(
+            signals.resolve_document_statuses([first.pk, None]),
+            {self.agency.pk},
+        )
+        self.assertEqual(self.statuses(), {
+            "test/first.pdf": "awaiting-cleaning",
+            "test/second.pdf": "unchecked",
+        })
+        self.assertEqual(signals.resolve_document_statuses([None]), set())
+        self.assertEqual(signals.resolve_document_statuses([]), set())
+        self.assertEqual(self.statuses()["test/second.pdf"], "unchecked")
+
+
+# the lambda chain util.STATUSES used to be, frozen here to check the
+# suffix table against. the first status whose test matches wins
+OLD_STATUSES = OrderedDict({
+    "complete": lambda n: n.endswith(".cleaned.csv") or n.endswith(".complete.csv"),
+    "awaiting-cleaning": lambda n: (
+        n.endswith(".csv") and not n.endswith(".rough.csv") and not n.endswith(".auto.csv")
+    ) or n.endswith(".txt") or n.endswith(".precleaned.csv"),
+    "auto-extracted": lambda n: n.endswith(".auto.csv"),
+    "awaiting-csv": lambda n: n.endswith(".ocr.pdf"),
+    "awaiting-reading": lambda n: n.endswith(".msg"),
+    "awaiting-extraction": lambda n: n.endswith(".eml") or n.endswith(".rough.csv"),
+    "non-request": lambda n: False,
+    "supporting-document": lambda n: False,
+    "case-doc": lambda n: False,
+    "extractor": lambda n: (n.endswith(".R") and "make_" in n) or n.endswith(".py"),
+    "exemption-log": lambda n: False,
+    "unchecked": lambda n: True,
+})
+
+
+def old_classify(name):
+    for status, test_fn in OLD_STATUSES.items():
+        if test_fn(name):
+            return status
+
+
+def classify_test_names():
+    names = [
+        "", "csv", ".csv", "xcsv", "report", "report.pdf", "report.CSV",
+        "report.Rmd", "report.R.csv", "report.csv.pdf", "report%.csv",
+        "make_report.R", "makeXreport.R", "make_/report.R", "report.R",
+        "agency_attachments/Test PD/make_tables/report.R",
+        "agency_attachments/Test PD/Report (1) [final].ocr.pdf",
+    ]
+    # every suffix after every other, e.g. .auto.csv.rough.csv
+    suffixes = list(STATUS_SUFFIXES) + [".pdf", ".xlsx", ".auto", ".rough"]
+    for base in ("report", "make_report"):
+        for first, second in product([""] + suffixes, repeat=2):
+            names.append(f"{base}{first}{second}")
+    return sorted(set(names))
+
+
+class ClassifyTestCase(SimpleTestCase):
+    def test_matches_old_statuses_chain(self):
+        names = classify_test_names()
+        # make sure the table covers every status the chain could give
+        self.assertEqual(
+            set(old_classify(name) for name in names),
+            set(STATUS_SUFFIXES.values()) | {"unchecked"},
+        )
+        for name in names:
+            self.assertEqual(classify(name), old_classify(name), name)
+        self.assertEqual(
+            classify_many(names + names),
+            [old_classify(name) for name in names + names],
+        )
+        self.assertEqual(classify(None), "unchecked")
+
+
+class StatusCaseTestCase(TestCase):
+    def test_matches_classify(self):
+        names = classify_test_names()
+        # bulk_create, so nothing classifies them on the way in
+        Document.objects.bulk_create(Document(file=name) for name in names)
+        in_sql = dict(Document.objects.annotate(
+            computed=status_case(),
+        ).values_list("file", "computed"))
+        self.assertEqual(len(in_sql), len(names))
+        for name in names:
+            self.assertEqual(in_sql[name], classify(name), name)
+
+
+@mock.patch("sys.stdout")
+class RecomputeStatusesTestCase(RollupAssertionsMixin, TestCase):
+    def setUp(self):
+        self.agency = Agency.objects.create(name="Test PD")
+        self.other_agency = Agency.objects.create(name="Other PD")
+        for agency, name, status in (
+            (self.agency, "cleaned.cleaned.csv", "unchecked"),
+            # set by hand
+            (self.agency, "by_hand.csv", "non-request"),
+            (self.other_agency, "other.ocr.pdf", "unchecked"),
+        ):
+            doc = Document.objects.create(
+                agency=agency, file=f"test/{name}.pdf",
+            )
+            pdoc = ProcessedDocument.objects.create(
+                document=doc, file=f"test/{name}",
+            )
+            # like statuses classified by older suffix rules
+            ProcessedDocument.objects.filter(pk=pdoc.pk).update(status=status)
+            Document.objects.filter(pk=doc.pk).update(status="unchecked")
+        rebuild_rollups()
+
+    def statuses(self):
+        rows = ProcessedDocument.objects.values_list(
+            "file", "status", "document__status"
+        )
+        return {
+            file: (status, doc_status) for file, status, doc_status in rows
+        }
+
+    def test_agency(self, stdout):
+        call_command("recompute_statuses", "--agency", "Test PD")
+        self.assertEqual(self.statuses(), {
+            "test/cleaned.cleaned.csv": ("complete", "complete"),
+            # the resolver catches up on the document, the processed
+            # document keeps its status
+            "test/by_hand.csv": ("non-request", "non-request"),
+            "test/other.ocr.pdf": ("unchecked", "unchecked"),
+        })
+        self.assertRollupsMatchRecount(self.agency)
+        self.assertRollupsMatchRecount(self.other_agency)
+
+    def test_force(self, stdout):
+        call_command("recompute_statuses", "--force")
+        self.assertEqual(self.statuses(), {
+            "test/cleaned.cleaned.csv": ("complete", "complete"),
+            "test/by_hand.csv": ("awaiting-cleaning", "awaiting-cleaning"),
+            "test/other.ocr.pdf": ("awaiting-csv", "awaiting-csv"),
+        })
+        self.assertRollupsMatchRecount(self.agency)
+        self.assertRollupsMatchRecount(self.other_agency)
+        self.assertEqual(
+            AgencyStatusRollup.objects.get(
+                agency=self.other_agency, status="awaiting-csv",
+            ).documents,
+            1,
+        )
+
+
+class AgencyAdminTestCase(TestCase):
+    def setUp(self):
+        # (agency, {status: number of documents})
+        for name, status_counts in (
+            ("Done PD", {"complete": 3, "case-doc": 1, "extractor": 1}),
+            ("Half PD", {
+                "complete": 1, "awaiting-csv": 2, "unchecked": 1,
+                "non-request": 2,
+            }),
+            ("New PD", {"unchecked": 4, "awaiting-cleaning": 1}),
+            ("Empty PD", {}),
+        ):
+            agency = Agency.objects.create(name=name)
+            for status, n_documents in status_counts.items():
+                Document.objects.bulk_create(
+                    Document(
+                        agency=agency, status=status,
+                        file=f"test/{name}/{status}-{i}.pdf",
+                    )
+                    for i in range(n_documents)
+                )
+        rebuild_rollups()
+
+        self.model_admin = AgencyAdmin(Agency, admin.site)
+        self.user = User.objects.create_superuser("admin", "", "admin")
+
+    def request(self, **params):
+        request = RequestFactory().get("/admin/documents/agency/", params)
+        request.user = self.user
+        return request
+
+    def expected_columns(self, agency):
+        """
+        The changelist columns, added up straight from the rollup table.
+        """
+        counts = dict(AgencyStatusRollup.objects.filter(
+            agency=agency
+        ).values_list("status", "documents"))
+
+        def n_documents(statuses):
+            return sum(counts.get(status, 0) for status in statuses)
+
+        responsive = set(AgencyAdmin.RESPONSIVE_STATUSES)
+        n_responsive = n_documents(responsive)
+        n_status_done = n_documents(
+            responsive.intersection(AgencyAdmin.DONE_STATUSES)
+        )
+        pct = int(100 * n_status_done / n_responsive) if n_responsive else 0
+        return {
+            "responsive": n_responsive,
+            "unchecked": n_documents(["unchecked"]),
+            "await_csv": n_documents(
+                responsive.intersection(AgencyAdmin.AWAIT_CSV_STATUSES)
+            ),
+            "status_done": n_status_done,
+            "total": sum(counts.values()),
+            "pct_done": f"{pct}%",
+            "non_request": n_documents(AgencyAdmin.NON_REQUEST_STATUSES),
+        }
+
+    def test_columns_match_rollups(self):
+        agencies = self.model_admin.get_queryset(self.request())
+        self.assertEqual(len(agencies), 4)
+        for agency in agencies:
+            columns = {
+                column: getattr(self.model_admin, column)(agency)
+                for column in self.expected_columns(agency)
+            }
+            self.assertEqual(
+                columns, self.expected_columns(agency), agency.name
+            )
+        self.assertEqual(
+            self.model_admin.total(agencies.get(name="Half PD")), 6
+        )
+
+    def test_ordering(self):
+        list_display = list(self.model_admin.list_display)
+        for column in ("responsive", "unchecked", "await_csv",
+                       "status_done", "total", "pct_done"):
+            order_field = getattr(self.model_admin, column).admin_order_field
+            # the changelist's ?o= is a 1-based list_display index
+            changelist = self.model_admin.get_changelist_instance(
+                self.request(o=f"-{list_display.index(column) + 1}")
+            )
+            agencies = list(changelist.queryset)
+            values = [getattr(agency, order_field) for agency in agencies]
+            self.assertEqual(values, sorted(values, reverse=True), column)
+
+        # pct_done sorts on the percentage, not the string
+        changelist = self.model_admin.get_changelist_instance(
+            self.request(o=f"{list_display.index('pct_done') + 1}")
+        )
+        self.assertEqual(
+            [agency.name for agency in changelist.queryset][-1], "Done PD"
+        )
+
+
+class CSVReaderTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def csv(self, content, encoding="utf-8"):
+        path = os.path.join(self.tmp_dir, "test.csv")
+        with open(path, "w", newline="", encoding=encoding) as f:
+            f.write(content)
+        return path
+
+    def test_read_csv_headers(self):
+        # Excel's BOM isn't part of the first header
+        path = self.csv("\ufeffDate,Name\r\n\r\n1/1/2020,Ann\r\n")
+        self.assertEqual(
+            export_sqlite_dbs.read_csv_headers(path), (["Date", "Name"], True)
+        )
+        path = self.csv("Date,Name\n\n\n")
+        self.assertEqual(
+            export_sqlite_dbs.read_csv_headers(path),
+            (["Date", "Name"], False),
+        )
+        self.assertEqual(
+            export_sqlite_dbs.read_csv_headers(self.csv("")), ([], False)
+        )
+
+    @mock.patch("sys.stdout")
+    def test_iter_csv_rows(self, stdout):
+        path = self.csv(
+            "\ufeffdate,name,notes\n"
+            "1/1/2020,Ann,\"two\nlines\"\n"
+            "\n"
+            # short rows get padded
+            "1/2/2020,Bob\n"
+            "1/3/2020\n"
+            # empty cells past the end are fine
+            "1/4/2020,Cy,,,\n"
+        )
+        headers = ["date", "name", "notes"]
+        rows = export_sqlite_dbs.iter_csv_rows(path, headers)
+        self.assertEqual(list(rows), [
+            {"date": "1/1/2020", "name": "Ann", "notes": "two\nlines"},
+            {"date": "1/2/2020", "name": "Bob", "notes": ""},
+            {"date": "1/3/2020", "name": "", "notes": ""},
+            {"date": "1/4/2020", "name": "Cy", "notes": ""},
+        ])
+        self.assertFalse(stdout.write.called)
+
+    @mock.patch("sys.stdout")
+    def test_cells_past_last_header_are_dropped(self, stdout):
+        path = self.csv("a,b\n1,2,3\n4,5\n")
+        self.assertEqual(
+            list(export_sqlite_dbs.iter_csv_rows(path, ["a", "b"])),
+            [{"a": "1", "b": "2"}, {"a": "4", "b": "5"}],
+        )
+        output = "".join(c.args[0] for c in stdout.write.call_args_list)
+        self.assertIn("dropping cells past the last header on row 2", output)
+
+
+@mock.patch("sys.stdout")
+class ExportParallelTestCase(TransactionTestCase):
+    # the workers have their own DB connections, they can't see anything
+    # inside a test transaction
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        media_root = os.path.join(self.tmp_dir, "media")
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        csvs = {
+            "Test PD": {
+                "use of force 2019": "date,officer\n1/1/2019,A\n2/1/2019,B\n",
+                "use of force 2020": "date,officer\n1/1/2020,C\n",
+                "complaints": "date,complaint,outcome\n1/1/2020,x,y\n",
+            },
+            "Other PD": {
+                "arrests": "date,charge\n" + "1/1/2020,z\n" * 5,
+            },
+            "Empty PD": {},
+        }
+        for agency_name, agency_csvs in csvs.items():
+            agency = Agency.objects.create(name=agency_name)
+            agency_dir = os.path.join(media_root, agency_name)
+            os.makedirs(agency_dir)
+            for name, content in agency_csvs.items():
+                doc = Document.objects.create(
+                    agency=agency, file=f"{agency_name}/{name}.pdf",
+                )
+                ProcessedDocument.objects.create(
+                    document=doc, file=f"{agency_name}/{name}.cleaned.csv",
+                )
+                with open(os.path.join(agency_dir, f"{name}.cleaned.csv"),
+                          "w") as f:
+                    f.write(content)
+        self.assertEqual(
+            Document.objects.filter(status="complete").count(), 4
+        )
+
+    def export(self, *args):
+        output_dir = os.path.join(self.tmp_dir, f"export{len(args)}")
+        command = export_sqlite_dbs.Command()
+        call_command(command, output_dir, *args)
+
+        manifest = export_sqlite_dbs.load_export_manifest(output_dir)
+        for entry in manifest.values():
+            # written at different times
+            del entry["db"]["mtime"]
+            del entry["db"]["sha256"]
+        tables = {}
+        for filename in sorted(os.listdir(output_dir)):
+            if not filename.endswith(".db"):
+                continue
+            db = sqlite_utils.Database(os.path.join(output_dir, filename))
+            for table in db.tables:
+                tables[(filename, table.name)] = sorted(
+                    tuple(row.items()) for row in table.rows
+                )
+            db.conn.close()
+        return command, manifest, tables
+
+    def test_serial_and_parallel_match(self, stdout):
+        serial, serial_manifest, serial_tables = self.export()
+        parallel, parallel_manifest, parallel_tables = self.export(
+            "--workers", "2"
+        )
+
+        self.assertEqual(serial.total_rows, 9)
+        self.assertEqual(serial.total_agencies, 2)
+        self.assertEqual(len(serial_manifest), 2)
+        self.assertEqual(len(serial_tables), 3)
+
+        self.assertEqual(parallel.total_rows, serial.total_rows)
+        self.assertEqual(parallel.total_agencies, serial.total_agencies)
+        self.assertEqual(parallel_manifest, serial_manifest)
+        self.assertEqual(parallel_tables, serial_tables)
+        self.assertEqual(
+            sorted(parallel.filename_headers.dict, key=str),
+            sorted(serial.filename_headers.dict, key=str),
+        )
+
+
+# Frozen copy of the original recursive Smith-Waterman from
+# export_sqlite_dbs, the numpy version has to agree with it exactly.
+def old_matrix(a, b, match_score=3, gap_cost=2):
+    H = np.zeros((len(a) + 1, len(b) + 1))
+    i_range = range(1, H.shape[0])
+    j_range = range(1, H.shape[1])
+    for i, j in product(i_range, j_range):
+        score = match_score if a[i - 1] == b[j - 1] else -match_score
+        match = H[i - 1, j - 1] + score
+        delete = H[i - 1, j] - gap_cost
+        insert = H[i, j - 1] - gap_cost
+        H[i, j] = max(match, delete, insert, 0)
+    return H
+
+
+def old_traceback(H, b, b_='', old_i=0):
+    # flip H to get index of **last** occurrence of H.max() with np.argmax()
+    H_flip = np.flip(np.flip(H, 0), 1)
+    i_, j_ = np.unravel_index(H_flip.argmax(), H_flip.shape)
+    # (i, j) are **last** indexes of H.max()
+    i, j = np.subtract(H.shape, (i_ + 1, j_ + 1))
+    if H[i, j] == 0:
+        return b_, j
+    b_ = b[j - 1] + '-' + b_ if old_i - i > 1 else b[j - 1] + b_
+    return old_traceback(H[0:i, 0:j], b, b_, i)
+
+
+def old_smith_waterman(a, b, match_score=3, gap_cost=2):
+    a, b = a.lower(), b.lower()
+    H = old_matrix(a, b, match_score, gap_cost)
+    b_, pos = old_traceback(H, b)
+    return a[pos: pos + len(b_)]
+
+
+def smith_waterman_inputs():
+    pairs = [
+        ("", ""),
+        ("", "abc"),
+        ("abc", ""),
+        ("abc", "xyz"),
+        ("abc", "abc"),
+        ("ABC", "abc"),
+        ("aaaa", "aa"),
+        ("abab", "baba"),
+        ("abcxxxdef", "abcdef"),
+        ("abcdef", "abcxxxdef"),
+        ("Agency/use of force 2019.cleaned.csv",
+         "Agency/use of force 2020.cleaned.csv"),
+        ("Agency/UOF_2018-2019_redacted.cleaned.csv",
+         "Agency/uof 2020 (1).cleaned.csv"),
+        ("Agency/complaints.cleaned.csv", "Agency/arrests.cleaned.csv"),
+    ]
+    # fixed seed and a small alphabet, so there are plenty of repeats,
+    # ties and gaps
+    rand = random.Random(20)
+    for _ in range(200):
+        pairs.append(tuple(
+            "".join(rand.choice("ab_- .") for _ in range(rand.randint(0, 25)))
+            for _ in range(2)
+        ))
+    return pairs
+
+
+class SmithWatermanTestCase(SimpleTestCase):
+    def test_matrix(self):
+        for a, b in smith_waterman_inputs():
+            for match_score, gap_cost in [(3, 2), (1, 1), (2, 5)]:
+                with self.subTest(a=a, b=b, match_score=match_score,
+                                  gap_cost=gap_cost):
+                    np.testing.assert_array_equal(
+                        export_sqlite_dbs.matrix(a, b, match_score, gap_cost),
+                        old_matrix(a, b, match_score, gap_cost),
+                    )
+
+    def test_traceback(self):
+        for a, b in smith_waterman_inputs():
+            H = old_matrix(a, b)
+            with self.subTest(a=a, b=b):
+                b_, pos = export_sqlite_dbs.traceback(H, b)
+                old_b_, old_pos = old_traceback(H, b)
+                self.assertEqual(b_, old_b_)
+                self.assertEqual(pos, old_pos)
+
+    def test_smith_waterman(self):
+        for a, b in smith_waterman_inputs():
+            with self.subTest(a=a, b=b):
+                self.assertEqual(
+                    export_sqlite_dbs.smith_waterman(a, b),
+                    old_smith_waterman(a, b),
+                )
+
+    def test_common_filename(self):
+        groups = [
+            ["Agency/complaints.cleaned.csv"],
+            ["Agency/use of force 2019.cleaned.csv",
+             "Agency/use of force 2020.cleaned.csv",
+             "Agency/use of force 2021 (part 2).cleaned.csv"],
+            ["Agency/2019 UOF.cleaned.csv",
+             "Agency/UOF_2020.cleaned.csv",
+             "Agency/uof-2021-redacted.cleaned.csv",
+             "Agency/Use of Force 2022.cleaned.csv"],
+        ]
+        for filenames in groups:
+            with self.subTest(filenames=filenames):
+                self.assertEqual(
+                    export_sqlite_dbs.common_filename(filenames),
+                    export_sqlite_dbs.common_filename(
+                        filenames, align=old_smith_waterman
+                    ),
+                )
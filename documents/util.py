@@ -1,34 +1,10 @@
+import hashlib
 import os
+import re
 
-from django.db.models import Model
+from django.db.models import Case, CharField, Model, Q, Value, When
 
-from collections import OrderedDict
 
-
-# this is how we decide if a file is complete these are in order, from more
-# complete to less. the way we'll check for complete-ness is to group files
-# by name without extension and then find the most complete match based on
-# full filename here.
-# greater score means higher number of steps required to completion
-STATUSES = OrderedDict({
-    "complete": lambda n: n.endswith(".cleaned.csv") or n.endswith(".complete.csv"),
-    "awaiting-cleaning": lambda n: (
-        n.endswith(".csv") and not n.endswith(".rough.csv") and not n.endswith(".auto.csv")
-    ) or n.endswith(".txt") or n.endswith(".precleaned.csv"),
-    "auto-extracted": lambda n: n.endswith(".auto.csv"),
-    "awaiting-csv": lambda n: n.endswith(".ocr.pdf"),
-    "awaiting-reading": lambda n: n.endswith(".msg"),
-    "awaiting-extraction": lambda n: n.endswith(".eml") or n.endswith(".rough.csv"),
-    "non-request": lambda n: False, # don't ever match this, but include it for score
-    "supporting-document": lambda n: False, # all False status won't be matched
-    "case-doc": lambda n: False,
-    "extractor": lambda n: (n.endswith(".R") and "make_" in n) or n.endswith(".py"),
-    "exemption-log": lambda n: False,
-    "unchecked": lambda n: True,
-})
-
-STATUS_KEYS = list(STATUSES.keys())
-STATUS_SCORES = {st: STATUS_KEYS.index(st) for st in STATUS_KEYS}
 STATUS_NAMES = (
     ('complete', 'Complete'),
     ('awaiting-cleaning', 'Awaiting final cleaning'),
@@ -44,6 +20,95 @@ STATUS_NAMES = (
     ('unchecked', 'New/Unprocessed'),
 )
 
+STATUS_KEYS = [st for st, _ in STATUS_NAMES]
+# greater score means higher number of steps required to completion
+STATUS_SCORES = {st: STATUS_KEYS.index(st) for st in STATUS_KEYS}
+
+# this is how we decide a file's status from its name. we group files by
+# name without extension and then find the most complete match based on
+# the full filename here. a name gets the status of the longest suffix it
+# ends with, e.g. .rough.csv beats .csv and .cleaned.csv beats both. a
+# bunch of statuses (non-request, case-doc, etc) are never matched, they
+# only get set by hand. anything else is unchecked
+STATUS_SUFFIXES = {
+    ".cleaned.csv": "complete",
+    ".complete.csv": "complete",
+    ".precleaned.csv": "awaiting-cleaning",
+    ".csv": "awaiting-cleaning",
+    ".txt": "awaiting-cleaning",
+    ".auto.csv": "auto-extracted",
+    ".ocr.pdf": "awaiting-csv",
+    ".msg": "awaiting-reading",
+    ".eml": "awaiting-extraction",
+    ".rough.csv": "awaiting-extraction",
+    # R scripts are only extractors if they're named make_*
+    ".R": "extractor",
+    ".py": "extractor",
+}
+
+# matches the longest suffix a name ends with: the leftmost match wins and
+# every alternative is anchored to the end
+_STATUS_SUFFIX_RE = re.compile("({})\\Z".format("|".join(
+    re.escape(suffix)
+    for suffix in sorted(STATUS_SUFFIXES, key=len, reverse=True)
+)))
+
+
+def classify(name):
+    """
+    The status a file gets going by its name.
+    """
+    if not name:
+        return "unchecked"
+    match = _STATUS_SUFFIX_RE.search(name)
+    if not match:
+        return "unchecked"
+    suffix = match.group(1)
+    if suffix == ".R" and "make_" not in name:
+        return "unchecked"
+    return STATUS_SUFFIXES[suffix]
+
+
+def classify_many(names):
+    """
+    classify for a bunch of names at once, returns a list of statuses in
+    the same order. Names repeat a lot across groups, so each unique name
+    only gets matched once.
+    """
+    statuses = {}
+    for name in names:
+        if name not in statuses:
+            statuses[name] = classify(name)
+    return [statuses[name] for name in names]
+
+
+def status_case(field="file"):
+    """
+    classify as a SQL CASE expression over a file field, so statuses can be
+    computed in the DB for lots of rows at once.
+    """
+    whens = []
+    for suffix in sorted(STATUS_SUFFIXES, key=len, reverse=True):
+        condition = Q(**{f"{field}__endswith": suffix})
+        if suffix == ".R":
+            condition &= Q(**{f"{field}__contains": "make_"})
+        whens.append(When(condition, then=Value(STATUS_SUFFIXES[suffix])))
+    return Case(
+        *whens,
+        default=Value("unchecked"),
+        output_field=CharField(),
+    )
+
+
+# document statuses whose OCR'd PDFs can be segmented into incidents
+SEGMENTABLE_STATUSES = [
+    "awaiting-reading",
+    "auto-extracted",
+    "awaiting-extraction",
+    "case-doc",
+    "unchecked",
+]
+
 
 def document_file_path(instance_or_agency, filename):
     agency = ''
@@ -62,3 +127,24 @@ def document_file_path(instance_or_agency, filename):
         path = os.path.split(filepart)[0].strip("/")
 
     return os.path.join("agency_attachments", agency, path, filename)
+
+
+# (path, size, mtime) => sha256 hex digest
+_FILE_HASHES = {}
+
+
+def file_sha256(path):
+    """
+    Content hash of a file on disk. This is memoized on the file's path,
+    size and mtime so repeatedly looking up an unchanged file doesn't
+    re-read it.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _FILE_HASHES:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        _FILE_HASHES[key] = sha.hexdigest()
+    return _FILE_HASHES[key]
@@ -1,14 +1,23 @@
 import os
 import json
-import shutil
 
-from django.conf import settings
 from django.db.models import Q
-from django.http import JsonResponse, HttpResponse
+from django.http import (
+    FileResponse, Http404, HttpResponseBadRequest, HttpResponseNotModified,
+    JsonResponse, HttpResponse
+)
 from django.shortcuts import render
-from pdf2image import convert_from_path
+from django.urls import reverse
+from pdf2image.exceptions import PDFPageCountError, PDFSyntaxError
 
-from .models import Agency, ProcessedDocument, FieldCategory
+from .models import (
+    Agency, AgencyStatusRollup, ProcessedDocument, FieldCategory
+)
+from .pages import (
+    PAGE_IMAGE_WIDTHS, PAGE_THUMBNAIL_WIDTH, cached_page_image, pdf_page_count
+)
+from .rollups import document_rollup_changes
+from .util import file_sha256
 
 
 def fieldname_values(request):
@@ -48,86 +57,30 @@ def fieldname_value_count(request):
     return JsonResponse({'status': 'ok'})
 
 
-# TODO: share with export_autoextractable.py mgmt command
-SEGMENTABLE_STATUSES = [
-    "awaiting-reading",
-    "auto-extracted",
-    "awaiting-extraction",
-    "case-doc",
-    "unchecked",
-]
-
-
-# TODO: share with export_autoextractable.py mgmt command
 def agency_segmentable_pdocs(agency):
-    return ProcessedDocument.objects.filter(
-        file__endswith=".ocr.pdf",
-        document__agency=agency,
-        document__status__in=SEGMENTABLE_STATUSES,
-        # pages__gt=1,
-    ).order_by("-pages")
-
-
-def agency_pdoc_images(agency, pdoc):
-    if not pdoc.file:
-        return []
-    if not pdoc.file.path or not os.path.exists(pdoc.file.path):
-        return []
-
-    print(f"Parsing: {pdoc}")
-
-    pages = convert_from_path(pdoc.file.path, dpi=200)
+    return ProcessedDocument.objects.segmentable(agency=agency)
 
-    page_count = len(pages)
-    if not page_count:
-        return []
-
-    media_path = "wapd-segment-temp"
-    tmpdir = os.path.join(settings.MEDIA_ROOT, media_path)
-
-    # clear it (delete all files)
-    # TODO: store these by filename, reuse them and allow
-    # multi-processing LOL
-    if os.path.exists(tmpdir):
-        shutil.rmtree(tmpdir)
-
-    os.makedirs(tmpdir)
-
-    img_files = []
-    total_pages = 0
-    for idx, page in enumerate(pages):
-        filename = f"page-{idx}.jpg"
-        tmpfile_path = os.path.join(
-            tmpdir, filename
-        )
-        page.save(tmpfile_path, "JPEG")
-        url = os.path.join(settings.MEDIA_URL, media_path, filename)
-        img_files.append(url)
 
-    print(f" - Pages: {len(img_files)}")
-    return img_files
+def set_segmentation_counts(agency, counts):
+    counts = counts or {}
+    agency.total_segmentable_pdocs = counts.get("total", 0)
+    agency.segmented_pdocs = counts.get("segmented", 0)
+    agency.unsegmented_pdocs = counts.get("unsegmented", 0)
 
 
 def GET_segmentable_home(request):
-    agencies = Agency.objects.filter(
-        document__processeddocument__file__endswith=".ocr.pdf",
-        document__processeddocument__status__in=SEGMENTABLE_STATUSES,
-    ).distinct()
+    # agency_id => {total, segmented, unsegmented}
+    agency_counts = {
+        counts["agency_id"]: counts
+        for counts in AgencyStatusRollup.objects.segmentation_counts()
+    }
+    agencies = Agency.objects.filter(pk__in=agency_counts.keys())
 
     total_segmentable_pdocs = 0
     segmented_pdocs = 0
     unsegmented_pdocs = 0
     for agency in agencies:
-        segmentable_pdocs = agency_segmentable_pdocs(agency)
-        agency.total_segmentable_pdocs = segmentable_pdocs.count()
-        agency.segmented_pdocs = segmentable_pdocs.filter(
-            incident_pgs__isnull=False,
-            incident_pgs__len__gt=0
-        ).count()
-        agency.unsegmented_pdocs = segmentable_pdocs.exclude(
-            incident_pgs__isnull=False,
-            incident_pgs__len__gt=0
-        ).count()
+        set_segmentation_counts(agency, agency_counts[agency.pk])
         total_segmentable_pdocs += agency.total_segmentable_pdocs
         segmented_pdocs += agency.segmented_pdocs
         unsegmented_pdocs += agency.unsegmented_pdocs
@@ -143,6 +96,11 @@ def GET_segmentable_home(request):
 
 def GET_agency(request, id):
     agency = Agency.objects.get(pk=id)
+    # NOTE: not .first(), that would add an ORDER BY id to the GROUP BY
+    counts = AgencyStatusRollup.objects.filter(
+        agency=agency
+    ).segmentation_counts()
+    set_segmentation_counts(agency, next(iter(counts), None))
     context = {
         "status": "ok",
         "agency": agency,
@@ -170,17 +128,102 @@ def GET_pdoc(request, pdoc_id):
     return render(request, "pdoc.htmx", context=context)
 
 
+def pdoc_page_count(pdoc):
+    """
+    How many pages a processed document's PDF has, counting (and storing)
+    them if we haven't yet. None if the PDF can't be read.
+    """
+    if pdoc.pages:
+        return pdoc.pages
+    try:
+        pdoc.pages = pdf_page_count(pdoc.file.path)
+    except (PDFPageCountError, PDFSyntaxError):
+        return None
+    # update() fires no signals, so keep the page totals in sync here
+    with document_rollup_changes([pdoc.document_id]):
+        ProcessedDocument.objects.filter(pk=pdoc.pk).update(
+            pages=pdoc.pages
+        )
+    return pdoc.pages
+
+
 def GET_pdoc_image_segments(request, pdoc_id):
     pdoc = ProcessedDocument.objects.get(pk=pdoc_id)
+
+    # we only need the page count here, the images themselves get
+    # rendered (and cached) as the browser asks for them
+    if pdoc.file and os.path.exists(pdoc.file.path):
+        pdoc_page_count(pdoc)
+
+    # the PDF's content hash goes in the image URLs, so they change (and
+    # browsers don't show cached images) when the document gets re-OCRed
+    version = None
+    if pdoc.file and os.path.exists(pdoc.file.path):
+        version = file_sha256(pdoc.file.path)
+
+    images = []
+    for page in range(pdoc.pages or 0):
+        url = reverse("pdoc_page_image", args=(pdoc.pk, page))
+        url = f"{url}?v={version}"
+        images.append({
+            "page": page,
+            "url": url,
+            "thumb_url": f"{url}&w={PAGE_THUMBNAIL_WIDTH}",
+        })
+
     context = {
         "status": "ok",
         "pdoc": pdoc,
         "agency": pdoc.document.agency,
-        "images": pdoc.images(),
+        "images": images,
     }
     return render(request, "pdoc_image_segments.htmx", context=context)
 
 
+def GET_pdoc_page_image(request, pdoc_id, page):
+    pdoc = ProcessedDocument.objects.get(pk=pdoc_id)
+    if not pdoc.file or not os.path.exists(pdoc.file.path):
+        raise Http404("Processed document has no file")
+    n_pages = pdoc_page_count(pdoc)
+    if n_pages is None:
+        raise Http404("Couldn't read PDF")
+    if page >= n_pages:
+        raise Http404("No such page")
+
+    width = request.GET.get("w")
+    if width:
+        try:
+            width = int(width)
+        except ValueError:
+            return HttpResponseBadRequest("Bad width")
+        if width not in PAGE_IMAGE_WIDTHS:
+            return HttpResponseBadRequest(
+                f"Width must be one of: {PAGE_IMAGE_WIDTHS}"
+            )
+
+    file_hash = file_sha256(pdoc.file.path)
+    etag = f'"{file_hash}-{page}-{width or "full"}"'
+    if request.GET.get("v") == file_hash:
+        # this URL only ever points at this version of the file
+        cache_control = "private, max-age=86400"
+    else:
+        # an old or missing version, make the browser check every time
+        cache_control = "private, no-cache"
+
+    if request.META.get("HTTP_IF_NONE_MATCH") == etag:
+        response = HttpResponseNotModified()
+    else:
+        image_path = cached_page_image(pdoc.file.path, page, width=width)
+        if not image_path:
+            raise Http404("Couldn't render page")
+        response = FileResponse(
+            open(image_path, "rb"), content_type="image/jpeg"
+        )
+    response["ETag"] = etag
+    response["Cache-Control"] = cache_control
+    return response
+
+
 def POST_save_image_segments(request, pdoc_id):
     pdoc = ProcessedDocument.objects.get(pk=pdoc_id)
     print("POST", request.POST)
@@ -129,6 +129,11 @@ MEDIA_URL= '/files/'
 MEDIA_ROOT=f"{BASE_DIR}/data/"
 DEFAULT_FILE_STORAGE = 'documents.storage.OverwritingFileSystemStorage'
 
+# A PDF to text jar that implements the --server mode documents/pdf2text.py
+# speaks. The stock Snowtide jar doesn't, and none is included here. Unset
+# (the default), every extraction launches its own JVM with the regular jar.
+PDF_TO_TEXT_SERVER_JAR = os.getenv("PDF_TO_TEXT_SERVER_JAR")
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.1/topics/i18n/
 
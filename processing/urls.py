@@ -41,6 +41,9 @@ urlpatterns = [
     path("api/pdoc_image_segments/<int:pdoc_id>",
          documents_views.GET_pdoc_image_segments,
          name="pdoc_image_segments"),
+    path("api/pdoc/<int:pdoc_id>/page/<int:page>.jpg",
+         documents_views.GET_pdoc_page_image,
+         name="pdoc_page_image"),
     path("api/save-segments/<int:pdoc_id>",
          documents_views.POST_save_image_segments,
          name="save_segments"),